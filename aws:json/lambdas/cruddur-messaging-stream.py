@@ -60,7 +60,8 @@ def lambda_handler(event, context):
     # =========================================================================
     # PARSE MESSAGE DATA
     # =========================================================================
-    message_group_uuid = pk.replace("MSG#", "")
+    # sharded groups write to MSG#<group_uuid>#<shard>; strip the shard suffix
+    message_group_uuid = pk.replace("MSG#", "").split("#", 1)[0]
     message = event['Records'][0]['dynamodb']['NewImage']['message']['S']
     print(f"GROUP ===> {message_group_uuid}, message: {message}")
     
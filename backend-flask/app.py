@@ -3,6 +3,8 @@
 # ============================================================
 from flask import Flask
 from flask import request
+from flask import Response, stream_with_context
+from flask import g
 from flask_cors import CORS, cross_origin
 import os
 
@@ -22,117 +24,103 @@ from services.create_message import *
 from services.show_activity import *
 from services.users_short import *
 from services.update_profile import *
+from services.message_stream import *
+from services.react_activity import *
 
 # ============================================================
 # AUTHENTICATION - AWS COGNITO
 # ============================================================
 # JWT token verification for authenticated requests
-from lib.cognito_jwt_token import CognitoJwtToken, extract_access_token, TokenVerifyError
+from lib.cognito_jwt_token import CognitoJwtToken
+# Request-scoped auth: verifies once per request, claims/user live on flask.g
+from lib.auth import authenticate, AUTH_REQUIRED, AUTH_OPTIONAL
+from lib.auth import current_claims, current_cognito_user_id, current_user_uuid
+import lib.auth
 
 # ============================================================
-# OBSERVABILITY - OPENTELEMETRY (HONEYCOMB)
+# CONDITIONAL GET (ETag / Last-Modified -> 304)
 # ============================================================
-# Distributed tracing setup - currently partially disabled in favor of X-Ray
-from opentelemetry import trace
-from opentelemetry.instrumentation.flask import FlaskInstrumentor
-from opentelemetry.instrumentation.requests import RequestsInstrumentor
-from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.sdk.trace.export import ConsoleSpanExporter, SimpleSpanProcessor
+from lib.conditional import conditional_response
 
 # ============================================================
-# OBSERVABILITY - AWS X-RAY
+# RESPONSE CACHE (PUBLIC READS, STALE-WHILE-REVALIDATE)
 # ============================================================
-# AWS's distributed tracing service - takes priority over OpenTelemetry Flask instrumentation
-from aws_xray_sdk.core import xray_recorder
-from aws_xray_sdk.ext.flask.middleware import XRayMiddleware
+# Pre-serialized bodies of the anonymous feed, profiles and user cards;
+# dropped by the writes that change them (see lib/cache.py)
+from lib.cache import cached_response
 
 # ============================================================
-# LOGGING - AWS CLOUDWATCH
+# RESPONSE ENCODING
 # ============================================================
-# Send application logs to CloudWatch for centralized monitoring
-import watchtower
-import logging
-import sys
-import time
-from time import strftime
+# orjson-backed JSON provider (UUID/datetime aware) and negotiated
+# gzip/brotli compression for large bodies
+from lib.json_provider import FastJSONProvider, json_body
+import lib.compress
 
 # ============================================================
-# ERROR TRACKING - ROLLBAR
+# LOAD SHEDDING (ADAPTIVE CONCURRENCY LIMITS PER ROUTE GROUP)
 # ============================================================
-# Third-party error monitoring and tracking service
-# import rollbar
-# import rollbar.contrib.flask
-# from flask import got_request_exception
+import lib.concurrency
 
 # ============================================================
-# CLOUDWATCH CONFIGURATION
+# RATE LIMITING (TOKEN BUCKETS PER USER / IP ON WRITE ENDPOINTS)
 # ============================================================
-# Configure log group, region, and stream for CloudWatch Logs
-CLOUDWATCH_LOG_GROUP = os.environ.get('CLOUDWATCH_LOG_GROUP', 'cruddur')
-AWS_REGION = os.environ.get('AWS_REGION', 'us-east-1')
-CLOUDWATCH_LOG_STREAM = os.environ.get('CLOUDWATCH_LOG_STREAM', f"app-instance-{int(time.time())}")
+from lib.ratelimit import rate_limit
 
 # ============================================================
-# LOGGER SETUP
+# IDEMPOTENCY KEYS (SAFE CLIENT RETRIES OF CREATE ENDPOINTS)
 # ============================================================
-# Configure Python logger to write to both console (STDOUT) and CloudWatch
-LOGGER = logging.getLogger(__name__)
-LOGGER.setLevel(logging.DEBUG)
-
-# Console handler - logs appear in docker logs
-console_handler = logging.StreamHandler(sys.stdout)
-console_handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-console_handler.setFormatter(formatter)
-LOGGER.addHandler(console_handler)
-
-# CloudWatch handler - logs sent to AWS CloudWatch (requires AWS credentials)
-try:
-    cw_handler = watchtower.CloudWatchLogHandler(
-        log_group_name=CLOUDWATCH_LOG_GROUP,
-        log_stream_name=CLOUDWATCH_LOG_STREAM,
-        # region_name=AWS_REGION,  # Not used - watchtower auto-detects region from AWS credentials
-        create_log_group=True,
-        create_log_stream=True,
-    )
-    LOGGER.addHandler(cw_handler)
-    LOGGER.info("CloudWatch logging configured successfully.")
-except Exception as e:
-    LOGGER.error(f"Failed to configure CloudWatch logging: {e}")
+from lib.idempotency import idempotent
 
 # ============================================================
-# OPENTELEMETRY TRACING SETUP
+# OBSERVABILITY - TRACING (OPENTELEMETRY/HONEYCOMB OR AWS X-RAY)
 # ============================================================
-# Initialize tracer provider and configure to send traces to OTEL Collector
-provider = TracerProvider()
-processor = BatchSpanProcessor(OTLPSpanExporter())
-provider.add_span_processor(processor)
+# One tracing facade with per-route head sampling and tail sampling of
+# slow/failed requests; the backend SDK is loaded on the exporter thread
+# (see lib/observability.py) so it does not hold up worker startup
+from lib.observability import capture
+import lib.observability
 
 # ============================================================
-# X-RAY CONFIGURATION
+# OBSERVABILITY - METRICS (PROMETHEUS /metrics)
 # ============================================================
-# Configure X-Ray recorder with service name and dynamic naming pattern
-xray_url = os.getenv("AWS_XRAY_URL")
-xray_recorder.configure(service='backend-flask', dynamic_naming=xray_url)
+# Per-route request counts and latency histograms plus Db, DynamoDB, cache
+# and limiter metrics, summed over the gunicorn workers (see lib/metrics.py)
+import lib.metrics
 
 # ============================================================
-# COMMENTED OUT: Console trace exporter
+# LOGGING - STRUCTURED JSON PIPELINE (STDOUT + CLOUDWATCH)
 # ============================================================
-# Would print OpenTelemetry traces to STDOUT for debugging
-# Disabled to reduce log noise - using OTEL Collector instead
-#simple_processor = SimpleSpanProcessor(ConsoleSpanExporter())
-#provider.add_span_processor(simple_processor)
+# Request threads only enqueue records; a background shipper writes JSON lines
+# to stdout and, with LOG_CLOUDWATCH=1, to CloudWatch via watchtower.
+# See lib/log.py for LOG_LEVEL / ACCESS_LOG_SAMPLE / LOG_QUEUE_SIZE.
+import logging
+import time
+from lib.log import get_logger, access_log_sampled
 
-# Set global tracer provider and get tracer instance for this module
-trace.set_tracer_provider(provider)
-tracer = trace.get_tracer(__name__)
+# ============================================================
+# ERROR TRACKING - ROLLBAR
+# ============================================================
+# Third-party error monitoring and tracking service
+# import rollbar
+# import rollbar.contrib.flask
+# from flask import got_request_exception
+
+# ============================================================
+# LOGGER SETUP
+# ============================================================
+LOGGER = get_logger('app')
+ACCESS_LOGGER = get_logger('access')
 
 # ============================================================
 # FLASK APP INITIALIZATION
 # ============================================================
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
+lib.compress.init_app(app)
+# first before_request hook: shed excess load (503 + Retry-After) before any
+# auth or database work is done for it
+lib.concurrency.init_app(app)
 
 # ============================================================
 # COGNITO JWT TOKEN VERIFIER
@@ -143,19 +131,40 @@ cognito_jwt_token = CognitoJwtToken(
   user_pool_client_id=os.getenv("AWS_COGNITO_USER_POOL_CLIENT_ID"),
   region=os.getenv("AWS_REGION")
 )
+lib.auth.init_app(app, cognito_jwt_token)
+
+# ============================================================
+# READINESS CHECKS
+# ============================================================
+# Postgres, DynamoDB and JWKS are checked by a background thread per
+# worker; /api/health-check/ready only serves the last result
+import lib.health
+lib.health.init_app(cognito_jwt_token)
  
 # ============================================================
-# X-RAY MIDDLEWARE
+# REQUEST TRACING
+# ============================================================
+# Records spans per request and exports the sampled ones to the single
+# TRACING_BACKEND (otel or xray) from a background thread
+lib.observability.init_app(app)
+
+# ============================================================
+# METRICS
 # ============================================================
-# Must be initialized FIRST before other Flask instrumentations to avoid conflicts
-XRayMiddleware(app, xray_recorder)
+# Serves /metrics (Prometheus text format); with METRICS_DIR set each
+# worker also writes its snapshot there for the others to sum
+lib.metrics.init_app(app)
 
 # ============================================================
-# OPENTELEMETRY INSTRUMENTATION
+# DATABASE POOL
 # ============================================================
-# FlaskInstrumentor().instrument_app(app) - DISABLED to prevent conflict with X-Ray middleware
-# Only instrumenting outgoing HTTP requests, not the Flask app itself
-RequestsInstrumentor().instrument()
+# The pool is created lazily; open it in the background so the first
+# request does not pay for importing psycopg and connecting. With
+# GUNICORN_PRELOAD=1 this is deferred to each worker after the fork
+# (lib/process.py), the master never opens a connection
+from lib.db import db
+import lib.process
+lib.process.on_worker_start(db.start_background_open)
 
 # ============================================================
 # CORS CONFIGURATION
@@ -168,8 +177,11 @@ cors = CORS(
     app,
   resources={r"/api/*": {
     "origins": origins,  # Only allow requests from these origins
-    "allow_headers": ["Authorization", "Content-Type", "if-modified-since"],
-    "expose_headers": ["location", "link", "Authorization"],
+    "allow_headers": ["Authorization", "Content-Type", "if-modified-since", "if-none-match",
+                      "Idempotency-Key"],
+    "expose_headers": ["location", "link", "Authorization", "ETag", "Last-Modified",
+                       "RateLimit-Limit", "RateLimit-Remaining", "RateLimit-Reset",
+                       "RateLimit-Policy", "Retry-After", "Idempotent-Replayed"],
     "methods": ["OPTIONS", "GET", "HEAD", "POST"]
   }}
     # COMMENTED OUT: Old CORS configuration - kept for reference
@@ -183,29 +195,37 @@ cors = CORS(
 # ============================================================
 # REQUEST LOGGING MIDDLEWARE
 # ============================================================
-# Runs before every request to log incoming request details for debugging
+# Runs before every request; records the start time for the access log
 @app.before_request
 def log_request_info():
-    print('='*70)
-    print('🔍 INCOMING REQUEST')
-    print(f'   Method: {request.method}')
-    print(f'   Path: {request.path}')
-    print(f'   Origin: {request.headers.get("Origin", "NO ORIGIN")}')
-    print(f'   Authorization header present: {"Authorization" in request.headers}')
-    if "Authorization" in request.headers:
-        auth_header = request.headers.get("Authorization")
-        print(f'   Auth header (first 50 chars): {auth_header[:50]}...')
-    print('='*70)
+    # only stamps the start time; the access log line is written after the
+    # response (sampled per route) and never includes the Authorization header
+    g.request_started = time.perf_counter()
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.debug("request", extra={'fields': {
+            'method': request.method,
+            'path': request.path,
+            'origin': request.headers.get("Origin"),
+            'authorization': "Authorization" in request.headers
+        }})
 
 # =============================================================
 # API ENDPOINTS - HEALTH CHECK
 # =============================================================
-# Simple health check endpoint for load balancer and container health checks
-# Returns 200 OK if the Flask app is running
+# Liveness, for the ECS container health check: returns 200 OK if the
+# Flask app is running, without touching any dependency
 @app.route('/api/health-check')
 def health_check():
   return {'success': True, 'version': 1}, 200
 
+# Readiness, for the ALB target group: 503 while Postgres, DynamoDB or the
+# Cognito keys are unusable. Serves the cached result of the background
+# checks (lib/health.py), so probes never add load to the database
+@app.route('/api/health-check/ready')
+def health_check_ready():
+  ready, body = lib.health.readiness.status()
+  return body, 200 if ready else 503, {'Cache-Control': 'no-store'}
+
 # ============================================================
 # ROLLBAR INITIALIZATION
 # ============================================================
@@ -236,177 +256,208 @@ def health_check():
 # ============================================================
 # RESPONSE LOGGING MIDDLEWARE
 # ============================================================
-# Runs after every request to log the response for monitoring
+# Runs after every request to log the response for monitoring and to
+# record it in the request metrics
 @app.after_request
 def after_request(response):
-    timestamp = strftime('[%Y-%b-%d %H:%M]')
-    LOGGER.error('%s %s %s %s %s %s', timestamp, request.remote_addr, request.method, request.scheme, request.full_path, response.status)
+    duration_ms = (time.perf_counter() - g.get('request_started', time.perf_counter())) * 1000
+    lib.metrics.observe_request(request.method, request.url_rule.rule if request.url_rule else None,
+                                response.status_code, duration_ms / 1000)
+    route = request.url_rule.rule if request.url_rule else request.path
+    if access_log_sampled(route, response.status_code, duration_ms):
+        # the route template and the path only: the query string can carry
+        # tokens and personal data, and is never logged
+        ACCESS_LOGGER.info('%s %s %s', request.method, route, response.status_code, extra={'fields': {
+            'remote_addr': request.remote_addr,
+            'method': request.method,
+            'route': route,
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': round(duration_ms, 2)
+        }})
     return response
 
 # ============================================================
 # API ENDPOINTS - MESSAGE GROUPS
 # ============================================================
 @app.route("/api/message_groups", methods=['GET'])
+@authenticate(AUTH_REQUIRED)
 def data_message_groups():
-    access_token = extract_access_token(request.headers)
-    try:
-        claims = cognito_jwt_token.verify(access_token)
-        # authenicatied request
-        app.logger.debug("authenicated")
-        app.logger.debug(claims)
-        cognito_user_id = claims['sub']
-        model = MessageGroups.run(cognito_user_id=cognito_user_id)
-        if model['errors'] is not None:
-         return model['errors'], 422
-        else:
-         return model['data'], 200
-    except TokenVerifyError as e:
-        # unauthenicatied request
-        app.logger.debug(e)
-        return {}, 401
+    my_user_uuid = current_user_uuid()
+
+    def build():
+      model = MessageGroups.run(cognito_user_id=current_cognito_user_id(), my_user_uuid=my_user_uuid)
+      if model['errors'] is not None:
+       return model['errors'], 422
+      else:
+       return model['data'], 200
+    return conditional_response(*MessageGroups.validators(my_user_uuid), build=build)
 
 # ============================================================
 # API ENDPOINTS - DIRECT MESSAGES
 # ============================================================
 @app.route("/api/messages/<string:message_group_uuid>", methods=['GET', 'OPTIONS'])
 @cross_origin()
+@authenticate(AUTH_REQUIRED)
 def data_messages(message_group_uuid):
-    access_token = extract_access_token(request.headers)
-    try:
-        claims = cognito_jwt_token.verify(access_token)
-        # authenticated request
-        app.logger.debug("authenticated")
-        app.logger.debug(claims)
-        cognito_user_id = claims['sub']
+    def build():
         model = Messages.run(
-            cognito_user_id=cognito_user_id, 
-            message_group_uuid=message_group_uuid
+            cognito_user_id=current_cognito_user_id(),
+            message_group_uuid=message_group_uuid,
+            my_user_uuid=current_user_uuid()
           )
         if model['errors'] is not None:
             return model['errors'], 422
         else:
             return model['data'], 200
-    except TokenVerifyError as e:
-        # unauthenticated request
-        app.logger.debug(e)
-        return {}, 401 
+    return conditional_response(*Messages.validators(message_group_uuid), build=build)
 
 @app.route("/api/messages", methods=['POST','OPTIONS'])
 @cross_origin()
+@authenticate(AUTH_REQUIRED)
+@idempotent('create_message')
+@rate_limit('create_message')
 def data_create_message():
   message_group_uuid   = request.json.get('message_group_uuid',None)
   user_receiver_handle = request.json.get('handle',None)
   message = request.json['message']
-  access_token = extract_access_token(request.headers)
-  try:
-    claims = cognito_jwt_token.verify(access_token)
-    # authenicatied request
-    app.logger.debug("authenicated")
-    app.logger.debug(claims)
-    cognito_user_id = claims['sub']
-    if message_group_uuid == None:
-      # Create for the first time
-      model = CreateMessage.run(
-        mode="create",
-        message=message,
-        cognito_user_id=cognito_user_id,
-        user_receiver_handle=user_receiver_handle
-      )
-    else:
-      # Push onto existing Message Group
-      model = CreateMessage.run(
-        mode="update",
-        message=message,
-        message_group_uuid=message_group_uuid,
-        cognito_user_id=cognito_user_id
-      )
-    if model['errors'] is not None:
-      return model['errors'], 422
-    else:
-      return model['data'], 200
-  except TokenVerifyError as e:
-    # unauthenicatied request
-    app.logger.debug(e)
-    return {}, 401
+  cognito_user_id = current_cognito_user_id()
+  if message_group_uuid == None:
+    # Create for the first time
+    model = CreateMessage.run(
+      mode="create",
+      message=message,
+      cognito_user_id=cognito_user_id,
+      user_receiver_handle=user_receiver_handle
+    )
+  else:
+    # Push onto existing Message Group
+    model = CreateMessage.run(
+      mode="update",
+      message=message,
+      message_group_uuid=message_group_uuid,
+      cognito_user_id=cognito_user_id
+    )
+  if model['errors'] is not None:
+    return model['errors'], 422
+  else:
+    return model['data'], 200
 
 
+# ============================================================
+# API ENDPOINTS - MESSAGE STREAM (SERVER-SENT EVENTS)
+# ============================================================
+# Pushes new messages for the signed-in user instead of polling
+# /api/messages/<uuid> and /api/message_groups.
+# EventSource cannot set headers, so the stream is opened with a one-time
+# ticket from /api/stream/ticket rather than with the JWT in the URL
+@app.route("/api/stream/ticket", methods=['POST','OPTIONS'])
+@cross_origin()
+@authenticate(AUTH_REQUIRED)
+@rate_limit('stream_ticket')
+def data_stream_ticket():
+    my_user_uuid = current_user_uuid()
+    if my_user_uuid is None:
+        return ['user_not_found'], 422
+    ticket = MessageStream.issue_ticket(my_user_uuid)
+    if ticket is None:
+        return {'errors': ['stream_ticket_failed']}, 503
+    return ticket, 200, {'Cache-Control': 'no-store'}
+
+@app.route("/api/stream", methods=['GET'])
+def data_stream():
+    if not MessageStream.acquire():
+        # out of stream slots in this worker: client keeps polling for now
+        # (the ticket is left unused for the retry)
+        return {'errors': ['stream_capacity']}, 503, {'Retry-After': '30'}
+    my_user_uuid = MessageStream.redeem_ticket(request.args.get('ticket'))
+    if my_user_uuid is None:
+        MessageStream.release()
+        return {}, 401
+
+    response = Response(
+        stream_with_context(MessageStream.run(my_user_uuid)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    response.call_on_close(MessageStream.release)
+    return response
+
 # ============================================================
 # API ENDPOINTS - HOME FEED
 # ============================================================
 @app.route("/api/activities/home", methods=['GET', 'OPTIONS'])
 @cross_origin()
-@xray_recorder.capture('activities_home')
+@capture('activities_home')
+@authenticate(AUTH_OPTIONAL)
 def data_home():
     """
     Get home activities feed - supports both authenticated and unauthenticated users
     
-    Authentication flow:
-    1. Extract JWT token from Authorization header
-    2. Verify token with AWS Cognito
-    3. If valid: return personalized feed
-    4. If invalid/missing: return public feed
+    Authentication flow (see lib/auth.py):
+    1. @authenticate(AUTH_OPTIONAL) verifies the token once, if one was sent
+    2. If valid: return personalized feed
+    3. If invalid/missing: return public feed
+
+    Both feeds honor If-None-Match / If-Modified-Since and answer 304
+    when nothing was posted since the client's copy. The feed JSON built
+    by Postgres is passed through as the body without being re-parsed;
+    the public feed is also served from the response cache (lib/cache.py).
     """
-    # Extract and verify JWT access token
-    access_token = extract_access_token(request.headers)
-    
-    # COMMENTED OUT: Alternative auth header extraction method
-    #auth_header = request.headers.get('Authorization')
-    #if not auth_header:
-        #return {"error": "Authorization header is missing"}, 401
-
-    try:
-        # Verify token and get user claims (throws TokenVerifyError if invalid)
-        claims = cognito_jwt_token.verify(access_token)
-
-        # Authenticated request - log user info
-        app.logger.debug("authenticated")
-        app.logger.debug(claims)
-        app.logger.debug(claims['username'])
-
-        # Return personalized feed with user's Cognito ID
-        data = HomeActivities().run(cognito_user_id=claims['username'])
-
-        # COMMENTED OUT: Additional token validation
-        #token_type, access_token = auth_header.split()
-        #if token_type.lower() != 'bearer':
-        return data, 200
-
-    except TokenVerifyError as e:
-        # Unauthenticated request - return public feed
-        app.logger.debug(e)
-        app.logger.debug("unauthenticated")
-
-        data = HomeActivities().run()
+    claims = current_claims()
+    if claims is None:
+        # Unauthenticated request - the public feed is the same for everyone
+        return cached_response(HomeActivities.CACHE_KEY, build=HomeActivities().cached_body)
 
-        # COMMENTED OUT: Debug logging
-        #print(f"Received access token: {access_token}")
-        # COMMENTED OUT: Alternative service call with logger
-        #data = HomeActivities.run(logger=LOGGER)
-
-        return data, 200
+    # Return personalized feed with user's Cognito ID
+    build = lambda: (json_body(HomeActivities().run(cognito_user_id=claims['username'], raw=True)), 200)
+    return conditional_response(*HomeActivities().validators(), build=build)
 
 # ============================================================
 # API ENDPOINTS - NOTIFICATIONS
 # ============================================================
 @app.route("/api/activities/notifications", methods=['GET'])
-@xray_recorder.capture('notifications_api_call')  # Track this endpoint in X-Ray
+@authenticate(AUTH_REQUIRED)
+@capture('notifications_api_call')  # span around the endpoint
 def data_notifications():
-    """Get notification activities for user"""
-    data = NotificationsActivities.run()
-    return data, 200
+    """Get a page of the signed-in user's notifications, newest first"""
+    model = NotificationsActivities.run(
+        user_uuid=current_user_uuid(),
+        before=request.args.get('before'),
+        limit=request.args.get('limit', type=int)
+    )
+    if model['errors'] is not None:
+        return model['errors'], 422
+    return model['data'], 200
+
+# Unread badge: one primary key lookup, cheap to poll
+@app.route("/api/notifications/unread", methods=['GET'])
+@authenticate(AUTH_REQUIRED)
+def data_notifications_unread():
+    user_uuid = current_user_uuid()
+    if user_uuid is None:
+        return ['user_not_found'], 422
+    return {'unread': NotificationsActivities.unread(user_uuid)}, 200
+
+@app.route("/api/notifications/read", methods=['POST','OPTIONS'])
+@cross_origin()
+@authenticate(AUTH_REQUIRED)
+def data_notifications_read():
+    user_uuid = current_user_uuid()
+    if user_uuid is None:
+        return ['user_not_found'], 422
+    NotificationsActivities.mark_read(user_uuid)
+    return {'unread': 0}, 200
 
 # ============================================================
 # API ENDPOINTS - USER PROFILE
 # ============================================================
 @app.route("/api/activities/@<string:handle>", methods=['GET'])
-@xray_recorder.capture('user_api_call')  # Track this endpoint in X-Ray
+@capture('user_api_call')  # span around the endpoint
 def data_handle(handle):
     """Get activities for a specific user profile"""
-    model = UserActivities.run(handle)
-    if model['errors'] is not None:
-        return model['errors'], 422
-    else:
-        return model['data'], 200
+    # the profile JSON built by Postgres is cached and sent without being re-parsed
+    return cached_response(UserActivities.cache_key(handle), build=lambda: UserActivities.cached_body(handle))
 
 # ============================================================
 # API ENDPOINTS - SEARCH
@@ -426,19 +477,12 @@ def data_search():
 # ============================================================
 @app.route("/api/activities", methods=['POST','OPTIONS'])
 @cross_origin()
+@idempotent('create_activity')
+@rate_limit('create_activity')
 def data_activities():
     """Create a new activity/post"""
-    # Debug logging for troubleshooting
-    print('='*60)
-    print('🔍 /api/activities endpoint hit!')
-    print(f'   Method: {request.method}')
-    print(f'   Headers: {dict(request.headers)}')
-    print(f'   Origin: {request.headers.get("Origin")}')
-    print('='*60)
-    
     # Handle CORS preflight request
     if request.method == 'OPTIONS':
-        print('✅ Handling OPTIONS preflight request')
         return '', 204
     
     try:
@@ -447,23 +491,18 @@ def data_activities():
         message = request.json['message']
         ttl = request.json['ttl']  # Time-to-live for activity expiration
         
-        print(f'🔍 Request data - message: {message}, ttl: {ttl}')
-        
         # Create activity in database
         model = CreateActivity.run(message, user_handle, ttl)
         
         # Return response based on success/failure
         if model['errors'] is not None:
-            print(f'❌ CreateActivity returned errors: {model["errors"]}')
+            LOGGER.debug('CreateActivity returned errors: %s', model['errors'])
             return model['errors'], 422
         else:
-            print(f'✅ CreateActivity succeeded: {model["data"]}')
             return model['data'], 200
     except Exception as e:
         # Catch and log any unexpected errors
-        print(f'💥 EXCEPTION in data_activities: {e}')
-        import traceback
-        traceback.print_exc()
+        LOGGER.exception('EXCEPTION in data_activities: %s', e)
         return {'error': str(e)}, 500
 
 # ============================================================
@@ -471,60 +510,108 @@ def data_activities():
 # ============================================================
 @app.route("/api/activities/<string:activity_uuid>", methods=['GET'])
 def data_show_activity(activity_uuid):
-    """Get a single activity by UUID"""
-    data = ShowActivity.run(activity_uuid=activity_uuid)
-    return data, 200
+    """Get a single activity by UUID with a page of its reply tree"""
+    model = ShowActivity.run(
+        activity_uuid=activity_uuid,
+        after=request.args.get('after'),
+        limit=request.args.get('limit', type=int)
+    )
+    if model['errors'] is not None:
+        return model['errors'], 404 if model['errors'] == ['activity_not_found'] else 422
+    return model['data'], 200
 
 # ============================================================
 # API ENDPOINTS - REPLY TO ACTIVITY
 # ============================================================
 @app.route("/api/activities/<string:activity_uuid>/reply", methods=['POST','OPTIONS'])
 @cross_origin()
+@authenticate(AUTH_REQUIRED)
+@rate_limit('create_reply')
 def data_activities_reply(activity_uuid):
-    """Create a reply to an existing activity"""
-    user_handle  = 'chrisfenton'
+    """Create a reply, by the signed-in user, to an existing activity"""
     message = request.json['message']
-    model = CreateReply.run(message, user_handle, activity_uuid)
+    model = CreateReply.run(message, current_user_uuid(), activity_uuid)
     if model['errors'] is not None:
         return model['errors'], 422
     else:
         return model['data'], 200
     
+# ============================================================
+# API ENDPOINTS - LIKE / REPOST
+# ============================================================
+# POST likes (reposts), DELETE takes it back; both are idempotent. The
+# counts on the activity follow within COUNTERS_FLUSH_INTERVAL (lib/counters.py)
+# @authenticate comes before @rate_limit: anonymous calls get a 401 without
+# taking a token, and every bucket is the signed-in user's, never an IP's
+def react_to_activity(kind, activity_uuid):
+    model = ReactActivity.run(
+        kind=kind,
+        activity_uuid=activity_uuid,
+        user_uuid=current_user_uuid(),
+        active=request.method == 'POST'
+    )
+    if model['errors'] is not None:
+        return model['errors'], 404 if model['errors'] == ['activity_not_found'] else 422
+    return model['data'], 200
+
+@app.route("/api/activities/<string:activity_uuid>/like", methods=['POST','DELETE','OPTIONS'])
+@cross_origin()
+@authenticate(AUTH_REQUIRED)
+@rate_limit('react_activity')
+def data_activities_like(activity_uuid):
+    return react_to_activity('like', activity_uuid)
+
+@app.route("/api/activities/<string:activity_uuid>/repost", methods=['POST','DELETE','OPTIONS'])
+@cross_origin()
+@authenticate(AUTH_REQUIRED)
+@rate_limit('react_activity')
+def data_activities_repost(activity_uuid):
+    return react_to_activity('repost', activity_uuid)
+
 # ============================================================
 # API ENDPOINTS - USERS SHORT INFO
 # ============================================================    
     
 @app.route("/api/users/@<string:handle>/short", methods=['GET'])
 def data_users_short(handle):
-  data = UsersShort.run(handle)
-  return data, 200 
+  return cached_response(UsersShort.cache_key(handle), build=lambda: UsersShort.cached_body(handle))
+
+# Many cards in one request and one query:
+#   /api/users/short?handles=andrewbrown,bayko&uuids=<uuid>,<uuid>
+@app.route("/api/users/short", methods=['GET'])
+def data_users_short_many():
+  handles = request.args.get('handles', '')
+  uuids = request.args.get('uuids', '')
+  model = UsersShort.run_many(
+    handles=[handle for handle in handles.split(',') if handle],
+    uuids=[value for value in uuids.split(',') if value]
+  )
+  if model['errors'] is not None:
+    return model['errors'], 422
+  else:
+    return model['data'], 200
 
 # ============================================================
 # API ENDPOINTS - UPDATE PROFILE
 # ============================================================
 @app.route("/api/profile/update", methods=['POST','OPTIONS'])
 @cross_origin()
+@authenticate(AUTH_REQUIRED)
+@rate_limit('update_profile')
 def data_update_profile():
     """Update user profile bio and display name"""
     bio = request.json.get('bio', None)
     display_name = request.json.get('display_name', None)
-    
-    access_token = extract_access_token(request.headers)
-    try:
-        claims = cognito_jwt_token.verify(access_token)
-        cognito_user_id = claims['sub']
-        model = UpdateProfile.run(
-            cognito_user_id=cognito_user_id,
-            bio=bio,
-            display_name=display_name
-        )
-        if model['errors'] is not None:
-            return model['errors'], 422
-        else:
-            return model['data'], 200
-    except TokenVerifyError as e:
-        app.logger.debug(e)
-        return {}, 401   
+
+    model = UpdateProfile.run(
+        cognito_user_id=current_cognito_user_id(),
+        bio=bio,
+        display_name=display_name
+    )
+    if model['errors'] is not None:
+        return model['errors'], 422
+    else:
+        return model['data'], 200
 
 # ============================================================
 # APPLICATION ENTRY POINT
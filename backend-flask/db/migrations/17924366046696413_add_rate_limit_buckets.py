@@ -0,0 +1,25 @@
+from lib.db import db
+
+class AddRateLimitBucketsMigration:
+  def migrate_sql():
+    data = """
+    CREATE UNLOGGED TABLE public.rate_limit_buckets (
+      key text PRIMARY KEY,
+      tokens double precision NOT NULL,
+      allowed boolean NOT NULL,
+      updated_at TIMESTAMPTZ NOT NULL
+    );
+    """
+    return data
+
+  def rollback_sql():
+    data = """
+    DROP TABLE public.rate_limit_buckets;
+    """
+    return data
+
+  def migrate():
+    db.query_commit(AddRateLimitBucketsMigration.migrate_sql(), {})
+
+  def rollback():
+    db.query_commit(AddRateLimitBucketsMigration.rollback_sql(), {})
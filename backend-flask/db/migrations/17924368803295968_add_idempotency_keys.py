@@ -0,0 +1,29 @@
+from lib.db import db
+
+class AddIdempotencyKeysMigration:
+  def migrate_sql():
+    data = """
+    CREATE TABLE public.idempotency_keys (
+      key text PRIMARY KEY,
+      fingerprint text NOT NULL,
+      status smallint,
+      content_type text,
+      body bytea,
+      locked_until TIMESTAMPTZ NOT NULL,
+      expires_at TIMESTAMPTZ NOT NULL
+    );
+    CREATE INDEX idempotency_keys_expires_at_idx ON public.idempotency_keys (expires_at);
+    """
+    return data
+
+  def rollback_sql():
+    data = """
+    DROP TABLE public.idempotency_keys;
+    """
+    return data
+
+  def migrate():
+    db.query_commit(AddIdempotencyKeysMigration.migrate_sql(), {})
+
+  def rollback():
+    db.query_commit(AddIdempotencyKeysMigration.rollback_sql(), {})
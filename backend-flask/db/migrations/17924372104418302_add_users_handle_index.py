@@ -0,0 +1,20 @@
+from lib.db import db
+
+class AddUsersHandleIndexMigration:
+  def migrate_sql():
+    data = """
+    CREATE INDEX IF NOT EXISTS users_handle_idx ON public.users (handle);
+    """
+    return data
+
+  def rollback_sql():
+    data = """
+    DROP INDEX IF EXISTS public.users_handle_idx;
+    """
+    return data
+
+  def migrate():
+    db.query_commit(AddUsersHandleIndexMigration.migrate_sql(), {})
+
+  def rollback():
+    db.query_commit(AddUsersHandleIndexMigration.rollback_sql(), {})
@@ -0,0 +1,30 @@
+from lib.db import db
+
+class ReplyToActivityUuidMigration:
+  def migrate_sql():
+    # the integer column never held a reply (CreateReply did not persist),
+    # so there is nothing to convert
+    data = """
+    ALTER TABLE public.activities
+      ALTER COLUMN reply_to_activity_uuid TYPE uuid USING NULL,
+      ADD CONSTRAINT activities_reply_to_activity_uuid_fkey
+        FOREIGN KEY (reply_to_activity_uuid) REFERENCES public.activities (uuid) ON DELETE CASCADE;
+    CREATE INDEX activities_reply_to_activity_uuid_idx
+      ON public.activities (reply_to_activity_uuid, created_at, uuid);
+    """
+    return data
+
+  def rollback_sql():
+    data = """
+    DROP INDEX IF EXISTS public.activities_reply_to_activity_uuid_idx;
+    ALTER TABLE public.activities
+      DROP CONSTRAINT IF EXISTS activities_reply_to_activity_uuid_fkey,
+      ALTER COLUMN reply_to_activity_uuid TYPE integer USING NULL;
+    """
+    return data
+
+  def migrate():
+    db.query_commit(ReplyToActivityUuidMigration.migrate_sql(), {})
+
+  def rollback():
+    db.query_commit(ReplyToActivityUuidMigration.rollback_sql(), {})
@@ -0,0 +1,28 @@
+from lib.db import db
+
+class AddActivityReactionsMigration:
+  def migrate_sql():
+    # one row per like / repost: the record activities.likes_count and
+    # reposts_count are kept from (lib/counters.py, bin/db/recount-activities)
+    data = """
+    CREATE TABLE public.activity_reactions (
+      activity_uuid uuid NOT NULL REFERENCES public.activities (uuid) ON DELETE CASCADE,
+      kind text NOT NULL,
+      user_uuid uuid NOT NULL REFERENCES public.users (uuid) ON DELETE CASCADE,
+      created_at TIMESTAMP default current_timestamp NOT NULL,
+      PRIMARY KEY (activity_uuid, kind, user_uuid)
+    );
+    """
+    return data
+
+  def rollback_sql():
+    data = """
+    DROP TABLE public.activity_reactions;
+    """
+    return data
+
+  def migrate():
+    db.query_commit(AddActivityReactionsMigration.migrate_sql(), {})
+
+  def rollback():
+    db.query_commit(AddActivityReactionsMigration.rollback_sql(), {})
@@ -0,0 +1,40 @@
+from lib.db import db
+
+class AddNotificationsMigration:
+  def migrate_sql():
+    # notifications: one row per recipient (lib/notifications.py writes them)
+    # notification_counts: the unread counter and when the user last read
+    data = """
+    CREATE TABLE public.notifications (
+      uuid uuid DEFAULT uuid_generate_v4() PRIMARY KEY,
+      user_uuid uuid NOT NULL REFERENCES public.users (uuid) ON DELETE CASCADE,
+      kind text NOT NULL,
+      actor_uuid uuid NOT NULL REFERENCES public.users (uuid) ON DELETE CASCADE,
+      activity_uuid uuid REFERENCES public.activities (uuid) ON DELETE CASCADE,
+      reply_uuid uuid REFERENCES public.activities (uuid) ON DELETE CASCADE,
+      message_group_uuid text,
+      message text,
+      created_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+    );
+    CREATE INDEX notifications_user_uuid_created_at_idx
+      ON public.notifications (user_uuid, created_at DESC, uuid DESC);
+    CREATE TABLE public.notification_counts (
+      user_uuid uuid PRIMARY KEY REFERENCES public.users (uuid) ON DELETE CASCADE,
+      unread integer NOT NULL DEFAULT 0,
+      read_at TIMESTAMPTZ NOT NULL DEFAULT '-infinity'
+    );
+    """
+    return data
+
+  def rollback_sql():
+    data = """
+    DROP TABLE public.notification_counts;
+    DROP TABLE public.notifications;
+    """
+    return data
+
+  def migrate():
+    db.query_commit(AddNotificationsMigration.migrate_sql(), {})
+
+  def rollback():
+    db.query_commit(AddNotificationsMigration.rollback_sql(), {})
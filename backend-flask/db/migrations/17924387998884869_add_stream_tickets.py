@@ -0,0 +1,25 @@
+from lib.db import db
+
+class AddStreamTicketsMigration:
+  def migrate_sql():
+    data = """
+    CREATE TABLE public.stream_tickets (
+      ticket_hash text PRIMARY KEY,
+      user_uuid UUID NOT NULL REFERENCES public.users(uuid) ON DELETE CASCADE,
+      expires_at TIMESTAMPTZ NOT NULL
+    );
+    CREATE INDEX stream_tickets_expires_at_idx ON public.stream_tickets (expires_at);
+    """
+    return data
+
+  def rollback_sql():
+    data = """
+    DROP TABLE public.stream_tickets;
+    """
+    return data
+
+  def migrate():
+    db.query_commit(AddStreamTicketsMigration.migrate_sql(), {})
+
+  def rollback():
+    db.query_commit(AddStreamTicketsMigration.rollback_sql(), {})
@@ -0,0 +1,25 @@
+from lib.db import db
+
+class AddFeedVersionsMigration:
+  def migrate_sql():
+    data = """
+    CREATE TABLE public.feed_versions (
+      feed text PRIMARY KEY,
+      version bigint NOT NULL DEFAULT 0,
+      updated_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+    );
+    INSERT INTO public.feed_versions (feed) VALUES ('home');
+    """
+    return data
+
+  def rollback_sql():
+    data = """
+    DROP TABLE public.feed_versions;
+    """
+    return data
+
+  def migrate():
+    db.query_commit(AddFeedVersionsMigration.migrate_sql(), {})
+
+  def rollback():
+    db.query_commit(AddFeedVersionsMigration.rollback_sql(), {})
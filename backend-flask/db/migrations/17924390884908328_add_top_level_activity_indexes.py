@@ -0,0 +1,28 @@
+from lib.db import db
+
+class AddTopLevelActivityIndexesMigration:
+  def migrate_sql():
+    # the home feed and profiles list top-level activities only; replies are
+    # read through activities_reply_to_activity_uuid_idx
+    data = """
+    CREATE INDEX activities_top_level_created_at_idx
+      ON public.activities (created_at DESC)
+      WHERE reply_to_activity_uuid IS NULL;
+    CREATE INDEX activities_top_level_user_uuid_created_at_idx
+      ON public.activities (user_uuid, created_at DESC)
+      WHERE reply_to_activity_uuid IS NULL;
+    """
+    return data
+
+  def rollback_sql():
+    data = """
+    DROP INDEX IF EXISTS public.activities_top_level_user_uuid_created_at_idx;
+    DROP INDEX IF EXISTS public.activities_top_level_created_at_idx;
+    """
+    return data
+
+  def migrate():
+    db.query_commit(AddTopLevelActivityIndexesMigration.migrate_sql(), {})
+
+  def rollback():
+    db.query_commit(AddTopLevelActivityIndexesMigration.rollback_sql(), {})
@@ -0,0 +1,22 @@
+from lib.db import db
+
+class AddIdempotencyClaimTokenMigration:
+  def migrate_sql():
+    # rows claimed before this column existed can no longer be completed;
+    # their requests store nothing and a retry runs again
+    data = """
+    ALTER TABLE public.idempotency_keys ADD COLUMN claim_token text;
+    """
+    return data
+
+  def rollback_sql():
+    data = """
+    ALTER TABLE public.idempotency_keys DROP COLUMN claim_token;
+    """
+    return data
+
+  def migrate():
+    db.query_commit(AddIdempotencyClaimTokenMigration.migrate_sql(), {})
+
+  def rollback():
+    db.query_commit(AddIdempotencyClaimTokenMigration.rollback_sql(), {})
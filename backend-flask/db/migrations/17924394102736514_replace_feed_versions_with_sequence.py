@@ -0,0 +1,29 @@
+from lib.db import db
+
+class ReplaceFeedVersionsWithSequenceMigration:
+  def migrate_sql():
+    # every writer had to lock the one feed_versions row; nextval takes no
+    # row lock (db/sql/activities/home_changed.sql)
+    data = """
+    DROP TABLE IF EXISTS public.feed_versions;
+    CREATE SEQUENCE public.home_feed_seq;
+    """
+    return data
+
+  def rollback_sql():
+    data = """
+    DROP SEQUENCE IF EXISTS public.home_feed_seq;
+    CREATE TABLE public.feed_versions (
+      feed text PRIMARY KEY,
+      version bigint NOT NULL DEFAULT 0,
+      updated_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+    );
+    INSERT INTO public.feed_versions (feed) VALUES ('home');
+    """
+    return data
+
+  def migrate():
+    db.query_commit(ReplaceFeedVersionsWithSequenceMigration.migrate_sql(), {})
+
+  def rollback():
+    db.query_commit(ReplaceFeedVersionsWithSequenceMigration.rollback_sql(), {})
@@ -2,8 +2,9 @@
 CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
 
 -- forcefully drop our tables if they already exist
+-- (cascade: activity_reactions, notifications etc. reference them)
 DROP TABLE IF EXISTS public.users cascade;
-DROP TABLE IF EXISTS public.activities;
+DROP TABLE IF EXISTS public.activities cascade;
 
 CREATE TABLE public.users (
   uuid UUID DEFAULT uuid_generate_v4() PRIMARY KEY,
@@ -21,7 +22,7 @@ CREATE TABLE public.activities (
   replies_count integer DEFAULT 0,
   reposts_count integer DEFAULT 0,
   likes_count integer DEFAULT 0,
-  reply_to_activity_uuid integer,
+  reply_to_activity_uuid uuid,
   expires_at TIMESTAMP,
   created_at TIMESTAMP default current_timestamp NOT NULL
 );
@@ -12,4 +12,6 @@ SELECT
   activities.created_at
 FROM public.activities
 LEFT JOIN public.users ON users.uuid = activities.user_uuid
+-- replies show under the activity they answer (activities/show.sql)
+WHERE activities.reply_to_activity_uuid IS NULL
 ORDER BY activities.created_at DESC
\ No newline at end of file
@@ -0,0 +1 @@
+SELECT nextval('public.home_feed_seq')
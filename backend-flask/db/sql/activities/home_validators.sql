@@ -0,0 +1,7 @@
+SELECT
+  pg_sequence_last_value('public.home_feed_seq') AS version,
+  (
+    SELECT MAX(activities.created_at)
+    FROM public.activities
+    WHERE activities.reply_to_activity_uuid IS NULL
+  ) AS last_modified
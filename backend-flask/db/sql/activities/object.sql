@@ -1,11 +1,16 @@
 SELECT
   activities.uuid,
+  activities.user_uuid,
   users.display_name,
   users.handle,
   activities.message,
+  activities.replies_count,
+  activities.reposts_count,
+  activities.likes_count,
+  activities.reply_to_activity_uuid,
   activities.created_at,
   activities.expires_at
 FROM public.activities
 INNER JOIN public.users ON users.uuid = activities.user_uuid 
 WHERE 
-  activities.uuid = %(uuid)s
\ No newline at end of file
+  activities.uuid = %(uuid)s
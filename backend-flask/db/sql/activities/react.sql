@@ -0,0 +1,18 @@
+WITH target AS (
+  SELECT activities.uuid
+  FROM public.activities
+  WHERE activities.uuid = %(activity_uuid)s
+),
+changed AS (
+  INSERT INTO public.activity_reactions (activity_uuid, kind, user_uuid)
+  SELECT target.uuid, %(kind)s, %(user_uuid)s
+  FROM target
+  ON CONFLICT DO NOTHING
+  RETURNING activity_uuid
+)
+SELECT
+  CASE
+    WHEN NOT EXISTS (SELECT 1 FROM target) THEN 'not_found'
+    WHEN EXISTS (SELECT 1 FROM changed) THEN 'changed'
+    ELSE 'unchanged'
+  END;
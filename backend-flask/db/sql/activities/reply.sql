@@ -0,0 +1,15 @@
+INSERT INTO public.activities (
+  user_uuid,
+  message,
+  reply_to_activity_uuid,
+  expires_at
+)
+SELECT
+  users.uuid,
+  %(message)s,
+  parent.uuid,
+  parent.expires_at
+FROM public.activities parent
+JOIN public.users ON users.uuid = %(user_uuid)s
+WHERE parent.uuid = %(reply_to_activity_uuid)s
+RETURNING uuid;
@@ -0,0 +1,76 @@
+WITH RECURSIVE page AS (
+  -- direct replies after the cursor, one extra to tell whether there are more
+  SELECT
+    replies.uuid,
+    replies.created_at
+  FROM public.activities replies
+  WHERE
+    replies.reply_to_activity_uuid = %(uuid)s
+    AND (
+      %(after)s::uuid IS NULL
+      OR (replies.created_at, replies.uuid) > (
+        SELECT cursor.created_at, cursor.uuid
+        FROM public.activities cursor
+        WHERE cursor.uuid = %(after)s::uuid
+      )
+    )
+  ORDER BY replies.created_at, replies.uuid
+  LIMIT %(limit)s + 1
+),
+tree AS (
+  SELECT first_page.uuid, 1 AS depth
+  FROM (
+    SELECT page.uuid FROM page
+    ORDER BY page.created_at, page.uuid
+    LIMIT %(limit)s
+  ) first_page
+  UNION ALL
+  -- the first replies of every reply, down to %(depth)s levels
+  SELECT children.uuid, tree.depth + 1
+  FROM tree
+  CROSS JOIN LATERAL (
+    SELECT child.uuid
+    FROM public.activities child
+    WHERE child.reply_to_activity_uuid = tree.uuid
+    ORDER BY child.created_at, child.uuid
+    LIMIT %(children_limit)s
+  ) children
+  WHERE tree.depth < %(depth)s
+)
+SELECT
+  (SELECT row_to_json(activity_row) FROM (
+    SELECT
+      activities.uuid,
+      users.display_name,
+      users.handle,
+      users.cognito_user_id,
+      activities.message,
+      activities.replies_count,
+      activities.reposts_count,
+      activities.likes_count,
+      activities.reply_to_activity_uuid,
+      activities.expires_at,
+      activities.created_at
+    FROM public.activities
+    INNER JOIN public.users ON users.uuid = activities.user_uuid
+    WHERE activities.uuid = %(uuid)s
+  ) activity_row) AS activity,
+  (SELECT COALESCE(json_agg(reply_row ORDER BY reply_row.depth, reply_row.created_at, reply_row.uuid), '[]'::json) FROM (
+    SELECT
+      activities.uuid,
+      users.display_name,
+      users.handle,
+      users.cognito_user_id,
+      activities.message,
+      activities.replies_count,
+      activities.reposts_count,
+      activities.likes_count,
+      activities.reply_to_activity_uuid,
+      activities.expires_at,
+      activities.created_at,
+      tree.depth
+    FROM tree
+    INNER JOIN public.activities ON activities.uuid = tree.uuid
+    INNER JOIN public.users ON users.uuid = activities.user_uuid
+  ) reply_row) AS replies,
+  (SELECT count(*) > %(limit)s FROM page) AS more
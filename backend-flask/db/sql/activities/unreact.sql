@@ -0,0 +1,19 @@
+WITH target AS (
+  SELECT activities.uuid
+  FROM public.activities
+  WHERE activities.uuid = %(activity_uuid)s
+),
+changed AS (
+  DELETE FROM public.activity_reactions
+  WHERE
+    activity_reactions.activity_uuid = %(activity_uuid)s
+    AND activity_reactions.kind = %(kind)s
+    AND activity_reactions.user_uuid = %(user_uuid)s
+  RETURNING activity_uuid
+)
+SELECT
+  CASE
+    WHEN NOT EXISTS (SELECT 1 FROM target) THEN 'not_found'
+    WHEN EXISTS (SELECT 1 FROM changed) THEN 'changed'
+    ELSE 'unchanged'
+  END;
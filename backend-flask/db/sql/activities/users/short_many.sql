@@ -0,0 +1,8 @@
+SELECT
+  users.uuid,
+  users.handle,
+  users.display_name
+FROM public.users
+WHERE
+  users.handle = ANY(%(handles)s::text[])
+  OR users.uuid = ANY(%(uuids)s::uuid[])
@@ -0,0 +1,35 @@
+SELECT
+  (SELECT COALESCE(json_agg(notification_row ORDER BY notification_row.created_at DESC, notification_row.uuid DESC), '[]'::json) FROM (
+    SELECT
+      notifications.uuid,
+      notifications.kind,
+      actors.uuid AS actor_uuid,
+      actors.display_name,
+      actors.handle,
+      notifications.activity_uuid,
+      notifications.reply_uuid,
+      notifications.message_group_uuid,
+      COALESCE(replies.message, activities.message, notifications.message) AS message,
+      notifications.created_at,
+      notifications.created_at > COALESCE(counts.read_at, '-infinity') AS unread
+    FROM public.notifications
+    INNER JOIN public.users actors ON actors.uuid = notifications.actor_uuid
+    LEFT JOIN public.activities ON activities.uuid = notifications.activity_uuid
+    LEFT JOIN public.activities replies ON replies.uuid = notifications.reply_uuid
+    LEFT JOIN public.notification_counts counts ON counts.user_uuid = notifications.user_uuid
+    WHERE
+      notifications.user_uuid = %(user_uuid)s
+      AND (
+        %(before)s::uuid IS NULL
+        OR (notifications.created_at, notifications.uuid) < (
+          SELECT cursor.created_at, cursor.uuid
+          FROM public.notifications cursor
+          WHERE cursor.uuid = %(before)s::uuid AND cursor.user_uuid = %(user_uuid)s
+        )
+      )
+    ORDER BY notifications.created_at DESC, notifications.uuid DESC
+    LIMIT %(limit)s
+  ) notification_row) AS notifications,
+  (SELECT COALESCE(
+    (SELECT counts.unread FROM public.notification_counts counts WHERE counts.user_uuid = %(user_uuid)s),
+  0)) AS unread
@@ -0,0 +1,4 @@
+INSERT INTO public.notification_counts AS counts (user_uuid, unread, read_at)
+VALUES (%(user_uuid)s, 0, clock_timestamp())
+ON CONFLICT (user_uuid) DO UPDATE SET unread = 0, read_at = clock_timestamp()
+RETURNING counts.unread;
@@ -0,0 +1,3 @@
+SELECT COALESCE(
+  (SELECT counts.unread FROM public.notification_counts counts WHERE counts.user_uuid = %(user_uuid)s),
+0)
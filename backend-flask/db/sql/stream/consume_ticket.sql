@@ -0,0 +1,4 @@
+DELETE FROM public.stream_tickets
+WHERE ticket_hash = %(ticket_hash)s
+  AND expires_at >= clock_timestamp()
+RETURNING user_uuid;
@@ -0,0 +1,11 @@
+WITH expired AS (
+  DELETE FROM public.stream_tickets
+  WHERE expires_at < clock_timestamp()
+)
+INSERT INTO public.stream_tickets (ticket_hash, user_uuid, expires_at)
+VALUES (
+  %(ticket_hash)s,
+  %(user_uuid)s,
+  clock_timestamp() + make_interval(secs => %(ttl)s)
+)
+RETURNING ticket_hash;
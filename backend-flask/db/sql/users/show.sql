@@ -21,11 +21,13 @@ SELECT
           activities.created_at
         FROM public.activities
         WHERE activities.user_uuid = users.uuid
+          AND activities.reply_to_activity_uuid IS NULL
         ORDER BY activities.created_at DESC
         LIMIT 40
       ) array_row) AS activities,
       (SELECT count(true) FROM public.activities
-       WHERE activities.user_uuid = users.uuid) AS cruds_count
+       WHERE activities.user_uuid = users.uuid
+         AND activities.reply_to_activity_uuid IS NULL) AS cruds_count
     FROM public.users
     WHERE users.handle = %(handle)s
   ) object_row) AS profile
\ No newline at end of file
@@ -0,0 +1,43 @@
+import gc
+import os
+
+# gunicorn settings used by bin/docker/entrypoint-prod (command line flags
+# there still win). Only the fork handling, the metrics snapshot
+# directory (lib/metrics.py) and the final counter and notification flushes
+# (lib/counters.py, lib/notifications.py) live here.
+#
+# GUNICORN_PRELOAD=1 imports app.py once in the master before forking the
+# workers (--preload). The workers then share the imported code and data
+# copy-on-write instead of each importing it, which cuts per-worker memory
+# and worker boot time. It is safe because nothing owning a socket or thread
+# is created at import: see lib/process.py for what is deferred to post_fork.
+# Code changes then need a full restart (a HUP does not reload the app).
+
+preload_app = os.getenv('GUNICORN_PRELOAD', '0') == '1'
+
+def on_starting(server):
+  # metrics snapshots of an earlier run must not be summed into this one
+  import lib.metrics
+  lib.metrics.clear_dir()
+
+def when_ready(server):
+  if preload_app:
+    # move everything imported so far out of the collector's generations so
+    # a collection in a worker does not touch (and copy) the shared pages
+    gc.freeze()
+
+def post_fork(server, worker):
+  if preload_app:
+    import lib.process
+    lib.process.worker_started()
+
+def worker_exit(server, worker):
+  # write the like/repost/reply counts this worker still buffers (lib/counters.py)
+  import lib.counters
+  lib.counters.flush()
+  # and the notifications it still queues (lib/notifications.py)
+  import lib.notifications
+  lib.notifications.flush()
+  # keep what this worker counted since its last snapshot (lib/metrics.py)
+  import lib.metrics
+  lib.metrics.write_snapshot()
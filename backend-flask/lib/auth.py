@@ -0,0 +1,107 @@
+import collections
+import threading
+from functools import wraps
+from flask import current_app, g, request
+
+from lib.cognito_jwt_token import extract_access_token, TokenVerifyError
+from lib.log import get_logger
+
+LOGGER = get_logger(__name__)
+
+# Request-scoped authentication.
+#
+#   @app.route("/api/message_groups")
+#   @authenticate(AUTH_REQUIRED)
+#   def data_message_groups():
+#       model = MessageGroups.run(cognito_user_id=current_cognito_user_id(),
+#                                 my_user_uuid=current_user_uuid())
+#
+# The token is verified at most once per request and the claims live on
+# flask.g, never on the shared CognitoJwtToken instance, so concurrent
+# requests cannot see each other's claims. The users.uuid for the token's
+# sub is resolved on first use and memoized for the rest of the request
+# (and in a small process-wide map, since it never changes).
+#
+# Modes:
+#   AUTH_REQUIRED - 401 unless a valid token was sent
+#   AUTH_OPTIONAL - anonymous requests pass with no claims
+#   AUTH_NONE     - the token is not even looked at
+
+AUTH_REQUIRED = 'required'
+AUTH_OPTIONAL = 'optional'
+AUTH_NONE = 'none'
+
+USER_UUID_CACHE_SIZE = 10000
+_user_uuids = collections.OrderedDict()
+_user_uuids_lock = threading.Lock()
+
+def init_app(app, cognito_jwt_token):
+  app.extensions['cognito_jwt_token'] = cognito_jwt_token
+
+def verify_request():
+  """
+  Verifies the request's token once; later calls return the memoized result.
+  Returns the claims or None for an anonymous/invalid token.
+  """
+  if 'auth_verified' in g:
+    return g.claims
+  g.auth_verified = True
+  g.claims = None
+  g.auth_error = None
+  token = extract_access_token(request.headers)
+  if token:
+    try:
+      g.claims = current_app.extensions['cognito_jwt_token'].verify(token)
+    except TokenVerifyError as e:
+      g.auth_error = e
+      # the error class only: messages from the JWT library can quote the token
+      LOGGER.debug('token rejected: %s', error_class(e))
+  return g.claims
+
+def error_class(e):
+  cause = e.__cause__
+  return f"{type(e).__name__} ({type(cause).__name__})" if cause is not None else type(e).__name__
+
+def current_claims():
+  return g.get('claims')
+
+def current_cognito_user_id():
+  claims = current_claims()
+  return claims['sub'] if claims else None
+
+def current_user_uuid():
+  if 'user_uuid' in g:
+    return g.user_uuid
+  cognito_user_id = current_cognito_user_id()
+  g.user_uuid = lookup_user_uuid(cognito_user_id) if cognito_user_id else None
+  return g.user_uuid
+
+def lookup_user_uuid(cognito_user_id):
+  with _user_uuids_lock:
+    user_uuid = _user_uuids.get(cognito_user_id)
+  if user_uuid is not None:
+    return user_uuid
+
+  from lib.db import db
+  sql = db.template('activities/users','uuid_from_cognito_user_id')
+  user_uuid = db.query_value(sql,{
+    'cognito_user_id': cognito_user_id
+  })
+  if user_uuid is not None:
+    with _user_uuids_lock:
+      _user_uuids[cognito_user_id] = user_uuid
+      if len(_user_uuids) > USER_UUID_CACHE_SIZE:
+        _user_uuids.popitem(last=False)
+  return user_uuid
+
+def authenticate(mode=AUTH_REQUIRED):
+  def decorator(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+      if mode != AUTH_NONE and request.method != 'OPTIONS':
+        claims = verify_request()
+        if claims is None and mode == AUTH_REQUIRED:
+          return {}, 401
+      return fn(*args, **kwargs)
+    return wrapper
+  return decorator
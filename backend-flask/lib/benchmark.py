@@ -0,0 +1,81 @@
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import time
+
+# Small timing helpers shared by the scripts in bin/bench.
+# Every benchmark reports the same shape so results from different commits
+# can be diffed:  {'name', 'iterations', 'ops_per_sec', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms'}
+
+def percentile(sorted_samples, pct):
+  if not sorted_samples:
+    return 0.0
+  index = min(len(sorted_samples) - 1, max(0, int(round(pct / 100.0 * len(sorted_samples))) - 1))
+  return sorted_samples[index]
+
+def summarize(name, samples, elapsed):
+  ordered = sorted(samples)
+  return {
+    'name': name,
+    'iterations': len(samples),
+    'ops_per_sec': round(len(samples) / elapsed, 1) if elapsed > 0 else 0.0,
+    'p50_ms': round(percentile(ordered, 50) * 1000, 4),
+    'p95_ms': round(percentile(ordered, 95) * 1000, 4),
+    'p99_ms': round(percentile(ordered, 99) * 1000, 4),
+    'max_ms': round(ordered[-1] * 1000, 4) if ordered else 0.0
+  }
+
+def measure(name, fn, iterations, warmup=10, quiet=True):
+  """
+  Calls fn(i) `iterations` times and returns the summary dict.
+  quiet=True swallows anything the code under test prints so the
+  terminal stays readable (the cost of formatting it is still measured).
+  """
+  sink = io.StringIO() if quiet else None
+  with (contextlib.redirect_stdout(sink) if quiet else contextlib.nullcontext()):
+    for i in range(warmup):
+      fn(i)
+    samples = []
+    started = time.perf_counter()
+    for i in range(iterations):
+      t0 = time.perf_counter()
+      fn(i)
+      samples.append(time.perf_counter() - t0)
+      if sink is not None and sink.tell() > 1_000_000:
+        sink.seek(0)
+        sink.truncate()
+    elapsed = time.perf_counter() - started
+  return summarize(name, samples, elapsed)
+
+def print_table(results):
+  print(f"{'benchmark':<40}{'ops/s':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+  for r in results:
+    print(f"{r['name']:<40}{r['ops_per_sec']:>12}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}")
+
+def git_revision():
+  try:
+    return subprocess.check_output(
+      ['git', 'rev-parse', '--short', 'HEAD'],
+      stderr=subprocess.DEVNULL, text=True
+    ).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def write_results(path, suite, results, params=None):
+  report = {
+    'suite': suite,
+    'revision': git_revision(),
+    'python': platform.python_version(),
+    'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    'params': params or {},
+    'results': results
+  }
+  directory = os.path.dirname(path)
+  if directory:
+    os.makedirs(directory, exist_ok=True)
+  with open(path, 'w') as f:
+    json.dump(report, f, indent=2)
+  print(f"results written to {path}")
@@ -0,0 +1,327 @@
+import collections
+import os
+import threading
+import time
+from flask import current_app, make_response
+
+from lib.conditional import is_fresh, set_validators
+from lib.json_provider import dumps_bytes, json_body
+from lib.log import get_logger
+import lib.compress
+import lib.metrics
+import lib.pubsub
+
+LOGGER = get_logger(__name__)
+
+# Response cache for public read endpoints.
+#
+#   return cached_response(UsersShort.cache_key(handle),
+#     build=lambda: UsersShort.cached_body(handle))
+#
+#   lib.cache.invalidate(HomeActivities.cache_key())   # after a write
+#
+#   entries = cached_entries(keys, build_many=...)      # many small pieces
+#                                                       # built in one query
+#
+# build() returns (body, etag, last_modified). The body is serialized once,
+# when it is stored (JSON text from Postgres is kept as is), and compressed
+# once per encoding there too (lib/compress.py); every hit sends those bytes.
+# The stored validators still answer If-None-Match / If-Modified-Since with
+# a 304.
+#
+# An entry is fresh for RESPONSE_CACHE_TTL seconds. For RESPONSE_CACHE_STALE_TTL
+# seconds after that it is still served while one background thread rebuilds
+# it (stale-while-revalidate), so a refresh never adds latency to a request.
+# A miss is built by one request while concurrent requests for the same key
+# wait for it instead of all querying Postgres.
+#
+# Writes invalidate the keys they affect (CreateActivity, UpdateProfile).
+# With a shared PUBSUB_BACKEND (postgres) the invalidation is broadcast so
+# every worker and task drops its copy; with the in-process backend the
+# entries of other workers expire within the TTL.
+#
+# Memory is bounded by RESPONSE_CACHE_MAX_BYTES of bodies (compressed variants
+# included), evicting the least recently used entries.
+#
+# Environment:
+#   RESPONSE_CACHE_ENABLED    0 builds every response (default 1)
+#   RESPONSE_CACHE_TTL        seconds an entry is fresh (default 5)
+#   RESPONSE_CACHE_STALE_TTL  seconds a stale entry may be served while it is
+#                             rebuilt (default 30)
+#   RESPONSE_CACHE_MAX_BYTES  total size of cached bodies (default 16 MiB)
+
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', '1') == '1'
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '5'))
+RESPONSE_CACHE_STALE_TTL = float(os.getenv('RESPONSE_CACHE_STALE_TTL', '30'))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+INVALIDATE_TOPIC = 'cache:invalidate'
+
+FRESH = 'fresh'
+STALE = 'stale'
+MISS = 'miss'
+
+class Entry:
+  __slots__ = ('body', 'variants', 'etag', 'last_modified', 'fresh_until', 'stale_until')
+
+  def __init__(self, body, etag, last_modified, fresh_until, stale_until, variants=None):
+    self.body = body
+    # encoding -> compressed body, for entries sent as a whole response
+    self.variants = variants or {}
+    self.etag = etag
+    self.last_modified = last_modified
+    self.fresh_until = fresh_until
+    self.stale_until = stale_until
+
+  def size(self):
+    return len(self.body) + sum(len(v) for v in self.variants.values())
+
+class Build:
+  """A build in progress; invalidated if its key is dropped before it is stored."""
+  __slots__ = ('done', 'invalidated')
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.invalidated = False
+
+def make_entry(built, ttl, stale_ttl, now, compressed=False):
+  """compressed=True also compresses the body for every encoding (cached_response)."""
+  body, etag, last_modified = built
+  if isinstance(body, str):
+    body = body.encode('utf-8')
+  elif not isinstance(body, bytes):
+    body = dumps_bytes(body)
+  variants = lib.compress.compress_all(body) if compressed else None
+  return Entry(body, etag, last_modified, now + ttl, now + ttl + stale_ttl, variants)
+
+class ResponseCache:
+  BUILD_WAIT = 10  # seconds a request waits for another request's build
+
+  def __init__(self, max_bytes=RESPONSE_CACHE_MAX_BYTES, ttl=RESPONSE_CACHE_TTL,
+               stale_ttl=RESPONSE_CACHE_STALE_TTL, clock=time.monotonic):
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    self.stale_ttl = stale_ttl
+    self.clock = clock
+    self.reset()
+    os.register_at_fork(after_in_child=self.reset)
+
+  def reset(self):
+    # also run in a forked worker: its own entries, locks and listener
+    self.entries = collections.OrderedDict()
+    self.size = 0
+    self.building = {}  # key -> Build
+    self.lock = threading.Lock()
+    self.listener = None
+    self.counts = collections.Counter()
+
+  def fetch(self, key, build, ttl=None, stale_ttl=None):
+    """Returns (entry, FRESH|STALE|MISS)."""
+    ttl = self.ttl if ttl is None else ttl
+    stale_ttl = self.stale_ttl if stale_ttl is None else stale_ttl
+    with self.lock:
+      now = self.clock()
+      entry = self.entries.get(key)
+      if entry is not None and now < entry.stale_until:
+        self.entries.move_to_end(key)
+        if now < entry.fresh_until:
+          self.counts['hits'] += 1
+          return entry, FRESH
+        self.counts['stale_hits'] += 1
+        if key not in self.building:
+          self.start_refresh(key, build, ttl, stale_ttl)
+        return entry, STALE
+      self.counts['misses'] += 1
+      pending = self.building.get(key)
+      owner = pending is None
+      if owner:
+        pending = self.building[key] = Build()
+
+    if not owner:
+      # another request is building it: wait for that instead of querying too
+      pending.done.wait(self.BUILD_WAIT)
+      with self.lock:
+        entry = self.entries.get(key)
+      if entry is not None:
+        return entry, MISS
+      # that build failed or was invalidated meanwhile
+      return make_entry(build(), ttl, stale_ttl, self.clock(), compressed=True), MISS
+
+    try:
+      entry = make_entry(build(), ttl, stale_ttl, self.clock(), compressed=True)
+      self.store(key, entry, pending)
+      return entry, MISS
+    finally:
+      self.finish(key, pending)
+
+  def fetch_many(self, keys, build_many, ttl=None, stale_ttl=None):
+    """
+    {key: entry} for many keys at once. The keys that are not fresh (stale
+    ones included) are built together with one build_many(missing_keys) call,
+    which returns {key: (body, etag, last_modified)} for every key it was given.
+    Nothing waits for a build another request has in progress; those keys are
+    built here too, just not stored.
+    """
+    ttl = self.ttl if ttl is None else ttl
+    stale_ttl = self.stale_ttl if stale_ttl is None else stale_ttl
+    found = {}
+    missing = []
+    pending = {}
+    with self.lock:
+      now = self.clock()
+      for key in keys:
+        entry = self.entries.get(key)
+        if entry is not None and now < entry.fresh_until:
+          self.entries.move_to_end(key)
+          self.counts['hits'] += 1
+          found[key] = entry
+        else:
+          self.counts['misses'] += 1
+          missing.append(key)
+          if key not in self.building:
+            pending[key] = self.building[key] = Build()
+    if not missing:
+      return found
+
+    try:
+      built = build_many(missing)
+      now = self.clock()
+      for key in missing:
+        entry = make_entry(built[key], ttl, stale_ttl, now)
+        if key in pending:
+          self.store(key, entry, pending[key])
+        found[key] = entry
+      return found
+    finally:
+      for key, build in pending.items():
+        self.finish(key, build)
+
+  def start_refresh(self, key, build, ttl, stale_ttl):
+    # called with the lock held
+    pending = self.building[key] = Build()
+    app = current_app._get_current_object()
+    def refresh():
+      try:
+        with app.app_context():
+          entry = make_entry(build(), ttl, stale_ttl, self.clock(), compressed=True)
+        self.store(key, entry, pending)
+      except Exception as e:
+        LOGGER.warning("cache refresh of %s failed: %s", key, e)
+      finally:
+        self.finish(key, pending)
+    threading.Thread(target=refresh, name='cache-refresh', daemon=True).start()
+
+  def finish(self, key, pending):
+    with self.lock:
+      if self.building.get(key) is pending:
+        del self.building[key]
+    pending.done.set()
+
+  def store(self, key, entry, pending):
+    size = entry.size()
+    if size > self.max_bytes // 8:
+      return
+    with self.lock:
+      if pending.invalidated:
+        # built from data read before the write that invalidated it
+        return
+      old = self.entries.pop(key, None)
+      if old is not None:
+        self.size -= old.size()
+      self.entries[key] = entry
+      self.size += size
+      while self.size > self.max_bytes:
+        _, evicted = self.entries.popitem(last=False)
+        self.size -= evicted.size()
+        self.counts['evictions'] += 1
+
+  def drop(self, keys):
+    with self.lock:
+      for key in keys:
+        # later requests must not wait for a build that read old data
+        pending = self.building.pop(key, None)
+        if pending is not None:
+          pending.invalidated = True
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+          self.size -= entry.size()
+          self.counts['invalidations'] += 1
+
+  def clear(self):
+    with self.lock:
+      for pending in self.building.values():
+        pending.invalidated = True
+      self.building.clear()
+      self.entries.clear()
+      self.size = 0
+
+  def ensure_listener(self):
+    if lib.pubsub.PUBSUB_BACKEND == 'memory' or self.listener is not None:
+      return
+    with self.lock:
+      if self.listener is None:
+        self.listener = threading.Thread(target=self.listen, name='cache-invalidation', daemon=True)
+        self.listener.start()
+
+  def listen(self):
+    while True:
+      subscription = lib.pubsub.broker().subscribe([INVALIDATE_TOPIC])
+      try:
+        while True:
+          event = subscription.get(timeout=60)
+          if event is not None:
+            self.drop(event['keys'])
+      except lib.pubsub.Overflow:
+        # missed invalidations: nothing cached can be trusted any more
+        self.clear()
+      finally:
+        lib.pubsub.broker().unsubscribe(subscription)
+
+  def stats(self):
+    with self.lock:
+      stats = dict(self.counts)
+      stats['entries'] = len(self.entries)
+      stats['bytes'] = self.size
+    return stats
+
+cache = ResponseCache()
+
+def invalidate(*keys):
+  cache.drop(keys)
+  if lib.pubsub.PUBSUB_BACKEND != 'memory':
+    lib.pubsub.publish(INVALIDATE_TOPIC, {'keys': list(keys)})
+
+def cached_response(key, build, ttl=None, stale_ttl=None):
+  """A 200 (or 304) response for key, built with build() only when not cached."""
+  if RESPONSE_CACHE_ENABLED:
+    cache.ensure_listener()
+    entry, state = cache.fetch(key, build, ttl, stale_ttl)
+  else:
+    # nothing is reused, so leave compressing to lib.compress as usual
+    entry, state = make_entry(build(), 0, 0, 0), MISS
+  if is_fresh(entry.etag, entry.last_modified):
+    response = make_response('', 304)
+  else:
+    response = json_body(entry.body)
+    if entry.variants:
+      lib.compress.send_variant(response, entry.variants)
+  set_validators(response, entry.etag, entry.last_modified)
+  response.headers['X-Cache'] = state
+  return response
+
+def cached_entries(keys, build_many, ttl=None, stale_ttl=None):
+  """
+  {key: Entry} for endpoints that assemble one response from many cached
+  pieces (UsersShort.run_many); see ResponseCache.fetch_many.
+  """
+  if not RESPONSE_CACHE_ENABLED:
+    built = build_many(list(keys))
+    return {key: make_entry(built[key], 0, 0, 0) for key in keys}
+  cache.ensure_listener()
+  return cache.fetch_many(keys, build_many, ttl, stale_ttl)
+
+def stats():
+  return cache.stats()
+
+lib.metrics.register_stats('response_cache', stats,
+  counters=('hits', 'stale_hits', 'misses', 'evictions', 'invalidations'),
+  gauges=('entries', 'bytes'))
@@ -1,9 +1,18 @@
+import collections
+import hashlib
+import json
+import os
+import threading
 import time
-import requests
 from jose import jwk, jwt
 from jose.exceptions import JOSEError
 from jose.utils import base64url_decode
 
+from lib.log import get_logger
+from lib.process import on_worker_start
+
+LOGGER = get_logger(__name__)
+
 class FlaskAWSCognitoError(Exception):
   pass
 
@@ -17,28 +26,223 @@ def extract_access_token(request_headers):
         _, access_token = auth_header.split()
     return access_token
 
+class JwksStore:
+    """
+    Cognito's public keys, keyed by kid.
+
+    - lookups are a dict hit
+    - an unknown kid (Cognito rotated its keys) triggers a refresh, at most
+      once per min_refresh_interval and only one fetch at a time
+    - after ttl seconds the keys are refreshed in a background thread so the
+      request that notices never waits on the network
+    - a failed fetch keeps the last known good set
+    - the first load can run in the background; lookups made before it
+      finishes wait at most startup_wait seconds for it
+    """
+    def __init__(self, fetch, ttl=None, min_refresh_interval=None, startup_wait=None):
+        self.fetch = fetch
+        self.ttl = ttl if ttl is not None else int(os.getenv("JWKS_TTL", "3600"))
+        self.min_refresh_interval = min_refresh_interval if min_refresh_interval is not None \
+            else int(os.getenv("JWKS_MIN_REFRESH_INTERVAL", "30"))
+        self.startup_wait = startup_wait if startup_wait is not None \
+            else float(os.getenv("JWKS_STARTUP_WAIT", "5"))
+        self.loaded = threading.Event()
+        self.keys = {}
+        # kid -> jose key object, so jwk.construct runs once per key, not per request
+        self.public_keys = {}
+        self.loaded_at = None
+        self.last_attempt_at = None
+        self.refresh_lock = threading.Lock()
+        self.background_load = False
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # a refresh the parent had in flight never finishes in the child (and
+        # may have held the lock); keys it already loaded are kept
+        self.refresh_lock = threading.Lock()
+        if not self.loaded.is_set() and self.background_load:
+            self.start_background_load()
+
+    def refresh(self):
+        """Fetch now. Returns True if a new key set was installed."""
+        with self.refresh_lock:
+            return self._refresh_locked()
+
+    def _refresh_locked(self):
+        self.last_attempt_at = time.monotonic()
+        try:
+            keys = self.fetch()
+        except Exception as e:
+            if not self.keys:
+                raise FlaskAWSCognitoError(str(e)) from e
+            LOGGER.warning("JWKS refresh failed, keeping %d known keys: %s", len(self.keys), e)
+            return False
+        # swap in a new dict; readers never see a half-built one
+        self.keys = {key["kid"]: key for key in keys}
+        self.public_keys = {}
+        self.loaded_at = time.monotonic()
+        self.loaded.set()
+        return True
+
+    def _refresh_for_unknown_kid(self, kid):
+        attempt_started = time.monotonic()
+        with self.refresh_lock:
+            # single flight: someone else may have refreshed while we waited
+            if kid in self.keys:
+                return
+            last = self.last_attempt_at
+            if last is not None and last >= attempt_started:
+                return
+            # rate limit: forged/garbage kids must not hammer Cognito
+            if last is not None and attempt_started - last < self.min_refresh_interval:
+                return
+            try:
+                self._refresh_locked()
+            except FlaskAWSCognitoError as e:
+                LOGGER.warning("JWKS refresh for unknown kid %s failed: %s", kid, e)
+
+    def _refresh_in_background(self):
+        if self.refresh_lock.locked():
+            return
+        last = self.last_attempt_at
+        if last is not None and time.monotonic() - last < self.min_refresh_interval:
+            return
+        self.last_attempt_at = time.monotonic()
+        threading.Thread(target=self._background_refresh, name="jwks-refresh", daemon=True).start()
+
+    def start_background_load(self):
+        self.background_load = True
+        self.last_attempt_at = time.monotonic()
+        threading.Thread(target=self._background_refresh, name="jwks-load", daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except FlaskAWSCognitoError as e:
+            LOGGER.warning("JWKS background refresh failed: %s", e)
+
+    def check_stale(self):
+        """
+        Starts a background refresh once the keys are older than ttl. Never
+        waits; every lookup calls it, cached or not, so a key Cognito
+        stopped publishing is dropped within ttl (+ min_refresh_interval).
+        """
+        if self.loaded_at is not None and time.monotonic() - self.loaded_at > self.ttl:
+            self._refresh_in_background()
+
+    def get(self, kid):
+        if not self.loaded.is_set():
+            self.loaded.wait(self.startup_wait)
+        self.check_stale()
+        key = self.keys.get(kid)
+        if key is None:
+            self._refresh_for_unknown_kid(kid)
+            key = self.keys.get(kid)
+        return key
+
+    def public_key(self, kid):
+        self.check_stale()
+        public_key = self.public_keys.get(kid)
+        if public_key is not None:
+            return public_key
+        pkey_data = self.get(kid)
+        if pkey_data is None:
+            return None
+        try:
+            public_key = jwk.construct(pkey_data)
+        except JOSEError as e:
+            raise TokenVerifyError(str(e)) from e
+        self.public_keys[kid] = public_key
+        return public_key
+
+class VerifiedTokenCache:
+    """
+    Bounded LRU of tokens whose signature already verified, keyed by the
+    token's sha256 digest. Clients resend the same access token until it
+    expires, so a hit skips the RSA verification. Expiry and audience are
+    still checked by the caller on every hit.
+    """
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize if maxsize is not None else int(os.getenv("JWT_CACHE_SIZE", "10000"))
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def get(self, digest):
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is not None:
+                self.entries.move_to_end(digest)
+            return entry
+
+    def put(self, digest, kid, claims):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries[digest] = (kid, claims)
+            self.entries.move_to_end(digest)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def discard(self, digest):
+        with self.lock:
+            self.entries.pop(digest, None)
+
 class CognitoJwtToken:
-    def __init__(self, user_pool_id, user_pool_client_id, region, request_client=None):
+    """
+    Verifies Cognito access/id tokens.
+
+    JWKS loading never blocks construction: keys are fetched in a background
+    thread and the first verify() waits at most JWKS_STARTUP_WAIT seconds for
+    them. Set AWS_COGNITO_JWKS_FILE (or pass jwks_file) to read the keys from
+    a local jwks.json instead - used by tests, load tests and air-gapped
+    environments together with the tokens minted by lib/local_jwt.py.
+    """
+    def __init__(self, user_pool_id, user_pool_client_id, region, request_client=None, jwks_file=None):
         self.region = region
         if not self.region:
             raise FlaskAWSCognitoError("No AWS region provided")
         self.user_pool_id = user_pool_id
         self.user_pool_client_id = user_pool_client_id
-        self.claims = None
-        if not request_client:
-            self.request_client = requests.get
+        # None: requests.get, imported on first fetch (off the startup path)
+        self.request_client = request_client
+        self.jwks_file = jwks_file or os.getenv("AWS_COGNITO_JWKS_FILE")
+        self.jwks = JwksStore(self._fetch_jwk_keys)
+        self.verified_tokens = VerifiedTokenCache()
+        if self.jwks_file:
+            # local file: cheap and must fail loudly if it is wrong
+            self._load_jwk_keys()
         else:
-            self.request_client = request_client
-        self._load_jwk_keys()
+            # with gunicorn --preload this runs in each worker (lib/process.py)
+            on_worker_start(self.jwks.start_background_load)
 
+    @property
+    def jwk_keys(self):
+        return list(self.jwks.keys.values())
 
-    def _load_jwk_keys(self):
+    def _fetch_jwk_keys(self):
+        if self.jwks_file:
+            with open(self.jwks_file) as f:
+                return json.load(f)["keys"]
         keys_url = f"https://cognito-idp.{self.region}.amazonaws.com/{self.user_pool_id}/.well-known/jwks.json"
-        try:
-            response = self.request_client(keys_url)
-            self.jwk_keys = response.json()["keys"]
-        except requests.exceptions.RequestException as e:
-            raise FlaskAWSCognitoError(str(e)) from e
+        request_client = self.request_client
+        if request_client is None:
+            import requests
+            request_client = requests.get
+        response = request_client(keys_url)
+        if hasattr(response, "raise_for_status"):
+            response.raise_for_status()
+        return response.json()["keys"]
+
+    def _load_jwk_keys(self):
+        self.jwks.refresh()
 
     @staticmethod
     def _extract_headers(token):
@@ -49,24 +253,27 @@ class CognitoJwtToken:
             raise TokenVerifyError(str(e)) from e
 
     def _find_pkey(self, headers):
-        kid = headers["kid"]
-        # search for the kid in the downloaded public keys
-        key_index = -1
-        for i in range(len(self.jwk_keys)):
-            if kid == self.jwk_keys[i]["kid"]:
-                key_index = i
-                break
-        if key_index == -1:
+        kid = headers.get("kid")
+        pkey = self.jwks.get(kid) if kid else None
+        if pkey is None:
             raise TokenVerifyError("Public key not found in jwks.json")
-        return self.jwk_keys[key_index]
+        return pkey
+
+    def _find_public_key(self, headers):
+        kid = headers.get("kid")
+        public_key = self.jwks.public_key(kid) if kid else None
+        if public_key is None:
+            raise TokenVerifyError("Public key not found in jwks.json")
+        return public_key
 
     @staticmethod
-    def _verify_signature(token, pkey_data):
-        try:
-            # construct the public key
-            public_key = jwk.construct(pkey_data)
-        except JOSEError as e:
-            raise TokenVerifyError(str(e)) from e
+    def _verify_signature(token, public_key):
+        if isinstance(public_key, dict):
+            try:
+                # construct the public key from its jwks.json entry
+                public_key = jwk.construct(public_key)
+            except JOSEError as e:
+                raise TokenVerifyError(str(e)) from e
         # get the last two sections of the token,
         # message and signature (encoded in base64)
         message, encoded_signature = str(token).rsplit(".", 1)
@@ -102,13 +309,33 @@ class CognitoJwtToken:
         if not token:
             raise TokenVerifyError("No token provided")
 
+        digest = self.verified_tokens.digest(token)
+        cached = self.verified_tokens.get(digest)
+        # a cached token is only trusted while its signing key is still
+        # published: keep the key set fresh, then look the kid up in it
+        if cached is not None:
+            self.jwks.check_stale()
+            if cached[0] not in self.jwks.keys:
+                self.verified_tokens.discard(digest)
+                cached = None
+        if cached is not None:
+            claims = cached[1]
+            try:
+                self._check_expiration(claims, current_time)
+                self._check_audience(claims)
+            except TokenVerifyError:
+                self.verified_tokens.discard(digest)
+                raise
+            return dict(claims)
+
         headers = self._extract_headers(token)
-        pkey_data = self._find_pkey(headers)
-        self._verify_signature(token, pkey_data)
+        public_key = self._find_public_key(headers)
+        self._verify_signature(token, public_key)
 
         claims = self._extract_claims(token)
         self._check_expiration(claims, current_time)
         self._check_audience(claims)
 
-        self.claims = claims 
-        return claims
\ No newline at end of file
+        self.verified_tokens.put(digest, headers["kid"], claims)
+        # callers get their own copy; nothing per-request is kept on self
+        return dict(claims)
\ No newline at end of file
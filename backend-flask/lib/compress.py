@@ -0,0 +1,88 @@
+import gzip
+import os
+from flask import request
+
+# Negotiated response compression (Accept-Encoding: br / gzip).
+#
+#   lib.compress.init_app(app)
+#
+# Only buffered 2xx responses with a compressible mimetype and a body of at
+# least COMPRESS_MIN_SIZE bytes are compressed; small bodies are not worth the
+# CPU and streamed responses (the /api/stream SSE feed) are never touched.
+# brotli is preferred when the client accepts it and the module is installed.
+#
+# Responses served from lib/cache.py are compressed once, when the entry is
+# built (compress_all), and every hit sends the stored variant
+# (send_variant); compress_response leaves anything that already has a
+# Content-Encoding alone.
+#
+# Environment:
+#   COMPRESS_MIN_SIZE      bytes (default 1024)
+#   COMPRESS_GZIP_LEVEL    1-9 (default 4; about brotli 4's cost, 6 is twice as slow)
+#   COMPRESS_BROTLI_LEVEL  0-11 (default 4; higher levels cost too much per request)
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))
+COMPRESS_GZIP_LEVEL = int(os.getenv('COMPRESS_GZIP_LEVEL', '4'))
+COMPRESS_BROTLI_LEVEL = int(os.getenv('COMPRESS_BROTLI_LEVEL', '4'))
+COMPRESS_MIMETYPES = {
+  'application/json',
+  'text/html',
+  'text/plain',
+  'text/css',
+  'application/javascript'
+}
+
+def encodings():
+  return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+def compress(body, encoding):
+  if encoding == 'br':
+    return brotli.compress(body, quality=COMPRESS_BROTLI_LEVEL)
+  return gzip.compress(body, compresslevel=COMPRESS_GZIP_LEVEL, mtime=0)
+
+def compress_all(body):
+  """{encoding: compressed body} for every encoding we offer; {} for small bodies."""
+  if len(body) < COMPRESS_MIN_SIZE:
+    return {}
+  return {encoding: compress(body, encoding) for encoding in encodings()}
+
+def send_variant(response, variants):
+  """Sends the variant of compress_all() the client accepts, if any."""
+  add_vary(response)
+  encoding = request.accept_encodings.best_match([e for e in encodings() if e in variants])
+  if encoding is None:
+    return response
+  response.set_data(variants[encoding])
+  response.headers['Content-Encoding'] = encoding
+  return response
+
+def add_vary(response):
+  vary = response.vary
+  if 'accept-encoding' not in {v.lower() for v in vary}:
+    vary.add('Accept-Encoding')
+
+def compress_response(response):
+  if (response.direct_passthrough or response.is_streamed
+      or not 200 <= response.status_code < 300
+      or response.mimetype not in COMPRESS_MIMETYPES
+      or 'Content-Encoding' in response.headers):
+    return response
+  # the representation depends on Accept-Encoding whether or not we compress
+  add_vary(response)
+  body = response.get_data()
+  if len(body) < COMPRESS_MIN_SIZE:
+    return response
+  encoding = request.accept_encodings.best_match(encodings())
+  if encoding is None:
+    return response
+  response.set_data(compress(body, encoding))
+  response.headers['Content-Encoding'] = encoding
+  return response
+
+def init_app(app):
+  app.after_request(compress_response)
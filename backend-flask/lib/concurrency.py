@@ -0,0 +1,302 @@
+import math
+import os
+import random
+import threading
+import time
+from flask import g, request
+
+import lib.metrics
+
+# Adaptive concurrency limits and load shedding.
+#
+#   lib.concurrency.init_app(app)
+#
+# Every request (except the exempt ones) takes a slot in its route group's
+# limit before any auth or database work is done for it:
+#
+#   feed       GET activities / users endpoints
+#   messaging  GET message groups / messages
+#   writes     POST/PUT/PATCH/DELETE
+#   exempt     health checks, the SSE stream (capped by services/message_stream.py),
+#              CORS preflights
+#
+# A request that finds no free slot is answered at once with 503 and
+# Retry-After instead of queueing until the load balancer times out.
+#
+# Limits adapt to latency (the gradient scheme of Envoy's adaptive concurrency
+# filter). A group starts at CONCURRENCY_INITIAL_LIMIT, the request threads
+# the limiter may use, and takes the fastest request of its first window as a
+# provisional min RTT. Every CONCURRENCY_MIN_RTT_INTERVAL seconds it briefly
+# drops to its minimum limit to measure its unloaded latency (min RTT). A
+# measurement ends after MIN_RTT_SAMPLES requests that ran at the minimum
+# limit, or once it has lasted MIN_RTT_TIMEOUT seconds or MIN_RTT_MAX_ADMISSIONS
+# requests, whichever comes first: high priority writes keep more than
+# min_limit in flight, so under steady write load the samples may never come
+# and the probe is cut short with what it has. In between, after every
+# window of requests:
+#
+#   gradient = clamp(TOLERANCE * min_rtt / window_rtt, 0.5, 2.0)
+#   limit    = limit * gradient + sqrt(limit)
+#
+# so the limit grows while requests run about as fast as unloaded and shrinks
+# as soon as they queue up behind each other (database, GIL, DynamoDB).
+#
+# Priority: the process as a whole runs at most
+# min(CONCURRENCY_MAX_INFLIGHT, sum of the group limits) requests, shared
+# unevenly so slow anonymous feed reads cannot take every worker thread:
+#   anonymous requests (no token)    PRIORITY_LOW     may use 50% of it
+#   reads with a token               PRIORITY_NORMAL  may use 75%
+#   writes with a token              PRIORITY_HIGH    may use all of it, and
+#                                                     are not held to the
+#                                                     minimum limit while
+#                                                     min RTT is measured
+#   health checks                    never limited
+# The token is not verified here (that would be the work we are shedding);
+# a bogus token buys priority for a request that then gets a cheap 401.
+#
+# Environment:
+#   CONCURRENCY_LIMIT_ENABLED     0 disables limiting (default 1)
+#   CONCURRENCY_INITIAL_LIMIT     starting limit per group (default
+#                                 CONCURRENCY_MAX_INFLIGHT)
+#   CONCURRENCY_MIN_LIMIT         (default 3)
+#   CONCURRENCY_MAX_LIMIT         per group (default 32)
+#   CONCURRENCY_MAX_INFLIGHT      per process (default 6, which leaves two of
+#                                 the 8 gunicorn threads to answer the rest)
+#   CONCURRENCY_TOLERANCE         latency over min RTT tolerated (default 1.25)
+#   CONCURRENCY_MIN_RTT_INTERVAL  seconds between min RTT measurements (default 60)
+#   LOAD_SHED_RETRY_AFTER         seconds (default 1)
+#
+# Limits are per process. gunicorn gets a few more threads than the limit
+# (bin/docker/entrypoint-prod) so excess requests reach the limiter and are
+# shed quickly instead of waiting in gunicorn's connection queue.
+
+CONCURRENCY_LIMIT_ENABLED = os.getenv('CONCURRENCY_LIMIT_ENABLED', '1') == '1'
+CONCURRENCY_MAX_INFLIGHT = int(os.getenv('CONCURRENCY_MAX_INFLIGHT', '6'))
+CONCURRENCY_INITIAL_LIMIT = int(os.getenv('CONCURRENCY_INITIAL_LIMIT', CONCURRENCY_MAX_INFLIGHT))
+CONCURRENCY_MIN_LIMIT = int(os.getenv('CONCURRENCY_MIN_LIMIT', '3'))
+CONCURRENCY_MAX_LIMIT = int(os.getenv('CONCURRENCY_MAX_LIMIT', '32'))
+CONCURRENCY_TOLERANCE = float(os.getenv('CONCURRENCY_TOLERANCE', '1.25'))
+CONCURRENCY_MIN_RTT_INTERVAL = float(os.getenv('CONCURRENCY_MIN_RTT_INTERVAL', '60'))
+LOAD_SHED_RETRY_AFTER = int(os.getenv('LOAD_SHED_RETRY_AFTER', '1'))
+
+PRIORITY_LOW = 'low'
+PRIORITY_NORMAL = 'normal'
+PRIORITY_HIGH = 'high'
+
+PRIORITY_SHARE = {
+  PRIORITY_LOW: 0.5,
+  PRIORITY_NORMAL: 0.75,
+  PRIORITY_HIGH: 1.0
+}
+
+GROUP_FEED = 'feed'
+GROUP_MESSAGING = 'messaging'
+GROUP_WRITES = 'writes'
+
+EXEMPT_RULES = {'/api/health-check', '/api/health-check/ready', '/api/stream', '/metrics'}
+WRITE_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+
+class AdaptiveLimit:
+  """
+  Gradient concurrency limit for one group of requests.
+  ticket = try_acquire() before the work (None: shed it), release(ticket, seconds) after it.
+  try_acquire(high=True) is held to the adapted limit even while min RTT is
+  being measured at min_limit.
+  """
+  WINDOW = 20                   # samples per limit update
+  MIN_RTT_SAMPLES = 10          # samples at the minimum limit per min RTT measurement
+  MIN_RTT_TIMEOUT = 5.0         # seconds a measurement may last at most
+  MIN_RTT_MAX_ADMISSIONS = 200  # requests admitted during one measurement at most
+  SMOOTHING = 0.2
+
+  def __init__(self, name, initial=None, min_limit=None, max_limit=None, tolerance=None,
+               min_rtt_interval=None, clock=time.monotonic):
+    self.name = name
+    self.min_limit = min_limit if min_limit is not None else CONCURRENCY_MIN_LIMIT
+    self.max_limit = max_limit if max_limit is not None else CONCURRENCY_MAX_LIMIT
+    self.tolerance = tolerance if tolerance is not None else CONCURRENCY_TOLERANCE
+    self.min_rtt_interval = min_rtt_interval if min_rtt_interval is not None else CONCURRENCY_MIN_RTT_INTERVAL
+    self.clock = clock
+    self.limit = float(initial if initial is not None else CONCURRENCY_INITIAL_LIMIT)
+    self.inflight = 0
+    self.samples = []
+    # until the first measurement, the fastest request of the first window
+    self.min_rtt = None
+    self.measuring = False
+    self.measuring_until = None
+    self.measured_admissions = 0
+    self.next_measurement_at = clock() + self.min_rtt_interval * random.uniform(0.9, 1.1)
+    self.accepted = 0
+    self.shed = 0
+    self.lock = threading.Lock()
+
+  def current(self, high=False):
+    return self.min_limit if self.measuring and not high else self.limit
+
+  def try_acquire(self, high=False):
+    with self.lock:
+      now = self.clock()
+      if not self.measuring and now >= self.next_measurement_at:
+        self.measuring = True
+        self.measuring_until = now + self.MIN_RTT_TIMEOUT
+        self.measured_admissions = 0
+        self.samples = []
+      elif self.measuring and (now >= self.measuring_until or
+                               self.measured_admissions >= self.MIN_RTT_MAX_ADMISSIONS):
+        self.finish_measurement()
+      if self.inflight >= max(1, int(self.current(high))):
+        self.shed += 1
+        return None
+      self.inflight += 1
+      self.accepted += 1
+      if not self.measuring:
+        return False
+      self.measured_admissions += 1
+      # only a request that ran alone (or at min_limit) says what unloaded is
+      return self.inflight <= self.min_limit
+
+  def release(self, ticket, seconds):
+    with self.lock:
+      self.inflight -= 1
+      if self.measuring:
+        if ticket:
+          self.samples.append(seconds)
+          if len(self.samples) >= self.MIN_RTT_SAMPLES:
+            self.finish_measurement()
+      else:
+        self.samples.append(seconds)
+        if len(self.samples) >= self.WINDOW:
+          self.update()
+
+  def finish_measurement(self):
+    # cut short without a single sample: keep the min RTT we had
+    if self.samples:
+      self.min_rtt = sorted(self.samples)[len(self.samples) // 2]
+    self.samples = []
+    self.measuring = False
+    # jittered so groups and workers do not all drop to min_limit at once
+    self.next_measurement_at = self.clock() + self.min_rtt_interval * random.uniform(0.9, 1.1)
+
+  def update(self):
+    window_rtt = sorted(self.samples)[len(self.samples) // 2]
+    if self.min_rtt is None:
+      # not measured yet: the fastest request so far stands in for it
+      self.min_rtt = min(self.samples)
+    self.samples = []
+    if window_rtt <= 0:
+      return
+    gradient = max(0.5, min(2.0, self.tolerance * self.min_rtt / window_rtt))
+    new_limit = self.limit * gradient + math.sqrt(self.limit)
+    new_limit = self.limit * (1 - self.SMOOTHING) + new_limit * self.SMOOTHING
+    self.limit = max(self.min_limit, min(self.max_limit, new_limit))
+
+  def snapshot(self):
+    with self.lock:
+      return {
+        'limit': round(self.current(), 2),
+        'inflight': self.inflight,
+        'min_rtt_ms': round(self.min_rtt * 1000, 2) if self.min_rtt is not None else None,
+        'measuring': self.measuring,
+        'accepted': self.accepted,
+        'shed': self.shed
+      }
+
+class ConcurrencyLimiter:
+  def __init__(self, groups=(GROUP_FEED, GROUP_MESSAGING, GROUP_WRITES), max_inflight=None):
+    self.names = tuple(groups)
+    self.max_inflight = max_inflight if max_inflight is not None else CONCURRENCY_MAX_INFLIGHT
+    self.reset()
+    os.register_at_fork(after_in_child=self.reset)
+
+  def reset(self):
+    # also run in a forked worker: it starts with empty slots and unheld locks
+    self.groups = {name: AdaptiveLimit(name) for name in self.names}
+    self.shed_by_priority = {priority: 0 for priority in PRIORITY_SHARE}
+    self.lock = threading.Lock()
+
+  def capacity(self, high=False):
+    return min(self.max_inflight, sum(limit.current(high) for limit in self.groups.values()))
+
+  def acquire(self, group, priority):
+    """Returns what release() needs, or None if the request should be shed."""
+    limit = self.groups[group]
+    high = priority == PRIORITY_HIGH
+    with self.lock:
+      busy = sum(l.inflight for l in self.groups.values())
+      ticket = None
+      if busy < max(1, int(self.capacity(high) * PRIORITY_SHARE[priority])):
+        ticket = limit.try_acquire(high)
+      if ticket is None:
+        self.shed_by_priority[priority] += 1
+        return None
+    return (limit, ticket)
+
+  def release(self, held, seconds):
+    limit, ticket = held
+    limit.release(ticket, seconds)
+
+  def stats(self):
+    stats = {name: limit.snapshot() for name, limit in self.groups.items()}
+    stats['capacity'] = round(self.capacity(), 2)
+    stats['shed_by_priority'] = dict(self.shed_by_priority)
+    return stats
+
+limiter = ConcurrencyLimiter()
+
+def classify(req):
+  """(group, priority) for the request, or None if it is never limited."""
+  if req.method == 'OPTIONS' or req.url_rule is None or req.url_rule.rule in EXEMPT_RULES:
+    return None
+  has_token = 'Authorization' in req.headers
+  if req.method in WRITE_METHODS:
+    return GROUP_WRITES, PRIORITY_HIGH if has_token else PRIORITY_LOW
+  group = GROUP_MESSAGING if req.url_rule.rule.startswith('/api/message') else GROUP_FEED
+  return group, PRIORITY_NORMAL if has_token else PRIORITY_LOW
+
+def overloaded():
+  return {'errors': ['overloaded']}, 503, {'Retry-After': str(LOAD_SHED_RETRY_AFTER)}
+
+def before_request():
+  route = classify(request)
+  if route is None:
+    return None
+  held = limiter.acquire(*route)
+  if held is None:
+    return overloaded()
+  g.concurrency_held = held
+  g.concurrency_started = time.perf_counter()
+  return None
+
+def teardown_request(exception):
+  held = g.pop('concurrency_held', None)
+  if held is not None:
+    limiter.release(held, time.perf_counter() - g.concurrency_started)
+
+def init_app(app):
+  if not CONCURRENCY_LIMIT_ENABLED:
+    return
+  app.before_request(before_request)
+  app.teardown_request(teardown_request)
+
+def stats():
+  return limiter.stats()
+
+LIMIT = lib.metrics.gauge('concurrency_limit', 'Current adaptive limit, by route group', ('group',))
+INFLIGHT = lib.metrics.gauge('concurrency_inflight', 'Requests holding a slot, by route group', ('group',))
+ACCEPTED = lib.metrics.counter('concurrency_accepted_total', 'Requests admitted, by route group', ('group',))
+SHED = lib.metrics.counter('concurrency_shed_total', 'Requests shed with 503, by route group', ('group',))
+
+@lib.metrics.collector
+def collect():
+  if not CONCURRENCY_LIMIT_ENABLED:
+    return []
+  samples = []
+  for name, limit in limiter.groups.items():
+    snapshot = limit.snapshot()
+    samples += [
+      (LIMIT, (name,), snapshot['limit']),
+      (INFLIGHT, (name,), snapshot['inflight']),
+      (ACCEPTED, (name,), snapshot['accepted']),
+      (SHED, (name,), snapshot['shed'])
+    ]
+  return samples
@@ -0,0 +1,63 @@
+import hashlib
+from datetime import datetime, timezone
+from flask import request, make_response
+
+# Conditional GET helpers (ETag / If-None-Match, Last-Modified / If-Modified-Since).
+#
+# Endpoints derive a cheap validator (a sequence the writers advance, the
+# newest created_at / sk) *before* building the payload:
+#
+#   validators = HomeActivities().validators()
+#   return conditional_response(*validators, build=lambda: (HomeActivities().run(), 200))
+#
+# If the client's copy is still current a body-less 304 is sent and build()
+# is never called.
+
+def make_etag(*parts):
+  digest = hashlib.sha1('|'.join(str(p) for p in parts).encode('utf-8')).hexdigest()
+  return digest[:32]
+
+def parse_timestamp(value):
+  """
+  Parses the timestamps we store (Postgres TIMESTAMP rendered by row_to_json,
+  DynamoDB sk isoformat strings) into an aware UTC datetime.
+  """
+  if value is None:
+    return None
+  if isinstance(value, datetime):
+    dt = value
+  else:
+    try:
+      dt = datetime.fromisoformat(value)
+    except ValueError:
+      return None
+  if dt.tzinfo is None:
+    dt = dt.replace(tzinfo=timezone.utc)
+  return dt.astimezone(timezone.utc)
+
+def is_fresh(etag, last_modified):
+  # If-None-Match wins over If-Modified-Since (RFC 9110 13.2.2)
+  if request.if_none_match:
+    return etag is not None and request.if_none_match.contains_weak(etag)
+  if request.if_modified_since and last_modified is not None:
+    # HTTP dates have one-second resolution
+    return last_modified.replace(microsecond=0) <= request.if_modified_since
+  return False
+
+def set_validators(response, etag, last_modified):
+  if etag is not None:
+    response.set_etag(etag, weak=True)
+  if last_modified is not None:
+    response.last_modified = last_modified
+  # let clients keep the body but make them revalidate on every poll
+  response.headers['Cache-Control'] = 'private, no-cache'
+  return response
+
+def conditional_response(etag, last_modified, build):
+  if is_fresh(etag, last_modified):
+    return set_validators(make_response('', 304), etag, last_modified)
+  body, status = build()
+  response = make_response(body, status)
+  if status == 200:
+    set_validators(response, etag, last_modified)
+  return response
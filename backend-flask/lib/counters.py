@@ -0,0 +1,149 @@
+import atexit
+import os
+import threading
+import time
+
+from lib.log import get_logger
+import lib.metrics
+
+LOGGER = get_logger(__name__)
+
+# Write-coalescing counters for activities.likes_count / reposts_count /
+# replies_count.
+#
+#   lib.counters.add(activity_uuid, 'likes_count', 1)    # after the event row
+#   lib.counters.add(activity_uuid, 'likes_count', -1)   # is written / deleted
+#
+# The event itself is the record: activity_reactions for likes and reposts
+# (db/migrations), the reply row for replies. The count columns are only a
+# cache of those. Requests never update an activity row; they add to a
+# per-worker buffer, and one thread per worker writes everything buffered
+# every COUNTERS_FLUSH_INTERVAL seconds as one batched UPDATE (a like storm
+# on one post is one row update per interval, not one per like).
+#
+# The counts shown can lag the events by an interval; cached feeds and
+# profiles are not invalidated for a count change and catch up within their
+# TTL. Nor does a flush move the home feed's ETag: that would change it
+# every interval under normal like traffic and end its 304s. Buffered deltas
+# are written when a worker exits (gunicorn worker_exit, atexit); a worker
+# that is killed loses at most one interval of deltas, and a failed flush
+# keeps them for the next one. bin/db/recount-activities rebuilds the exact
+# totals from the events.
+#
+# Environment:
+#   COUNTERS_FLUSH_INTERVAL  seconds between flushes (default 1)
+#   COUNTERS_FLUSH_BATCH     activities per UPDATE statement (default 500)
+
+COUNTERS_FLUSH_INTERVAL = float(os.getenv('COUNTERS_FLUSH_INTERVAL', '1'))
+COUNTERS_FLUSH_BATCH = int(os.getenv('COUNTERS_FLUSH_BATCH', '500'))
+
+COLUMNS = ('likes_count', 'reposts_count', 'replies_count')
+
+FLUSH_SQL = """
+  UPDATE public.activities SET
+    likes_count = COALESCE(activities.likes_count, 0) + deltas.likes,
+    reposts_count = COALESCE(activities.reposts_count, 0) + deltas.reposts,
+    replies_count = COALESCE(activities.replies_count, 0) + deltas.replies
+  FROM unnest(%(uuids)s::uuid[], %(likes)s::int[], %(reposts)s::int[], %(replies)s::int[])
+    AS deltas (uuid, likes, reposts, replies)
+  WHERE activities.uuid = deltas.uuid
+"""
+
+class CounterBuffer:
+  def __init__(self, interval=COUNTERS_FLUSH_INTERVAL, batch=COUNTERS_FLUSH_BATCH):
+    self.interval = interval
+    self.batch = batch
+    self.reset()
+    os.register_at_fork(after_in_child=self.reset)
+
+  def reset(self):
+    # also run in a forked worker: the parent's deltas are the parent's to write
+    self.pending = {}  # activity uuid -> [likes, reposts, replies]
+    self.lock = threading.Lock()
+    self.flush_lock = threading.Lock()
+    self.thread = None
+    self.counts = {'added': 0, 'flushes': 0, 'rows_flushed': 0, 'flush_errors': 0}
+
+  def add(self, activity_uuid, column, delta=1):
+    index = COLUMNS.index(column)
+    with self.lock:
+      deltas = self.pending.get(activity_uuid)
+      if deltas is None:
+        deltas = self.pending[activity_uuid] = [0, 0, 0]
+      deltas[index] += delta
+      self.counts['added'] += 1
+      if self.thread is None:
+        self.thread = threading.Thread(target=self.run_forever, name='counters-flush', daemon=True)
+        self.thread.start()
+
+  def flush(self):
+    with self.flush_lock:
+      with self.lock:
+        pending, self.pending = self.pending, {}
+      # always the same order, so two workers' flushes never deadlock
+      rows = sorted((uuid, deltas) for uuid, deltas in pending.items() if any(deltas))
+      if not rows:
+        return 0
+      written = 0
+      try:
+        from lib.db import db
+        with db.pool.connection() as conn:
+          for start in range(0, len(rows), self.batch):
+            chunk = rows[start:start + self.batch]
+            with conn.transaction():
+              conn.execute(FLUSH_SQL, {
+                'uuids': [uuid for uuid, _ in chunk],
+                'likes': [deltas[0] for _, deltas in chunk],
+                'reposts': [deltas[1] for _, deltas in chunk],
+                'replies': [deltas[2] for _, deltas in chunk]
+              })
+            written += len(chunk)
+      except Exception as e:
+        self.counts['flush_errors'] += 1
+        LOGGER.warning("counter flush failed, keeping %d deltas: %s", len(rows) - written, e)
+        self.merge(rows[written:])
+      self.counts['flushes'] += 1
+      self.counts['rows_flushed'] += written
+      return written
+
+  def merge(self, rows):
+    with self.lock:
+      for uuid, deltas in rows:
+        current = self.pending.setdefault(uuid, [0, 0, 0])
+        for index, delta in enumerate(deltas):
+          current[index] += delta
+
+  def run_forever(self):
+    while True:
+      time.sleep(self.interval)
+      try:
+        self.flush()
+      except Exception as e:
+        LOGGER.warning("counter flush failed: %s", e)
+
+  def stats(self):
+    with self.lock:
+      stats = dict(self.counts)
+      stats['pending'] = len(self.pending)
+    return stats
+
+buffer = CounterBuffer()
+
+def add(activity_uuid, column, delta=1):
+  buffer.add(str(activity_uuid), column, delta)
+
+def flush():
+  try:
+    return buffer.flush()
+  except Exception as e:
+    LOGGER.warning("counter flush failed: %s", e)
+    return 0
+
+def stats():
+  return buffer.stats()
+
+atexit.register(flush)
+
+lib.metrics.register_stats('activity_counters', stats,
+  counters=('added', 'flushes', 'rows_flushed', 'flush_errors'),
+  gauges=('pending',))
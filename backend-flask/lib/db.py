@@ -1,12 +1,80 @@
-from psycopg_pool import ConnectionPool
 import os
 import re
-import sys
+import logging
+import threading
+import time
+from functools import wraps
 from flask import current_app as app
 
+from lib.log import get_logger
+from lib.observability import capture
+import lib.metrics
+
+LOGGER = get_logger(__name__)
+
+# pools inherited from the parent of a fork; kept referenced so they are never
+# garbage collected (and their connections closed) in the child
+_inherited_pools = []
+
+QUERY_DURATION = lib.metrics.histogram('db_query_duration_seconds',
+  'Postgres query time (pool checkout included), by SQL template', ('template', 'kind'))
+QUERY_ERRORS = lib.metrics.counter('db_query_errors_total', 'Postgres queries that raised', ('template', 'kind'))
+
+def metered(kind):
+  # labels the query with the db/sql template it was loaded from
+  # ('inline' for SQL built in code, e.g. migrations)
+  def decorator(fn):
+    @wraps(fn)
+    def wrapper(self, sql, *args, **kwargs):
+      template = self._template_names.get(sql, 'inline')
+      started = time.perf_counter()
+      try:
+        return fn(self, sql, *args, **kwargs)
+      except Exception:
+        QUERY_ERRORS.inc(template, kind)
+        raise
+      finally:
+        QUERY_DURATION.observe(time.perf_counter() - started, template, kind)
+    return wrapper
+  return decorator
+
 class Db:
+  # the pool (and psycopg itself) is only loaded on first use, so importing
+  # lib.db costs nothing at startup; start_background_open() warms it early.
+  # The pool belongs to the process that created it: a forked child (gunicorn
+  # --preload worker) creates its own, see lib/process.py
   def __init__(self):
-    self.init_pool()
+    self._pool = None
+    self._pool_pid = None
+    self._pool_lock = threading.Lock()
+    # template text -> name, so metrics can tell the queries apart
+    self._template_names = {}
+    os.register_at_fork(after_in_child=self._after_fork)
+
+  def _after_fork(self):
+    # never use or close the parent's pool here: its sockets are the parent's
+    # server sessions and closing them would end those sessions
+    if self._pool is not None:
+      _inherited_pools.append(self._pool)
+    self._pool = None
+    self._pool_pid = None
+    self._pool_lock = threading.Lock()
+
+  @property
+  def pool(self):
+    if self._pool is None or self._pool_pid != os.getpid():
+      with self._pool_lock:
+        if self._pool is None or self._pool_pid != os.getpid():
+          self.init_pool()
+    return self._pool
+
+  def start_background_open(self):
+    def open_pool():
+      try:
+        self.pool
+      except Exception as e:
+        LOGGER.warning('Background pool open failed: %s', e)
+    threading.Thread(target=open_pool, name='db-pool-open', daemon=True).start()
 
   def template(self,*args):
     pathing = list((app.root_path,'db','sql',) + args)
@@ -14,34 +82,31 @@ class Db:
 
     template_path = os.path.join(*pathing)
 
-    green = '\033[92m'
-    no_color = '\033[0m'
-    print("\n")
-    print(f'{green} Load SQL Template: {template_path} {no_color}')
+    LOGGER.debug('Load SQL Template: %s', template_path)
 
     with open(template_path, 'r') as f:
       template_content = f.read()
+    if template_content not in self._template_names:
+      self._template_names[template_content] = '/'.join(args)
     return template_content
 
   def init_pool(self):
+    from psycopg_pool import ConnectionPool
     connection_url = os.getenv("CONNECTION_URL")
-    self.pool = ConnectionPool(connection_url)
+    self._pool = ConnectionPool(connection_url)
+    self._pool_pid = os.getpid()
   # we want to commit data such as an insert
   # be sure to check for RETURNING in all uppercases
+  # statements and params are only logged at DEBUG (they can carry user data)
   def print_params(self,params):
-    blue = '\033[94m'
-    no_color = '\033[0m'
-    print(f'{blue} SQL Params:{no_color}')
-    for key, value in params.items():
-      print(key, ":", value)
+    LOGGER.debug('SQL Params: %s', params)
 
   def print_sql(self,title,sql, params={}):
-    cyan = '\033[96m'
-    no_color = '\033[0m'
-    print(f'{cyan} SQL STATEMENT-[{title}]------{no_color}')
-    print(sql,params)
+    LOGGER.debug('SQL STATEMENT-[%s] %s %s', title, sql, params)
+  @capture('db.query_commit')
+  @metered('commit')
   def query_commit(self,sql,params={},verbose=True):
-    if verbose:
+    if verbose and LOGGER.isEnabledFor(logging.DEBUG):
       self.print_sql('commit with returning',sql,params)
 
     pattern = r"\bRETURNING\b"
@@ -52,7 +117,9 @@ class Db:
         cur =  conn.cursor()
         cur.execute(sql,params)
         if is_returning_id:
-          returning_id = cur.fetchone()[0]
+          # no row: the statement matched nothing (e.g. INSERT ... SELECT)
+          row = cur.fetchone()
+          returning_id = row[0] if row is not None else None
         conn.commit() 
         if is_returning_id:
           return returning_id
@@ -60,8 +127,10 @@ class Db:
       self.print_sql_err(err)
 
    # when we want to return a a single value
+  @capture('db.query_value')
+  @metered('value')
   def query_value(self,sql,params={},verbose=True):
-    if verbose:
+    if verbose and LOGGER.isEnabledFor(logging.DEBUG):
       self.print_sql('value',sql,params)
 
     with self.pool.connection() as conn:
@@ -71,22 +140,28 @@ class Db:
         return json[0]
 
   # when we want to return a json object
-  def query_array_json(self,sql,params={},verbose=True):
-    if verbose:
+  # raw=True returns the JSON text Postgres built, unparsed, so an endpoint
+  # can send it as the response body without decoding and re-encoding it
+  @capture('db.query_array_json')
+  @metered('array_json')
+  def query_array_json(self,sql,params={},verbose=True,raw=False):
+    if verbose and LOGGER.isEnabledFor(logging.DEBUG):
       self.print_sql('array',sql,params)
 
-    wrapped_sql = self.query_wrap_array(sql)
+    wrapped_sql = self.query_wrap_array(sql,raw)
     with self.pool.connection() as conn:
       with conn.cursor() as cur:
         cur.execute(wrapped_sql,params)
         json = cur.fetchone()
         return json[0]
   # When we want to return an array of json objects
-  def query_object_json(self,sql,params={},verbose=True):
-    if verbose:
+  @capture('db.query_object_json')
+  @metered('object_json')
+  def query_object_json(self,sql,params={},verbose=True,raw=False):
+    if verbose and LOGGER.isEnabledFor(logging.DEBUG):
       self.print_sql('json',sql,params)
       self.print_params(params)
-    wrapped_sql = self.query_wrap_object(sql)
+    wrapped_sql = self.query_wrap_object(sql,raw)
 
     with self.pool.connection() as conn:
       with conn.cursor() as cur:
@@ -96,33 +171,37 @@ class Db:
           return "{}"  # ← added return
         else:
           return json[0]
-  def query_wrap_object(self,template):
+  def query_wrap_object(self,template,raw=False):
+    cast = '::text' if raw else ''
     sql = f"""
-    (SELECT COALESCE(row_to_json(object_row),'{{}}'::json) FROM (
+    (SELECT COALESCE(row_to_json(object_row),'{{}}'::json){cast} FROM (
     {template}
     ) object_row);
     """
     return sql
-  def query_wrap_array(self,template):
+  def query_wrap_array(self,template,raw=False):
+    cast = '::text' if raw else ''
     sql = f"""
-    (SELECT COALESCE(array_to_json(array_agg(row_to_json(array_row))),'[]'::json) FROM (
+    (SELECT COALESCE(array_to_json(array_agg(row_to_json(array_row))),'[]'::json){cast} FROM (
     {template}
     ) array_row);
     """
     return sql
   def print_sql_err(self,err):
-    # get details about the exception
-    err_type, err_obj, traceback = sys.exc_info()
-
-    # get the line number when exception occured
-    line_num = traceback.tb_lineno
-
-    # print the connect() error
-    print ("\npsycopg ERROR:", err, "on line number:", line_num)
-    print ("psycopg traceback:", traceback, "-- type:", err_type)
-
-    # print the pgcode and pgerror exceptions
-    print ("pgerror:", err.pgerror)
-    print ("pgcode:", err.pgcode, "\n")
-
-db = Db()
\ No newline at end of file
+    # pgcode/pgerror only exist on psycopg errors, not e.g. pool timeouts
+    LOGGER.error('psycopg ERROR: %s pgcode: %s pgerror: %s', err,
+      getattr(err, 'pgcode', None), getattr(err, 'pgerror', None), exc_info=err)
+
+  def pool_stats(self):
+    # never opens the pool just to report on it
+    pool = self._pool
+    if pool is None or self._pool_pid != os.getpid():
+      return {}
+    return pool.get_stats()
+
+db = Db()
+
+lib.metrics.register_stats('db_pool', db.pool_stats,
+  counters=('requests_num', 'requests_queued', 'requests_wait_ms', 'requests_errors',
+            'connections_num', 'connections_errors', 'connections_lost', 'returns_bad'),
+  gauges=('pool_min', 'pool_max', 'pool_size', 'pool_available', 'requests_waiting'))
\ No newline at end of file
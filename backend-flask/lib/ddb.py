@@ -1,22 +1,145 @@
-import boto3
 import sys
 from datetime import datetime, timedelta, timezone
 import uuid
 import os
+import heapq
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import botocore.exceptions
 
+from lib.memory_ddb import MemoryDdb
+from lib.log import get_logger
+from lib.observability import capture
+import lib.metrics
+
+LOGGER = get_logger(__name__)
+
+# ------------------------------------------------------------------
+# Call metrics
+# ------------------------------------------------------------------
+# Ddb.client() hands out the client wrapped in MeteredClient, which times
+# every data call and asks DynamoDB for the capacity it consumed
+# (ReturnConsumedCapacity=TOTAL unless the caller chose otherwise).
+CALL_DURATION = lib.metrics.histogram('ddb_call_duration_seconds', 'DynamoDB call time, by operation', ('operation',))
+CALL_ERRORS = lib.metrics.counter('ddb_call_errors_total', 'DynamoDB calls that failed, by error code', ('operation', 'code'))
+CONSUMED_CAPACITY = lib.metrics.counter('ddb_consumed_capacity_units_total',
+  'DynamoDB capacity units consumed, by operation and table', ('operation', 'table'))
+METERED_OPERATIONS = {
+  'get_item', 'put_item', 'update_item', 'delete_item', 'query', 'scan',
+  'batch_get_item', 'batch_write_item', 'transact_get_items', 'transact_write_items'
+}
+
+class MeteredClient:
+  def __init__(self, client):
+    self._client = client
+
+  def __getattr__(self, name):
+    attr = getattr(self._client, name)
+    if name not in METERED_OPERATIONS:
+      return attr
+    def call(**kwargs):
+      kwargs.setdefault('ReturnConsumedCapacity', 'TOTAL')
+      started = time.perf_counter()
+      try:
+        response = attr(**kwargs)
+      except botocore.exceptions.ClientError as e:
+        CALL_ERRORS.inc(name, e.response.get('Error', {}).get('Code', 'Unknown'))
+        raise
+      finally:
+        CALL_DURATION.observe(time.perf_counter() - started, name)
+      consumed = response.get('ConsumedCapacity')
+      # a dict for single table calls, a list (one per table) for batches
+      for capacity in (consumed if isinstance(consumed, list) else [consumed] if consumed else []):
+        CONSUMED_CAPACITY.inc(name, capacity.get('TableName', ''), n=capacity.get('CapacityUnits', 0))
+      return response
+    return call
+
+# ------------------------------------------------------------------
+# Write sharding for hot conversations
+# ------------------------------------------------------------------
+# A group's messages normally live under one partition: MSG#<group>.
+# A sharded group spreads them over N partitions:
+#   shard 0   -> MSG#<group>        (the original key, so old data stays put)
+#   shard i>0 -> MSG#<group>#<i>
+# The shard count is stored in a metadata item (MSGMETA#<group>, 'shards').
+# Groups without that item are unsharded (N = 1) so existing data keeps
+# working unchanged, and raising N later (bin/ddb/shard-group) never moves
+# data: readers always include shard 0.
+#
+# Each worker caches a group's shard count for DDB_SHARD_COUNT_TTL seconds
+# (default 10). After bin/ddb/shard-group raises it, a worker that already
+# sees the new count may write to a shard that a worker still holding the
+# old count does not read yet, so for up to that long a reader can miss the
+# newest messages of a just-resharded group. Nothing is lost: they show up on
+# the next read after the cached count expires.
+MESSAGE_SHARDS = int(os.getenv('DDB_MESSAGE_SHARDS', '1'))
+SHARD_COUNT_TTL = float(os.getenv('DDB_SHARD_COUNT_TTL', '10'))
+SHARD_COUNT_CACHE_MAX = 10000
+SCATTER_WORKERS = 8
+_shard_counts = {}
+_shard_counts_lock = threading.Lock()
+_scatter_pool = None
+_scatter_pool_lock = threading.Lock()
+
+# boto3 clients are thread safe and expensive to build (endpoint and model
+# loading), so one per (endpoint, region) is shared by a process's threads.
+# Clients, like the scatter thread pool, belong to the process that created
+# them: their HTTP connection pools must not cross a fork.
+_clients = {}
+_clients_lock = threading.Lock()
+
+def _after_fork():
+  global _clients_lock, _shard_counts_lock, _scatter_pool, _scatter_pool_lock
+  _clients.clear()
+  _clients_lock = threading.Lock()
+  _shard_counts_lock = threading.Lock()
+  # the parent's executor threads do not exist here
+  _scatter_pool = None
+  _scatter_pool_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+def scatter_pool():
+  # created on first use by one thread only; two racing requests must not
+  # each start (and one leak) a set of executor threads
+  global _scatter_pool
+  if _scatter_pool is None:
+    with _scatter_pool_lock:
+      if _scatter_pool is None:
+        _scatter_pool = ThreadPoolExecutor(max_workers=SCATTER_WORKERS, thread_name_prefix='ddb-scatter')
+  return _scatter_pool
+
 class Ddb:
   @staticmethod
   def client():
     endpoint_url = os.getenv("AWS_ENDPOINT_URL")
+    # AWS_ENDPOINT_URL=memory:// swaps in the in-process stand-in (lib/memory_ddb.py)
+    if endpoint_url == 'memory://':
+      shared = MemoryDdb.shared()
+      metered = _clients.get(endpoint_url)
+      if metered is None or metered._client is not shared:
+        metered = _clients[endpoint_url] = MeteredClient(shared)
+      return metered
     if endpoint_url:
       attrs = { 'endpoint_url': endpoint_url }
     else:
       attrs = {}
     attrs['region_name'] = os.getenv('AWS_DEFAULT_REGION') or os.getenv('AWS_REGION', 'us-east-1')
-    dynamodb = boto3.client('dynamodb',**attrs)
+    key = (endpoint_url, attrs['region_name'])
+    dynamodb = _clients.get(key)
+    if dynamodb is None:
+      with _clients_lock:
+        dynamodb = _clients.get(key)
+        if dynamodb is None:
+          # deferred: boto3 is ~200ms of import time most workers never need
+          import boto3
+          dynamodb = MeteredClient(boto3.client('dynamodb',**attrs))
+          _clients[key] = dynamodb
     return dynamodb
   @staticmethod
+  @capture('ddb.list_message_groups')
   def list_message_groups(client,my_user_uuid):
     year = str(datetime.now().year)
     table_name = 'cruddur-messages'
@@ -30,8 +153,7 @@ class Ddb:
         ':pkey': {'S': f"GRP#{my_user_uuid}"}
       }
     }
-    print('query-params:',query_params)
-    print(query_params)
+    LOGGER.debug('query-params: %s', query_params)
     # query the table
     response = client.query(**query_params)
     items = response['Items']
@@ -49,22 +171,113 @@ class Ddb:
       })
     return results
   @staticmethod
-  def list_messages(client,message_group_uuid):
+  def latest_sk(client, pk, year):
+    response = client.query(
+      TableName='cruddur-messages',
+      KeyConditionExpression='pk = :pkey AND begins_with(sk,:year)',
+      ScanIndexForward=False,
+      Limit=1,
+      ProjectionExpression='sk',
+      ExpressionAttributeValues={
+        ':year': {'S': year},
+        ':pkey': {'S': pk}
+      }
+    )
+    items = response['Items']
+    return items[0]['sk']['S'] if items else None
+  @staticmethod
+  def latest_message_group_at(client, my_user_uuid):
     year = str(datetime.now().year)
-    table_name = 'cruddur-messages'
+    return Ddb.latest_sk(client, f"GRP#{my_user_uuid}", year)
+  @staticmethod
+  def latest_message_at(client, message_group_uuid):
+    year = str(datetime.now().year)
+    shards = Ddb.shard_count(client, message_group_uuid)
+    latest = [
+      Ddb.latest_sk(client, Ddb.message_pk(message_group_uuid, shard), year)
+      for shard in range(shards)
+    ]
+    latest = [sk for sk in latest if sk is not None]
+    return max(latest) if latest else None
+  @staticmethod
+  def message_pk(message_group_uuid, shard=0):
+    if shard == 0:
+      return f"MSG#{message_group_uuid}"
+    return f"MSG#{message_group_uuid}#{shard}"
+
+  @staticmethod
+  def shard_count(client, message_group_uuid):
+    now = time.monotonic()
+    cached = _shard_counts.get(message_group_uuid)
+    if cached and cached[1] > now:
+      return cached[0]
+
+    response = client.get_item(
+      TableName='cruddur-messages',
+      Key={
+        'pk': {'S': f"MSGMETA#{message_group_uuid}"},
+        'sk': {'S': 'shards'}
+      }
+    )
+    item = response.get('Item')
+    shards = int(item['shards']['N']) if item else 1
+
+    with _shard_counts_lock:
+      if len(_shard_counts) >= SHARD_COUNT_CACHE_MAX:
+        _shard_counts.clear()
+      _shard_counts[message_group_uuid] = (shards, now + SHARD_COUNT_TTL)
+    return shards
+
+  @staticmethod
+  def set_shard_count(client, message_group_uuid, shards):
+    client.put_item(
+      TableName='cruddur-messages',
+      Item=Ddb.shard_count_record(message_group_uuid, shards)
+    )
+    with _shard_counts_lock:
+      _shard_counts.pop(message_group_uuid, None)
+
+  @staticmethod
+  def shard_count_record(message_group_uuid, shards):
+    return {
+      'pk': {'S': f"MSGMETA#{message_group_uuid}"},
+      'sk': {'S': 'shards'},
+      'shards': {'N': str(shards)}
+    }
+
+  @staticmethod
+  def query_message_shard(client, message_group_uuid, shard, year, limit):
     query_params = {
-      'TableName': table_name,
+      'TableName': 'cruddur-messages',
       'KeyConditionExpression': 'pk = :pkey AND begins_with(sk,:year)',
       'ScanIndexForward': False,
-      'Limit': 20,
+      'Limit': limit,
       'ExpressionAttributeValues': {
         ':year': {'S': year },
-        ':pkey': {'S': f"MSG#{message_group_uuid}"}
+        ':pkey': {'S': Ddb.message_pk(message_group_uuid, shard)}
       }
     }
-
     response = client.query(**query_params)
-    items = response['Items']
+    return response['Items']
+
+  @staticmethod
+  @capture('ddb.list_messages')
+  def list_messages(client,message_group_uuid):
+    year = str(datetime.now().year)
+    limit = 20
+    shards = Ddb.shard_count(client, message_group_uuid)
+
+    if shards == 1:
+      items = Ddb.query_message_shard(client, message_group_uuid, 0, year, limit)
+    else:
+      # scatter: newest page from every shard, gather: merge on sk (newest first)
+      pages = list(scatter_pool().map(
+        lambda shard: Ddb.query_message_shard(client, message_group_uuid, shard, year, limit),
+        range(shards)
+      ))
+      merged = heapq.merge(*pages, key=lambda item: item['sk']['S'], reverse=True)
+      items = [item for _, item in zip(range(limit), merged)]
+
     items.reverse()
     results = []
     for item in items:
@@ -78,13 +291,30 @@ class Ddb:
       })
     return results
   @staticmethod
+  def message_group_user_uuids(client, message_group_uuid):
+    # each participant owns one GRP#<user_uuid> record for the group
+    response = client.query(
+      TableName='cruddur-messages',
+      IndexName='message-group-sk-index',
+      KeyConditionExpression='message_group_uuid = :message_group_uuid',
+      ProjectionExpression='pk',
+      ExpressionAttributeValues={
+        ':message_group_uuid': {'S': message_group_uuid}
+      }
+    )
+    return list({item['pk']['S'].replace('GRP#', '', 1) for item in response['Items']})
+  @staticmethod
+  @capture('ddb.create_message')
   def create_message(client,message_group_uuid, message, my_user_uuid, my_user_display_name, my_user_handle):
     now = datetime.now(timezone.utc).isoformat()
     created_at = now
     message_uuid = str(uuid.uuid4())
 
+    shards = Ddb.shard_count(client, message_group_uuid)
+    shard = random.randrange(shards) if shards > 1 else 0
+
     record = {
-      'pk':   {'S': f"MSG#{message_group_uuid}"},
+      'pk':   {'S': Ddb.message_pk(message_group_uuid, shard)},
       'sk':   {'S': created_at },
       'message': {'S': message},
       'message_uuid': {'S': message_uuid},
@@ -98,8 +328,7 @@ class Ddb:
       TableName=table_name,
       Item=record
     )
-    # print the response
-    print(response)
+    LOGGER.debug('create_message response: %s', response)
     return {
       'message_group_uuid': message_group_uuid,
       'uuid': my_user_uuid,
@@ -109,8 +338,8 @@ class Ddb:
       'created_at': created_at
     }
   @staticmethod
-  def create_message_group(client, message,my_user_uuid, my_user_display_name, my_user_handle, other_user_uuid, other_user_display_name, other_user_handle):
-    print('== create_message_group.1')
+  @capture('ddb.create_message_group')
+  def create_message_group(client, message,my_user_uuid, my_user_display_name, my_user_handle, other_user_uuid, other_user_display_name, other_user_handle, shards=None):
     table_name = 'cruddur-messages'
 
     message_group_uuid = str(uuid.uuid4())
@@ -118,7 +347,6 @@ class Ddb:
     now = datetime.now(timezone.utc).isoformat()
     last_message_at = now
     created_at = now
-    print('== create_message_group.2')
 
     my_message_group = {
       'pk': {'S': f"GRP#{my_user_uuid}"},
@@ -130,7 +358,6 @@ class Ddb:
       'user_handle':  {'S': other_user_handle}
     }
 
-    print('== create_message_group.3')
     other_message_group = {
       'pk': {'S': f"GRP#{other_user_uuid}"},
       'sk': {'S': last_message_at},
@@ -141,9 +368,12 @@ class Ddb:
       'user_handle':  {'S': my_user_handle}
     }
 
-    print('== create_message_group.4')
+    if shards is None:
+      shards = MESSAGE_SHARDS
+    shard = random.randrange(shards) if shards > 1 else 0
+
     message = {
-      'pk':   {'S': f"MSG#{message_group_uuid}"},
+      'pk':   {'S': Ddb.message_pk(message_group_uuid, shard)},
       'sk':   {'S': created_at },
       'message': {'S': message},
       'message_uuid': {'S': message_uuid},
@@ -159,14 +389,19 @@ class Ddb:
         {'PutRequest': {'Item': message}}
       ]
     }
+    if shards > 1:
+      items[table_name].append({'PutRequest': {'Item': Ddb.shard_count_record(message_group_uuid, shards)}})
 
     try:
-      print('== create_message_group.try')
       # Begin the transaction
       response = client.batch_write_item(RequestItems=items)
+      # only a count that was actually stored may be cached: a failed or
+      # partial write must leave readers asking DynamoDB
+      if not response.get('UnprocessedItems'):
+        with _shard_counts_lock:
+          _shard_counts[message_group_uuid] = (shards, time.monotonic() + SHARD_COUNT_TTL)
       return {
         'message_group_uuid': message_group_uuid
       }
     except botocore.exceptions.ClientError as e:
-      print('== create_message_group.error')
-      print(e)
\ No newline at end of file
+      LOGGER.error('create_message_group failed: %s', e)
\ No newline at end of file
@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+
+from lib.log import get_logger
+import lib.metrics
+from lib.process import on_worker_start
+
+LOGGER = get_logger(__name__)
+
+# Liveness vs readiness.
+#
+#   /api/health-check        liveness: the process answers (ECS container
+#                            health check, bin/flask/health-check). Never
+#                            looks at a dependency, so a database outage does
+#                            not get every task killed and restarted.
+#   /api/health-check/ready  readiness: this worker can serve requests (the
+#                            ALB target group health check). 200 while every
+#                            required check passes, 503 otherwise.
+#
+#   lib.health.init_app(cognito_jwt_token)
+#   ready, body = lib.health.readiness.status()
+#
+# The checks run in one background thread per worker every READINESS_INTERVAL
+# seconds; the endpoint only returns the last result, so however often the
+# load balancer probes, the database sees one SELECT 1 per interval per
+# worker. Checks:
+#
+#   postgres  a pooled connection answers SELECT 1 within READINESS_TIMEOUT
+#   dynamodb  a get_item on cruddur-messages (a key that never exists)
+#   jwks      Cognito signing keys are loaded; keys older than JWKS_TTL are
+#             refreshed in the background and reported 'stale' (tokens still
+#             verify with them), no keys at all is 'failed'
+#
+# A worker whose checks have not run yet, or whose last run is older than
+# three intervals (the checker is stuck on a hung dependency), is not ready.
+#
+# Environment:
+#   READINESS_CHECKS    checks that must pass (default postgres,dynamodb,jwks);
+#                       the others are still run and reported
+#   READINESS_INTERVAL  seconds between runs (default 10)
+#   READINESS_TIMEOUT   seconds for the Postgres pool checkout (default 2)
+
+READINESS_CHECKS = [name.strip() for name in os.getenv('READINESS_CHECKS', 'postgres,dynamodb,jwks').split(',') if name.strip()]
+READINESS_INTERVAL = float(os.getenv('READINESS_INTERVAL', '10'))
+READINESS_TIMEOUT = float(os.getenv('READINESS_TIMEOUT', '2'))
+STALE_AFTER = 3  # intervals
+
+OK = 'ok'
+STALE = 'stale'
+FAILED = 'failed'
+
+def check_postgres():
+  from lib.db import db
+  with db.pool.connection(timeout=READINESS_TIMEOUT) as conn:
+    conn.execute('SELECT 1').fetchone()
+  return OK, None
+
+def check_dynamodb():
+  from lib.ddb import Ddb
+  Ddb.client().get_item(
+    TableName='cruddur-messages',
+    Key={'pk': {'S': 'HEALTH#ready'}, 'sk': {'S': 'ready'}},
+    ProjectionExpression='pk'
+  )
+  return OK, None
+
+class Readiness:
+  def __init__(self):
+    self.checks = {
+      'postgres': check_postgres,
+      'dynamodb': check_dynamodb
+    }
+    self.reset()
+    os.register_at_fork(after_in_child=self.reset)
+
+  def reset(self):
+    # also run in a forked worker: it checks (and reports) for itself
+    self.results = {}
+    self.checked_at = None
+    self.thread = None
+    self.lock = threading.Lock()
+
+  def add_check(self, name, fn):
+    self.checks[name] = fn
+
+  def run_checks(self):
+    results = {}
+    for name, fn in self.checks.items():
+      started = time.perf_counter()
+      try:
+        status, detail = fn()
+      except Exception as e:
+        status, detail = FAILED, f"{type(e).__name__}: {e}"
+      result = {'status': status, 'ms': round((time.perf_counter() - started) * 1000, 1)}
+      if detail is not None:
+        result['detail'] = detail
+      if status == FAILED and self.results.get(name, {}).get('status') != FAILED:
+        LOGGER.warning("readiness check %s failed: %s", name, detail)
+      results[name] = result
+    self.results = results
+    self.checked_at = time.monotonic()
+
+  def run_forever(self):
+    while True:
+      try:
+        self.run_checks()
+      except Exception as e:
+        LOGGER.warning("readiness checks failed to run: %s", e)
+      time.sleep(READINESS_INTERVAL)
+
+  def start(self):
+    with self.lock:
+      if self.thread is None:
+        self.thread = threading.Thread(target=self.run_forever, name='readiness', daemon=True)
+        self.thread.start()
+
+  def status(self):
+    """(ready, body) from the last run; never runs a check itself."""
+    results, checked_at = self.results, self.checked_at
+    if checked_at is None:
+      return False, {'ready': False, 'reason': 'starting', 'checks': {}}
+    age = time.monotonic() - checked_at
+    if age > READINESS_INTERVAL * STALE_AFTER:
+      return False, {'ready': False, 'reason': 'checks_stale', 'age_s': round(age, 1), 'checks': results}
+    ready = all(results.get(name, {}).get('status') != FAILED for name in READINESS_CHECKS)
+    return ready, {'ready': ready, 'age_s': round(age, 1), 'checks': results}
+
+readiness = Readiness()
+
+def jwks_check(cognito_jwt_token):
+  def check_jwks():
+    jwks = cognito_jwt_token.jwks
+    if not jwks.keys:
+      if not cognito_jwt_token.jwks_file:
+        jwks._refresh_in_background()
+      return FAILED, 'no signing keys loaded'
+    age = time.monotonic() - jwks.loaded_at
+    if age > jwks.ttl:
+      if not cognito_jwt_token.jwks_file:
+        jwks._refresh_in_background()
+      return STALE, f"keys loaded {int(age)}s ago"
+    return OK, None
+  return check_jwks
+
+CHECK_OK = lib.metrics.gauge('readiness_check_ok', '1 when the readiness check passed on its last run', ('check',))
+READY = lib.metrics.gauge('ready_workers', 'Workers reporting ready')
+
+@lib.metrics.collector
+def collect():
+  samples = [(CHECK_OK, (name,), int(result['status'] != FAILED)) for name, result in readiness.results.items()]
+  samples.append((READY, (), int(readiness.status()[0])))
+  return samples
+
+def init_app(cognito_jwt_token):
+  readiness.add_check('jwks', jwks_check(cognito_jwt_token))
+  on_worker_start(readiness.start)
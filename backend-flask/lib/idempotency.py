@@ -0,0 +1,359 @@
+import collections
+import hashlib
+import os
+import secrets
+import threading
+import time
+from functools import wraps
+from flask import current_app, make_response, request
+
+from lib.auth import verify_request
+from lib.log import get_logger
+import lib.metrics
+from lib.ratelimit import client_ip
+
+LOGGER = get_logger(__name__)
+
+# Idempotency-Key support for create endpoints.
+#
+#   @app.route("/api/messages", methods=['POST','OPTIONS'])
+#   @cross_origin()
+#   @authenticate(AUTH_REQUIRED)
+#   @idempotent('create_message')
+#   @rate_limit('create_message')
+#   def data_create_message(): ...
+#
+# A request carrying an Idempotency-Key header claims that key (scoped to
+# the route and the verified user, or the client IP when anonymous) before
+# the endpoint runs, and the endpoint's response is stored under it for
+# IDEMPOTENCY_TTL seconds. A retry with the same key then gets the stored
+# response back (Idempotent-Replayed: true) without writing anything again:
+#
+#   same key, same body, original finished     -> stored response replayed
+#   same key, same body, original still running -> 409 + Retry-After
+#   same key, different body                   -> 422 (the key was reused)
+#
+# Responses worth retrying (401, 408, 409, 429, 5xx) are not stored: the key
+# is released so the retry runs the endpoint. A claim whose request died
+# without finishing expires after IDEMPOTENCY_LOCK_TIMEOUT seconds. Every
+# claim carries a random claim token, and only the holder of the current
+# claim may complete or release it: a request that outlived its lock and
+# was taken over cannot overwrite (or delete) the new owner's record.
+# Requests without the header behave exactly as before. Placed outside
+# @rate_limit so a replay does not use up a token.
+#
+# Backends (IDEMPOTENCY_BACKEND):
+#   memory   - in the process (default); a retry is only recognized by the
+#              worker that served the original
+#   postgres - the idempotency_keys table (db/migrations); claimed with an
+#              INSERT .. ON CONFLICT that only takes over expired rows
+#   dynamodb - IDEM#<key> items in cruddur-messages, claimed with a
+#              conditional put_item (attribute_not_exists(pk) OR expired)
+# If the store fails the request runs without idempotency (fail open).
+#
+# Environment:
+#   IDEMPOTENCY_BACKEND       memory | postgres | dynamodb (default memory)
+#   IDEMPOTENCY_TTL           seconds a response is replayed (default 86400)
+#   IDEMPOTENCY_LOCK_TIMEOUT  seconds an unfinished claim blocks retries (default 60)
+
+IDEMPOTENCY_BACKEND = os.getenv('IDEMPOTENCY_BACKEND', 'memory')
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', '86400'))
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv('IDEMPOTENCY_LOCK_TIMEOUT', '60'))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+RETRYABLE_STATUSES = {401, 408, 409, 429}
+
+OUTCOMES = lib.metrics.counter('idempotency_requests_total',
+  'Requests carrying an Idempotency-Key, by endpoint and outcome', ('name', 'outcome'))
+
+class Record:
+  """A claimed key: status is None while the original request is running."""
+  __slots__ = ('fingerprint', 'status', 'content_type', 'body')
+
+  def __init__(self, fingerprint, status=None, content_type=None, body=None):
+    self.fingerprint = fingerprint
+    self.status = status
+    self.content_type = content_type
+    self.body = body
+
+class MemoryStore:
+  def __init__(self):
+    self.records = collections.OrderedDict()  # key -> (record, locked_until, expires_at, claim_token)
+    self.lock = threading.Lock()
+
+  def prune(self, now):
+    # insertion order is expiry order (every record gets the same TTL)
+    while self.records:
+      key, (_, _, expires_at, _) = next(iter(self.records.items()))
+      if expires_at > now:
+        break
+      del self.records[key]
+
+  def claim(self, key, fingerprint, claim_token):
+    """None if the key is now ours (under claim_token), else the existing Record."""
+    now = time.time()
+    with self.lock:
+      self.prune(now)
+      existing = self.records.get(key)
+      if existing is not None:
+        record, locked_until, _, _ = existing
+        if record.status is not None or locked_until > now:
+          return record
+        del self.records[key]
+      self.records[key] = (Record(fingerprint), now + IDEMPOTENCY_LOCK_TIMEOUT, now + IDEMPOTENCY_TTL, claim_token)
+    return None
+
+  def complete(self, key, claim_token, fingerprint, status, content_type, body):
+    with self.lock:
+      existing = self.records.get(key)
+      if existing is not None and existing[3] == claim_token and existing[0].status is None:
+        self.records[key] = (Record(fingerprint, status, content_type, body), 0, existing[2], claim_token)
+
+  def release(self, key, claim_token):
+    with self.lock:
+      existing = self.records.get(key)
+      if existing is not None and existing[3] == claim_token and existing[0].status is None:
+        del self.records[key]
+
+class PostgresStore:
+  # only an expired row or a claim whose request died may be taken over
+  CLAIM_SQL = """
+    INSERT INTO public.idempotency_keys AS idem (key, fingerprint, claim_token, locked_until, expires_at)
+    VALUES (%(key)s, %(fingerprint)s, %(claim_token)s, now() + %(lock_timeout)s * interval '1 second',
+      now() + %(ttl)s * interval '1 second')
+    ON CONFLICT (key) DO UPDATE SET
+      fingerprint = EXCLUDED.fingerprint,
+      claim_token = EXCLUDED.claim_token,
+      status = NULL,
+      content_type = NULL,
+      body = NULL,
+      locked_until = EXCLUDED.locked_until,
+      expires_at = EXCLUDED.expires_at
+    WHERE idem.expires_at < now()
+       OR (idem.status IS NULL AND idem.locked_until < now())
+    RETURNING idem.key
+  """
+  PRUNE_EVERY = 1000
+
+  def __init__(self):
+    self.calls = 0
+
+  def claim(self, key, fingerprint, claim_token):
+    from lib.db import db
+    self.calls += 1
+    with db.pool.connection() as conn:
+      claimed = conn.execute(self.CLAIM_SQL, {
+        'key': key,
+        'fingerprint': fingerprint,
+        'claim_token': claim_token,
+        'lock_timeout': IDEMPOTENCY_LOCK_TIMEOUT,
+        'ttl': IDEMPOTENCY_TTL
+      }).fetchone()
+      if self.calls % self.PRUNE_EVERY == 0:
+        conn.execute("DELETE FROM public.idempotency_keys WHERE expires_at < now()")
+      if claimed is not None:
+        return None
+      row = conn.execute("""
+        SELECT fingerprint, status, content_type, body
+        FROM public.idempotency_keys
+        WHERE key = %(key)s
+      """, {'key': key}).fetchone()
+    if row is None:
+      # released between the two statements; the client may simply retry
+      return Record(fingerprint)
+    return Record(row[0], row[1], row[2], bytes(row[3]) if row[3] is not None else None)
+
+  def complete(self, key, claim_token, fingerprint, status, content_type, body):
+    from lib.db import db
+    with db.pool.connection() as conn:
+      conn.execute("""
+        UPDATE public.idempotency_keys
+        SET status = %(status)s, content_type = %(content_type)s, body = %(body)s
+        WHERE key = %(key)s AND claim_token = %(claim_token)s AND status IS NULL
+      """, {
+        'key': key,
+        'claim_token': claim_token,
+        'status': status,
+        'content_type': content_type,
+        'body': body
+      })
+
+  def release(self, key, claim_token):
+    from lib.db import db
+    with db.pool.connection() as conn:
+      conn.execute("""
+        DELETE FROM public.idempotency_keys
+        WHERE key = %(key)s AND claim_token = %(claim_token)s AND status IS NULL
+      """, {'key': key, 'claim_token': claim_token})
+
+class DynamoDBStore:
+  TABLE_NAME = 'cruddur-messages'
+
+  def item_key(self, key):
+    return {'pk': {'S': f"IDEM#{key}"}, 'sk': {'S': 'response'}}
+
+  def claim(self, key, fingerprint, claim_token):
+    from lib.ddb import Ddb
+    import botocore.exceptions
+    client = Ddb.client()
+    now = int(time.time())
+    item = self.item_key(key)
+    item.update({
+      'fingerprint': {'S': fingerprint},
+      'claim_token': {'S': claim_token},
+      'locked_until': {'N': str(now + IDEMPOTENCY_LOCK_TIMEOUT)},
+      # epoch seconds, usable as the table's TTL attribute
+      'expires_at': {'N': str(now + IDEMPOTENCY_TTL)}
+    })
+    try:
+      client.put_item(
+        TableName=self.TABLE_NAME,
+        Item=item,
+        # completed items have no locked_until, so only a dead claim matches it
+        ConditionExpression='attribute_not_exists(pk) OR expires_at < :now OR locked_until < :now',
+        ExpressionAttributeValues={':now': {'N': str(now)}}
+      )
+      return None
+    except botocore.exceptions.ClientError as e:
+      if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+        raise
+    existing = client.get_item(TableName=self.TABLE_NAME, Key=self.item_key(key), ConsistentRead=True).get('Item')
+    if existing is None:
+      return Record(fingerprint)
+    return Record(
+      existing['fingerprint']['S'],
+      int(existing['status']['N']) if 'status' in existing else None,
+      existing['content_type']['S'] if 'content_type' in existing else None,
+      existing['body']['B'] if 'body' in existing else None
+    )
+
+  def complete(self, key, claim_token, fingerprint, status, content_type, body):
+    from lib.ddb import Ddb
+    import botocore.exceptions
+    item = self.item_key(key)
+    item.update({
+      'fingerprint': {'S': fingerprint},
+      'claim_token': {'S': claim_token},
+      'status': {'N': str(status)},
+      'content_type': {'S': content_type or 'application/json'},
+      'body': {'B': body},
+      'expires_at': {'N': str(int(time.time()) + IDEMPOTENCY_TTL)}
+    })
+    try:
+      Ddb.client().put_item(
+        TableName=self.TABLE_NAME,
+        Item=item,
+        # still our claim: not taken over after our lock ran out, not completed
+        ConditionExpression='claim_token = :claim_token AND attribute_not_exists(#status)',
+        ExpressionAttributeNames={'#status': 'status'},
+        ExpressionAttributeValues={':claim_token': {'S': claim_token}}
+      )
+    except botocore.exceptions.ClientError as e:
+      if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+        raise
+      LOGGER.info("idempotency claim on %s was taken over, response not stored", key)
+
+  def release(self, key, claim_token):
+    from lib.ddb import Ddb
+    import botocore.exceptions
+    try:
+      Ddb.client().delete_item(
+        TableName=self.TABLE_NAME,
+        Key=self.item_key(key),
+        ConditionExpression='claim_token = :claim_token AND attribute_not_exists(#status)',
+        ExpressionAttributeNames={'#status': 'status'},
+        ExpressionAttributeValues={':claim_token': {'S': claim_token}}
+      )
+    except botocore.exceptions.ClientError as e:
+      if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+        raise
+
+BACKENDS = {
+  'memory': MemoryStore,
+  'postgres': PostgresStore,
+  'dynamodb': DynamoDBStore
+}
+
+_store = None
+_store_lock = threading.Lock()
+
+def _after_fork():
+  global _store, _store_lock
+  _store = None
+  _store_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+def store():
+  global _store
+  with _store_lock:
+    if _store is None:
+      _store = BACKENDS[IDEMPOTENCY_BACKEND]()
+    return _store
+
+def scope():
+  claims = verify_request()
+  if claims is not None:
+    return f"user:{claims['sub']}"
+  return f"ip:{client_ip()}"
+
+def fingerprint():
+  return hashlib.sha256(request.get_data()).hexdigest()
+
+def replay(record):
+  response = current_app.response_class(record.body, status=record.status, content_type=record.content_type)
+  response.headers['Idempotent-Replayed'] = 'true'
+  return response
+
+def idempotent(name):
+  def decorator(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+      idempotency_key = request.headers.get('Idempotency-Key')
+      if request.method == 'OPTIONS' or not idempotency_key:
+        return fn(*args, **kwargs)
+      if len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        return {'errors': ['idempotency_key_too_long']}, 400
+
+      key = f"{name}:{scope()}:{idempotency_key}"
+      request_fingerprint = fingerprint()
+      claim_token = secrets.token_hex(16)
+      try:
+        existing = store().claim(key, request_fingerprint, claim_token)
+      except Exception as e:
+        LOGGER.warning("idempotency store failed, running without it: %s", e)
+        OUTCOMES.inc(name, 'store_failed')
+        return fn(*args, **kwargs)
+
+      if existing is not None:
+        if existing.fingerprint != request_fingerprint:
+          OUTCOMES.inc(name, 'key_reused')
+          return {'errors': ['idempotency_key_reused']}, 422
+        if existing.status is None:
+          OUTCOMES.inc(name, 'in_progress')
+          return {'errors': ['idempotency_key_in_progress']}, 409, {'Retry-After': '1'}
+        OUTCOMES.inc(name, 'replayed')
+        return replay(existing)
+
+      OUTCOMES.inc(name, 'claimed')
+
+      try:
+        response = make_response(fn(*args, **kwargs))
+      except BaseException:
+        finish(key, claim_token, request_fingerprint, None)
+        raise
+      finish(key, claim_token, request_fingerprint, response)
+      return response
+    return wrapper
+  return decorator
+
+def finish(key, claim_token, request_fingerprint, response):
+  try:
+    if response is None or response.status_code >= 500 or response.status_code in RETRYABLE_STATUSES \
+        or response.is_streamed:
+      store().release(key, claim_token)
+    else:
+      store().complete(key, claim_token, request_fingerprint, response.status_code,
+        response.content_type, response.get_data())
+  except Exception as e:
+    LOGGER.warning("idempotency store failed to record %s: %s", key, e)
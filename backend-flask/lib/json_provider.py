@@ -0,0 +1,90 @@
+import dataclasses
+import decimal
+import json
+import uuid
+from datetime import date, datetime
+from flask import current_app
+from flask.json.provider import JSONProvider
+
+# Fast JSON for API responses.
+#
+#   app.json = FastJSONProvider(app)
+#
+# Endpoints keep returning dicts/lists; Flask hands them to app.json.response().
+# Uses orjson when it is installed and falls back to the stdlib encoder
+# otherwise; both produce the same output for our payloads:
+#
+#   uuid.UUID       -> "68f126b0-1ceb-4a33-88be-d90fa7109eee"
+#   datetime / date -> ISO 8601 (what the services already send as strings),
+#                      not Flask's default RFC 822 HTTP date
+#   decimal.Decimal -> string
+#
+# Output is always compact; keys keep insertion order (no sort_keys).
+#
+# JSON that is already serialized (Db.query_array_json(..., raw=True) returns
+# the text Postgres built) is sent as is with json_body():
+#
+#   return json_body(db.query_array_json(sql, raw=True)), 200
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+def default(obj):
+  if isinstance(obj, (datetime, date)):
+    return obj.isoformat()
+  if isinstance(obj, uuid.UUID):
+    return str(obj)
+  if isinstance(obj, decimal.Decimal):
+    return str(obj)
+  if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+    return dataclasses.asdict(obj)
+  if isinstance(obj, (set, frozenset)):
+    return list(obj)
+  if hasattr(obj, '__html__'):
+    return str(obj.__html__())
+  raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+if orjson is not None:
+  ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+  def dumps_bytes(obj):
+    return orjson.dumps(obj, default=default, option=ORJSON_OPTIONS)
+
+  def loads(s):
+    return orjson.loads(s)
+else:
+  def dumps_bytes(obj):
+    return json.dumps(obj, default=default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+  def loads(s):
+    return json.loads(s)
+
+def dumps(obj):
+  return dumps_bytes(obj).decode('utf-8')
+
+class FastJSONProvider(JSONProvider):
+  mimetype = 'application/json'
+
+  def dumps(self, obj, **kwargs):
+    if kwargs:
+      # json.dumps options (indent, sort_keys...) only the stdlib understands
+      kwargs.setdefault('default', default)
+      return json.dumps(obj, **kwargs)
+    return dumps(obj)
+
+  def loads(self, s, **kwargs):
+    if kwargs:
+      return json.loads(s, **kwargs)
+    return loads(s)
+
+  def response(self, *args, **kwargs):
+    obj = self._prepare_response_obj(args, kwargs)
+    return self._app.response_class(dumps_bytes(obj) + b"\n", mimetype=self.mimetype)
+
+def json_body(raw):
+  """A JSON response whose body is already-serialized JSON text or bytes."""
+  if isinstance(raw, str):
+    raw = raw.encode('utf-8')
+  return current_app.response_class(raw, mimetype='application/json')
@@ -0,0 +1,60 @@
+import json
+import os
+import time
+import uuid
+from jose import jwk, jwt
+
+# Test-only helper: a local RSA key pair that stands in for a Cognito user
+# pool, so the auth path can be exercised and load-tested offline.
+#
+#   private_pem, jwks = generate_keypair()
+#   token = mint_token(private_pem, jwks['keys'][0]['kid'], sub='...', client_id='...')
+#
+# Point the backend at the public half with AWS_COGNITO_JWKS_FILE=<jwks.json>.
+# Tokens minted here verify nowhere else.
+
+def generate_keypair(kid=None, bits=2048):
+  import rsa
+  public, private = rsa.newkeys(bits)
+  kid = kid or f"local-{uuid.uuid4()}"
+  public_jwk = jwk.construct(public.save_pkcs1().decode('utf-8'), 'RS256').to_dict()
+  public_jwk = {k: v.decode('utf-8') if isinstance(v, bytes) else v for k, v in public_jwk.items()}
+  public_jwk.update({'kid': kid, 'use': 'sig', 'alg': 'RS256'})
+  return private.save_pkcs1().decode('utf-8'), {'keys': [public_jwk]}
+
+def write_keypair(directory, kid=None):
+  """Writes private.pem and jwks.json into directory and returns their paths."""
+  private_pem, jwks = generate_keypair(kid)
+  os.makedirs(directory, exist_ok=True)
+  private_path = os.path.join(directory, 'private.pem')
+  jwks_path = os.path.join(directory, 'jwks.json')
+  with open(private_path, 'w') as f:
+    f.write(private_pem)
+  os.chmod(private_path, 0o600)
+  with open(jwks_path, 'w') as f:
+    json.dump(jwks, f, indent=2)
+  return private_path, jwks_path
+
+def load_keypair(directory):
+  with open(os.path.join(directory, 'private.pem')) as f:
+    private_pem = f.read()
+  with open(os.path.join(directory, 'jwks.json')) as f:
+    jwks = json.load(f)
+  return private_pem, jwks
+
+def mint_token(private_pem, kid, sub, client_id, username=None, ttl=3600, **extra_claims):
+  """Signs a Cognito-shaped access token (token_use=access, client_id, sub, username, exp)."""
+  now = int(time.time())
+  claims = {
+    'sub': sub,
+    'client_id': client_id,
+    'username': username or sub,
+    'token_use': 'access',
+    'scope': 'aws.cognito.signin.user.admin',
+    'iat': now,
+    'auth_time': now,
+    'exp': now + ttl,
+    'jti': str(uuid.uuid4())
+  }
+  claims.update(extra_claims)
+  return jwt.encode(claims, private_pem, algorithm='RS256', headers={'kid': kid})
@@ -0,0 +1,219 @@
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+# One structured (JSON lines) logging path for backend-flask.
+#
+#   from lib.log import get_logger
+#   LOGGER = get_logger(__name__)
+#   LOGGER.debug("created activity %s", uuid)          # free when DEBUG is off
+#   LOGGER.info("message sent", extra={'fields': {'group': uuid}})
+#
+# Request threads only append the record to a bounded in-memory queue; a
+# background shipper thread formats it and writes it to stdout (and to
+# CloudWatch through watchtower when LOG_CLOUDWATCH=1). When the queue is
+# full the record is dropped and counted instead of blocking the request.
+#
+# Environment:
+#   LOG_LEVEL        DEBUG/INFO/WARNING/ERROR (default INFO)
+#   LOG_QUEUE_SIZE   records buffered before dropping (default 10000)
+#   LOG_CLOUDWATCH   1 to also ship to CloudWatch Logs (CLOUDWATCH_LOG_GROUP/STREAM)
+#   ACCESS_LOG_SAMPLE per-route access-log sample rates, e.g.
+#                    "/api/health-check=0,/api/activities/home=0.1,default=1"
+#                    (5xx and slow requests are always logged)
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+LOG_CLOUDWATCH = os.getenv('LOG_CLOUDWATCH', '0') == '1'
+ACCESS_LOG_SLOW_MS = float(os.getenv('ACCESS_LOG_SLOW_MS', '1000'))
+ROOT_LOGGER = 'cruddur'
+
+# attributes every LogRecord has; anything else came in through extra=
+RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+def parse_sample_rates(spec):
+  rates = {}
+  for part in filter(None, (p.strip() for p in spec.split(','))):
+    route, _, rate = part.partition('=')
+    rates[route.strip()] = float(rate)
+  return rates
+
+ACCESS_LOG_SAMPLE = parse_sample_rates(os.getenv('ACCESS_LOG_SAMPLE', '/api/health-check=0,/api/health-check/ready=0,default=1'))
+
+class JsonFormatter(logging.Formatter):
+  def format(self, record):
+    entry = {
+      'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+      'level': record.levelname,
+      'logger': record.name,
+      'msg': record.getMessage()
+    }
+    fields = getattr(record, 'fields', None)
+    if fields:
+      entry.update(fields)
+    for key, value in record.__dict__.items():
+      if key not in RESERVED and key != 'fields':
+        entry[key] = value
+    if record.exc_text:
+      entry['exc'] = record.exc_text
+    return json.dumps(entry, default=str)
+
+class Stats:
+  """
+  Pipeline counters, exported as log_<name>_total by lib/metrics.py. They are
+  bumped from every request thread and the shipper, so under a lock: a bare
+  += can lose increments when threads interleave.
+  """
+  def __init__(self):
+    self.enqueued = 0
+    self.dropped = 0
+    self.shipped = 0
+    self.ship_errors = 0
+    self.lock = threading.Lock()
+
+  def incr(self, name, amount=1):
+    with self.lock:
+      setattr(self, name, getattr(self, name) + amount)
+
+  def snapshot(self):
+    with self.lock:
+      return {
+        'enqueued': self.enqueued,
+        'dropped': self.dropped,
+        'shipped': self.shipped,
+        'ship_errors': self.ship_errors
+      }
+
+class QueueingHandler(logging.Handler):
+  """Never blocks: put_nowait or drop and count."""
+  def __init__(self, pipeline):
+    super().__init__()
+    self.pipeline = pipeline
+
+  def emit(self, record):
+    pipeline = self.pipeline
+    pipeline.ensure_shipper()
+    # resolve the message now: args may be mutated once we return
+    record.msg = record.getMessage()
+    record.args = None
+    if record.exc_info:
+      record.exc_text = logging.Formatter().formatException(record.exc_info)
+      record.exc_info = None
+    try:
+      pipeline.queue.put_nowait(record)
+      pipeline.stats.incr('enqueued')
+    except queue.Full:
+      pipeline.stats.incr('dropped')
+
+class Pipeline:
+  def __init__(self, maxsize=LOG_QUEUE_SIZE):
+    self.queue = queue.Queue(maxsize=maxsize)
+    self.stats = Stats()
+    self.targets = []
+    self.shipper = None
+    self.shipper_pid = None
+    self.lock = threading.Lock()
+    os.register_at_fork(after_in_child=self.after_fork)
+
+  def after_fork(self):
+    # the parent's shipper thread (and watchtower's) do not exist in the
+    # child and the queue's lock may have been held at the fork; records the
+    # parent had not shipped yet are the parent's to ship
+    self.queue = queue.Queue(maxsize=self.queue.maxsize)
+    self.stats = Stats()
+    self.targets = []
+    self.shipper = None
+    self.shipper_pid = None
+    self.lock = threading.Lock()
+
+  def ensure_shipper(self):
+    # started lazily, and again in a forked child (threads do not survive fork)
+    if self.shipper_pid == os.getpid():
+      return
+    with self.lock:
+      if self.shipper_pid == os.getpid():
+        return
+      self.shipper = threading.Thread(target=self.ship, name='log-shipper', daemon=True)
+      self.shipper_pid = os.getpid()
+      self.shipper.start()
+
+  def build_targets(self):
+    formatter = JsonFormatter()
+    stdout = logging.StreamHandler(sys.stdout)
+    stdout.setFormatter(formatter)
+    targets = [stdout]
+    if LOG_CLOUDWATCH:
+      # created on the shipper thread, so the CreateLogGroup/Stream calls
+      # never run on the import path or a request thread
+      try:
+        import watchtower
+        cloudwatch = watchtower.CloudWatchLogHandler(
+          log_group_name=os.getenv('CLOUDWATCH_LOG_GROUP', 'cruddur'),
+          log_stream_name=os.getenv('CLOUDWATCH_LOG_STREAM', f"app-instance-{int(time.time())}"),
+          create_log_group=True,
+          create_log_stream=True
+        )
+        cloudwatch.setFormatter(formatter)
+        targets.append(cloudwatch)
+      except Exception as e:
+        stdout.handle(logging.makeLogRecord({
+          'name': ROOT_LOGGER, 'levelno': logging.ERROR, 'levelname': 'ERROR',
+          'msg': f"Failed to configure CloudWatch logging: {e}"
+        }))
+    return targets
+
+  def ship(self):
+    if not self.targets:
+      self.targets = self.build_targets()
+    while True:
+      record = self.queue.get()
+      for target in self.targets:
+        try:
+          target.handle(record)
+        except Exception:
+          self.stats.incr('ship_errors')
+      self.stats.incr('shipped')
+
+  def flush(self, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not self.queue.empty() and time.monotonic() < deadline:
+      time.sleep(0.01)
+    for target in self.targets:
+      target.flush()
+
+_pipeline = Pipeline()
+
+def setup():
+  root = logging.getLogger(ROOT_LOGGER)
+  if not any(isinstance(h, QueueingHandler) for h in root.handlers):
+    root.addHandler(QueueingHandler(_pipeline))
+  root.setLevel(LOG_LEVEL)
+  root.propagate = False
+  return root
+
+def get_logger(name):
+  setup()
+  if name.startswith(ROOT_LOGGER):
+    return logging.getLogger(name)
+  return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+def stats():
+  values = _pipeline.stats.snapshot()
+  values['queue_depth'] = _pipeline.queue.qsize()
+  values['queue_size'] = _pipeline.queue.maxsize
+  return values
+
+def flush(timeout=2.0):
+  _pipeline.flush(timeout)
+
+def access_log_sampled(route, status, duration_ms):
+  """Whether to emit the access log record for this request."""
+  if status >= 500 or duration_ms >= ACCESS_LOG_SLOW_MS:
+    return True
+  rate = ACCESS_LOG_SAMPLE.get(route, ACCESS_LOG_SAMPLE.get('default', 1.0))
+  return rate >= 1.0 or (rate > 0.0 and random.random() < rate)
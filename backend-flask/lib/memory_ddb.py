@@ -0,0 +1,399 @@
+import bisect
+import copy
+import math
+import re
+import threading
+
+# In-process stand-in for the subset of the DynamoDB client API that
+# lib/ddb.py uses. It speaks the same low level wire format as
+# boto3.client('dynamodb') ({'S': ...} attribute values, Items /
+# LastEvaluatedKey responses) so Ddb can be pointed at it unchanged:
+#
+#   AWS_ENDPOINT_URL=memory:// -> Ddb.client() returns MemoryDdb.shared()
+#
+# Supported: create_table, delete_table, put_item, get_item, delete_item,
+# batch_write_item and query (table or GSI, pk = :v plus an optional
+# begins_with / comparison / BETWEEN on the range key, ScanIndexForward,
+# Limit, ExclusiveStartKey -> LastEvaluatedKey, ProjectionExpression,
+# ReturnConsumedCapacity) and ConditionExpression on put_item / delete_item
+# (attribute_exists / attribute_not_exists / comparisons joined by AND / OR,
+# no parentheses).
+
+MESSAGES_TABLE_SCHEMA = {
+  'KeySchema': [
+    {'AttributeName': 'pk', 'KeyType': 'HASH'},
+    {'AttributeName': 'sk', 'KeyType': 'RANGE'}
+  ],
+  'GlobalSecondaryIndexes': [{
+    'IndexName': 'message-group-sk-index',
+    'KeySchema': [
+      {'AttributeName': 'message_group_uuid', 'KeyType': 'HASH'},
+      {'AttributeName': 'sk', 'KeyType': 'RANGE'}
+    ],
+    'Projection': {'ProjectionType': 'ALL'}
+  }]
+}
+
+# upper bound used to turn begins_with(prefix) into a half-open range
+PREFIX_END = '\U0010ffff'
+
+KEY_CONDITION = re.compile(
+  r'^\s*(?P<hash>[#\w]+)\s*=\s*(?P<hash_value>:\w+)\s*'
+  r'(?:AND\s+(?P<range>.+?))?\s*$',
+  re.IGNORECASE
+)
+BEGINS_WITH = re.compile(r'^begins_with\s*\(\s*([#\w]+)\s*,\s*(:\w+)\s*\)$', re.IGNORECASE)
+BETWEEN = re.compile(r'^([#\w]+)\s+BETWEEN\s+(:\w+)\s+AND\s+(:\w+)$', re.IGNORECASE)
+COMPARISON = re.compile(r'^([#\w]+)\s*(<=|>=|<>|<|>|=)\s*(:\w+)$')
+ATTRIBUTE_FUNCTION = re.compile(r'^(attribute_exists|attribute_not_exists)\s*\(\s*([#\w]+)\s*\)$', re.IGNORECASE)
+OR = re.compile(r'\s+OR\s+', re.IGNORECASE)
+AND = re.compile(r'\s+AND\s+', re.IGNORECASE)
+
+
+class MemoryDdbError(Exception):
+  pass
+
+
+def client_error(code, message, operation):
+  # raise the same exception type boto3 raises so callers' except blocks work
+  try:
+    from botocore.exceptions import ClientError
+  except ImportError:
+    return MemoryDdbError(f"{code}: {message}")
+  return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+def key_value(attr):
+  if 'S' in attr:
+    return attr['S']
+  if 'N' in attr:
+    return float(attr['N'])
+  if 'B' in attr:
+    return attr['B']
+  raise MemoryDdbError(f"unsupported key attribute: {attr}")
+
+
+def item_size(item):
+  size = 0
+  for name, attr in item.items():
+    size += len(name)
+    for value in attr.values():
+      size += len(value) if isinstance(value, (str, bytes)) else 8
+  return size
+
+
+class _Table:
+  def __init__(self, name, key_schema, indexes):
+    self.name = name
+    self.hash_key, self.range_key = self._keys(key_schema)
+    # index name -> (hash attribute, range attribute)
+    self.indexes = {}
+    for index in indexes:
+      self.indexes[index['IndexName']] = self._keys(index['KeySchema'])
+    self.items = {}
+    # partitions[None] is the base table, partitions[index_name] a GSI.
+    # each maps hash value -> sorted list of (range, table_hash, table_range)
+    self.partitions = {None: {}}
+    for index_name in self.indexes:
+      self.partitions[index_name] = {}
+
+  @staticmethod
+  def _keys(key_schema):
+    hash_key = next(k['AttributeName'] for k in key_schema if k['KeyType'] == 'HASH')
+    range_key = next(k['AttributeName'] for k in key_schema if k['KeyType'] == 'RANGE')
+    return hash_key, range_key
+
+  def key_for(self, key):
+    try:
+      return (key_value(key[self.hash_key]), key_value(key[self.range_key]))
+    except KeyError as e:
+      raise client_error('ValidationException', f"missing key attribute {e}", 'GetItem')
+
+  def key_attrs(self, primary):
+    item = self.items[primary]
+    return {
+      self.hash_key: item[self.hash_key],
+      self.range_key: item[self.range_key]
+    }
+
+  def _entries(self, index_name, item, primary):
+    if index_name is None:
+      yield primary[0], (primary[1], primary[0], primary[1])
+      return
+    hash_attr, range_attr = self.indexes[index_name]
+    # sparse index: items without both GSI keys are not projected
+    if hash_attr in item and range_attr in item:
+      yield key_value(item[hash_attr]), (key_value(item[range_attr]), primary[0], primary[1])
+
+  def put(self, item):
+    primary = self.key_for(item)
+    self.delete(primary)
+    self.items[primary] = item
+    for index_name, partitions in self.partitions.items():
+      for hash_value, entry in self._entries(index_name, item, primary):
+        bisect.insort(partitions.setdefault(hash_value, []), entry)
+
+  def delete(self, primary):
+    item = self.items.pop(primary, None)
+    if item is None:
+      return None
+    for index_name, partitions in self.partitions.items():
+      for hash_value, entry in self._entries(index_name, item, primary):
+        entries = partitions[hash_value]
+        del entries[bisect.bisect_left(entries, entry)]
+        if not entries:
+          del partitions[hash_value]
+    return item
+
+
+class MemoryDdb:
+  _shared = None
+  _shared_lock = threading.Lock()
+
+  def __init__(self):
+    self.tables = {}
+    self.lock = threading.RLock()
+
+  @classmethod
+  def shared(cls):
+    # one process-wide instance so every Ddb.client() call sees the same data
+    with cls._shared_lock:
+      if cls._shared is None:
+        cls._shared = cls()
+        cls._shared.create_table(TableName='cruddur-messages', **MESSAGES_TABLE_SCHEMA)
+      return cls._shared
+
+  @classmethod
+  def reset_shared(cls):
+    with cls._shared_lock:
+      cls._shared = None
+
+  # ------------------------------------------------------------ tables
+  def create_table(self, TableName, KeySchema, GlobalSecondaryIndexes=(), **_):
+    with self.lock:
+      if TableName in self.tables:
+        raise client_error('ResourceInUseException', f"Table already exists: {TableName}", 'CreateTable')
+      self.tables[TableName] = _Table(TableName, KeySchema, GlobalSecondaryIndexes)
+    return {'TableDescription': {'TableName': TableName, 'TableStatus': 'ACTIVE'}}
+
+  def delete_table(self, TableName):
+    with self.lock:
+      self._table(TableName, 'DeleteTable')
+      del self.tables[TableName]
+    return {'TableDescription': {'TableName': TableName, 'TableStatus': 'DELETING'}}
+
+  def _table(self, name, operation):
+    table = self.tables.get(name)
+    if table is None:
+      raise client_error('ResourceNotFoundException', f"Requested resource not found: {name}", operation)
+    return table
+
+  @staticmethod
+  def _consumed(table_name, units, return_consumed):
+    if return_consumed in ('TOTAL', 'INDEXES'):
+      return {'ConsumedCapacity': {'TableName': table_name, 'CapacityUnits': units}}
+    return {}
+
+  # ------------------------------------------------------------ items
+  def put_item(self, TableName, Item, ReturnConsumedCapacity='NONE', ConditionExpression=None,
+               ExpressionAttributeNames=None, ExpressionAttributeValues=None, **_):
+    with self.lock:
+      table = self._table(TableName, 'PutItem')
+      if ConditionExpression is not None:
+        self._check_condition(table.items.get(table.key_for(Item)), ConditionExpression,
+          ExpressionAttributeNames or {}, ExpressionAttributeValues or {}, 'PutItem')
+      table.put(copy.deepcopy(Item))
+    units = float(math.ceil(item_size(Item) / 1024))
+    return self._consumed(TableName, units, ReturnConsumedCapacity)
+
+  def get_item(self, TableName, Key, ReturnConsumedCapacity='NONE', **_):
+    with self.lock:
+      table = self._table(TableName, 'GetItem')
+      item = table.items.get(table.key_for(Key))
+      response = {'Item': copy.deepcopy(item)} if item is not None else {}
+    units = 0.5 * max(1, math.ceil(item_size(item or {}) / 4096))
+    response.update(self._consumed(TableName, units, ReturnConsumedCapacity))
+    return response
+
+  def delete_item(self, TableName, Key, ReturnConsumedCapacity='NONE', ConditionExpression=None,
+                  ExpressionAttributeNames=None, ExpressionAttributeValues=None, **_):
+    with self.lock:
+      table = self._table(TableName, 'DeleteItem')
+      if ConditionExpression is not None:
+        self._check_condition(table.items.get(table.key_for(Key)), ConditionExpression,
+          ExpressionAttributeNames or {}, ExpressionAttributeValues or {}, 'DeleteItem')
+      table.delete(table.key_for(Key))
+    return self._consumed(TableName, 1.0, ReturnConsumedCapacity)
+
+  def batch_write_item(self, RequestItems, ReturnConsumedCapacity='NONE', **_):
+    with self.lock:
+      for table_name, requests in RequestItems.items():
+        table = self._table(table_name, 'BatchWriteItem')
+        for request in requests:
+          if 'PutRequest' in request:
+            table.put(copy.deepcopy(request['PutRequest']['Item']))
+          elif 'DeleteRequest' in request:
+            table.delete(table.key_for(request['DeleteRequest']['Key']))
+    response = {'UnprocessedItems': {}}
+    if ReturnConsumedCapacity in ('TOTAL', 'INDEXES'):
+      response['ConsumedCapacity'] = [
+        {'TableName': name, 'CapacityUnits': float(len(requests))}
+        for name, requests in RequestItems.items()
+      ]
+    return response
+
+  # ------------------------------------------------------------ query
+  def query(self, TableName, KeyConditionExpression, ExpressionAttributeValues,
+            IndexName=None, ScanIndexForward=True, Limit=None, ExclusiveStartKey=None,
+            ExpressionAttributeNames=None, ProjectionExpression=None,
+            ReturnConsumedCapacity='NONE', **_):
+    names = ExpressionAttributeNames or {}
+    values = ExpressionAttributeValues
+
+    with self.lock:
+      table = self._table(TableName, 'Query')
+      if IndexName is None:
+        hash_attr, range_attr = table.hash_key, table.range_key
+      elif IndexName in table.indexes:
+        hash_attr, range_attr = table.indexes[IndexName]
+      else:
+        raise client_error('ValidationException', f"The table does not have the specified index: {IndexName}", 'Query')
+
+      hash_value, bounds = self._parse_key_condition(
+        KeyConditionExpression, names, values, hash_attr, range_attr)
+      entries = table.partitions[IndexName].get(hash_value, [])
+      lo, hi = self._bounds(entries, bounds)
+
+      if ExclusiveStartKey is not None:
+        start = self._start_entry(table, IndexName, ExclusiveStartKey)
+        position = bisect.bisect_left(entries, start)
+        if ScanIndexForward:
+          found = position < len(entries) and entries[position] == start
+          lo = max(lo, position + 1 if found else position)
+        else:
+          hi = min(hi, position)
+
+      if ScanIndexForward:
+        selected = entries[lo:hi]
+      else:
+        selected = entries[lo:hi][::-1]
+      more = Limit is not None and len(selected) > Limit
+      if Limit is not None:
+        selected = selected[:Limit]
+
+      items = [copy.deepcopy(table.items[(entry[1], entry[2])]) for entry in selected]
+      if ProjectionExpression:
+        projected = [names.get(n.strip(), n.strip()) for n in ProjectionExpression.split(',')]
+        items = [{k: v for k, v in item.items() if k in projected} for item in items]
+      response = {'Items': items, 'Count': len(items), 'ScannedCount': len(items)}
+      if more and selected:
+        last = selected[-1]
+        last_key = table.key_attrs((last[1], last[2]))
+        if IndexName is not None:
+          last_item = table.items[(last[1], last[2])]
+          last_key[hash_attr] = last_item[hash_attr]
+          last_key[range_attr] = last_item[range_attr]
+        response['LastEvaluatedKey'] = copy.deepcopy(last_key)
+
+    units = 0.5 * max(1, math.ceil(sum(item_size(i) for i in items) / 4096))
+    response.update(self._consumed(TableName, units, ReturnConsumedCapacity))
+    return response
+
+  @staticmethod
+  def _start_entry(table, index_name, start_key):
+    primary = table.key_for(start_key)
+    if index_name is None:
+      return (primary[1], primary[0], primary[1])
+    _, range_attr = table.indexes[index_name]
+    return (key_value(start_key[range_attr]), primary[0], primary[1])
+
+  @staticmethod
+  def _bounds(entries, bounds):
+    # bounds is (low, low_inclusive, high, high_inclusive) on the range value
+    low, low_inclusive, high, high_inclusive = bounds
+    lo, hi = 0, len(entries)
+    if low is not None:
+      if low_inclusive:
+        lo = bisect.bisect_left(entries, low, key=lambda e: e[0])
+      else:
+        lo = bisect.bisect_right(entries, low, key=lambda e: e[0])
+    if high is not None:
+      if high_inclusive:
+        hi = bisect.bisect_right(entries, high, key=lambda e: e[0])
+      else:
+        hi = bisect.bisect_left(entries, high, key=lambda e: e[0])
+    return lo, max(lo, hi)
+
+  @staticmethod
+  def _parse_key_condition(expression, names, values, hash_attr, range_attr):
+    def attr_name(token):
+      return names.get(token, token)
+
+    def value(token):
+      try:
+        return key_value(values[token])
+      except KeyError:
+        raise client_error('ValidationException', f"Value provided for {token} is not defined", 'Query')
+
+    match = KEY_CONDITION.match(expression)
+    if match is None or attr_name(match.group('hash')) != hash_attr:
+      raise client_error('ValidationException', f"Unsupported KeyConditionExpression: {expression}", 'Query')
+    hash_value = value(match.group('hash_value'))
+
+    condition = match.group('range')
+    if condition is None:
+      return hash_value, (None, True, None, True)
+    condition = condition.strip()
+
+    begins = BEGINS_WITH.match(condition)
+    between = BETWEEN.match(condition)
+    comparison = COMPARISON.match(condition)
+    if begins and attr_name(begins.group(1)) == range_attr:
+      prefix = value(begins.group(2))
+      return hash_value, (prefix, True, prefix + PREFIX_END, False)
+    if between and attr_name(between.group(1)) == range_attr:
+      return hash_value, (value(between.group(2)), True, value(between.group(3)), True)
+    if comparison and attr_name(comparison.group(1)) == range_attr:
+      operator, operand = comparison.group(2), value(comparison.group(3))
+      return hash_value, {
+        '=':  (operand, True, operand, True),
+        '<':  (None, True, operand, False),
+        '<=': (None, True, operand, True),
+        '>':  (operand, False, None, True),
+        '>=': (operand, True, None, True)
+      }[operator]
+    raise client_error('ValidationException', f"Unsupported KeyConditionExpression: {expression}", 'Query')
+
+  # ------------------------------------------------------------ conditions
+  @staticmethod
+  def _check_condition(item, expression, names, values, operation):
+    item = item or {}
+
+    def term_holds(term):
+      term = term.strip()
+      function = ATTRIBUTE_FUNCTION.match(term)
+      if function:
+        exists = names.get(function.group(2), function.group(2)) in item
+        return exists if function.group(1).lower() == 'attribute_exists' else not exists
+      comparison = COMPARISON.match(term)
+      if comparison is None:
+        raise client_error('ValidationException', f"Unsupported ConditionExpression: {expression}", operation)
+      attr = item.get(names.get(comparison.group(1), comparison.group(1)))
+      operand = values.get(comparison.group(3))
+      if operand is None:
+        raise client_error('ValidationException', f"Value provided for {comparison.group(3)} is not defined", operation)
+      if attr is None:
+        # like DynamoDB: a comparison on a missing attribute is false
+        return False
+      left, right = key_value(attr), key_value(operand)
+      return {
+        '=': left == right,
+        '<>': left != right,
+        '<': left < right,
+        '<=': left <= right,
+        '>': left > right,
+        '>=': left >= right
+      }[comparison.group(2)]
+
+    if not any(all(term_holds(term) for term in AND.split(clause)) for clause in OR.split(expression)):
+      raise client_error('ConditionalCheckFailedException', 'The conditional request failed', operation)
@@ -0,0 +1,402 @@
+import bisect
+import fcntl
+import hmac
+import json
+import os
+import threading
+import time
+from flask import make_response, request
+
+from lib.process import on_worker_start
+import lib.log
+
+# In-process metrics registry, scraped as Prometheus text on /metrics.
+#
+#   REQUESTS = lib.metrics.counter('http_requests_total', 'Requests', ('method', 'route', 'status'))
+#   REQUESTS.inc('GET', '/api/activities/home', '200')
+#
+#   LATENCY = lib.metrics.histogram('db_query_duration_seconds', 'Query time', ('template',))
+#   LATENCY.observe(0.012, 'activities/home')
+#
+#   lib.metrics.register_stats('cache', lib.cache.stats,
+#     counters=('hits', 'misses'), gauges=('entries',))
+#
+# Recording never takes a lock: every thread adds to its own shard (a plain
+# dict), and the shards are only summed when the registry is scraped. Gauges
+# and the existing stats() dicts of other modules (cache, log pipeline,
+# concurrency limits, tracing, Db pool) are read by collectors at scrape time
+# and cost nothing on the request path.
+#
+# Workers: every gunicorn worker has its own registry. With METRICS_DIR set
+# each worker writes a snapshot to METRICS_DIR/<pid>.json every
+# METRICS_FLUSH_INTERVAL seconds (and when it exits), and the worker that
+# answers a scrape sums all of them, so /metrics shows the whole task no
+# matter which worker served it. Counters and histograms of workers that have
+# exited are folded into METRICS_DIR/archive.json so totals never go
+# backwards; gauges only count live workers. gunicorn.conf.py empties the
+# directory when gunicorn starts. Other workers' numbers are up to
+# METRICS_FLUSH_INTERVAL seconds old. Without METRICS_DIR (flask run, one
+# worker) /metrics shows this process only.
+#
+# Access: /metrics names every route, the pool and limiter sizes and the
+# error rates, so it is not public. With METRICS_TOKEN set a scrape must
+# send it as "Authorization: Bearer <METRICS_TOKEN>" (401 otherwise);
+# without it /metrics only answers loopback clients (a sidecar, curl inside
+# the container) and is a 404 to everyone else, the load balancer included.
+#
+#   curl -H "Authorization: Bearer $METRICS_TOKEN" http://localhost:4567/metrics
+#
+# Environment:
+#   METRICS_ENABLED         0 disables /metrics (default 1)
+#   METRICS_TOKEN           bearer token a scrape must present (default unset:
+#                           loopback clients only)
+#   METRICS_DIR             directory shared by the workers for their snapshots
+#                           (default unset: this process only)
+#   METRICS_FLUSH_INTERVAL  seconds between snapshots (default 5)
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') == '1'
+METRICS_DIR = os.getenv('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+METRICS_TOKEN = os.getenv('METRICS_TOKEN') or None
+LOOPBACK = ('127.0.0.1', '::1')
+PREFIX = 'cruddur_'
+ARCHIVE = 'archive.json'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds; request and query latencies from sub-millisecond cache hits to
+# load balancer timeouts
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Metric:
+  kind = None
+
+  def __init__(self, registry, name, help, labels):
+    self.registry = registry
+    self.name = PREFIX + name
+    self.help = help
+    self.labels = tuple(labels)
+
+class Counter(Metric):
+  kind = 'counter'
+
+  def inc(self, *labels, n=1):
+    shard = self.registry.shard()
+    key = (self.name, labels)
+    shard[key] = shard.get(key, 0) + n
+
+class Histogram(Metric):
+  kind = 'histogram'
+
+  def __init__(self, registry, name, help, labels, buckets=DEFAULT_BUCKETS):
+    super().__init__(registry, name, help, labels)
+    self.buckets = tuple(buckets)
+
+  def observe(self, value, *labels):
+    shard = self.registry.shard()
+    key = (self.name, labels)
+    # per bucket counts (the last one is +Inf), then the sum
+    counts = shard.get(key)
+    if counts is None:
+      counts = shard[key] = [0] * (len(self.buckets) + 2)
+    counts[bisect.bisect_left(self.buckets, value)] += 1
+    counts[-1] += value
+
+class Gauge(Metric):
+  """Set only by a collector, when the registry is read."""
+  kind = 'gauge'
+
+class Snapshot:
+  """Summed values: counters -> number, histograms -> counts list, gauges -> number."""
+
+  def __init__(self, counters=None, histograms=None, gauges=None):
+    self.counters = counters if counters is not None else {}
+    self.histograms = histograms if histograms is not None else {}
+    self.gauges = gauges if gauges is not None else {}
+
+  def add(self, other, gauges=True):
+    for key, value in other.counters.items():
+      self.counters[key] = self.counters.get(key, 0) + value
+    for key, counts in other.histograms.items():
+      mine = self.histograms.get(key)
+      if mine is None or len(mine) != len(counts):
+        self.histograms[key] = list(counts)
+      else:
+        for i, count in enumerate(counts):
+          mine[i] += count
+    if gauges:
+      for key, value in other.gauges.items():
+        self.gauges[key] = self.gauges.get(key, 0) + value
+
+  def to_json(self):
+    def rows(values):
+      return [[name, list(labels), value] for (name, labels), value in values.items()]
+    return {'counters': rows(self.counters), 'histograms': rows(self.histograms), 'gauges': rows(self.gauges)}
+
+  @classmethod
+  def from_json(cls, data):
+    def values(rows):
+      return {(name, tuple(labels)): value for name, labels, value in rows}
+    return cls(values(data.get('counters', [])), values(data.get('histograms', [])), values(data.get('gauges', [])))
+
+class Registry:
+  def __init__(self):
+    self.metrics = {}     # name -> Metric
+    self.collectors = []  # fn() -> iterable of (metric, labels, value)
+    self.reset()
+    os.register_at_fork(after_in_child=self.reset)
+
+  def reset(self):
+    # also run in a forked worker: it starts counting from zero
+    self.local = threading.local()
+    self.shards = []     # (thread, shard) of every thread that recorded something
+    self.retired = Snapshot()  # shards of threads that have ended
+    self.lock = threading.Lock()
+    self.flusher = None
+
+  def register(self, metric):
+    existing = self.metrics.get(metric.name)
+    if existing is not None:
+      return existing
+    self.metrics[metric.name] = metric
+    return metric
+
+  def shard(self):
+    try:
+      return self.local.shard
+    except AttributeError:
+      shard = self.local.shard = {}
+      with self.lock:
+        self.shards.append((threading.current_thread(), shard))
+      return shard
+
+  def snapshot(self):
+    snapshot = Snapshot()
+    with self.lock:
+      live = []
+      for thread, shard in self.shards:
+        # dict() and list() copies are atomic under the GIL, so the owning
+        # thread can keep recording while this one reads
+        values = self.split(dict(shard))
+        if thread.is_alive():
+          live.append((thread, shard))
+          snapshot.add(values)
+        else:
+          self.retired.add(values)
+      self.shards = live
+      snapshot.add(self.retired)
+    for collect in self.collectors:
+      try:
+        for metric, labels, value in collect():
+          if value is None:
+            continue
+          target = snapshot.gauges if metric.kind == 'gauge' else snapshot.counters
+          target[(metric.name, tuple(labels))] = value
+      except Exception:
+        # a collector must never break the scrape (e.g. the pool is closing)
+        continue
+    return snapshot
+
+  def split(self, values):
+    snapshot = Snapshot()
+    for key, value in values.items():
+      if isinstance(value, list):
+        snapshot.histograms[key] = list(value)
+      else:
+        snapshot.counters[key] = value
+    return snapshot
+
+registry = Registry()
+
+def counter(name, help, labels=()):
+  return registry.register(Counter(registry, name, help, labels))
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+  return registry.register(Histogram(registry, name, help, labels, buckets))
+
+def gauge(name, help, labels=()):
+  return registry.register(Gauge(registry, name, help, labels))
+
+def collector(fn):
+  registry.collectors.append(fn)
+  return fn
+
+def register_stats(subsystem, stats, counters=(), gauges=()):
+  """Exposes keys of an existing stats() dict as <subsystem>_<key>[_total]."""
+  metrics = [(key, counter(f"{subsystem}_{key}_total", f"{subsystem} {key}")) for key in counters]
+  metrics += [(key, gauge(f"{subsystem}_{key}", f"{subsystem} {key}")) for key in gauges]
+  def collect():
+    values = stats()
+    return [(metric, (), values.get(key, 0)) for key, metric in metrics]
+  collector(collect)
+
+# ------------------------------------------------------------ workers
+
+def snapshot_path(pid):
+  return os.path.join(METRICS_DIR, f"{pid}.json")
+
+def write_json(path, data):
+  tmp = f"{path}.{os.getpid()}.tmp"
+  with open(tmp, 'w') as f:
+    json.dump(data, f, separators=(',', ':'))
+  os.replace(tmp, path)
+
+def read_json(path):
+  try:
+    with open(path) as f:
+      return Snapshot.from_json(json.load(f))
+  except (OSError, ValueError):
+    return Snapshot()
+
+def write_snapshot(snapshot=None):
+  if not METRICS_DIR:
+    return
+  snapshot = snapshot if snapshot is not None else registry.snapshot()
+  os.makedirs(METRICS_DIR, exist_ok=True)
+  write_json(snapshot_path(os.getpid()), snapshot.to_json())
+
+def alive(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+def aggregate():
+  """This process's snapshot summed with the other workers' (METRICS_DIR)."""
+  own = registry.snapshot()
+  if not METRICS_DIR:
+    return own
+  write_snapshot(own)
+  total = Snapshot()
+  with open(os.path.join(METRICS_DIR, '.lock'), 'a') as lock:
+    # one scrape at a time folds exited workers into the archive
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    archive_path = os.path.join(METRICS_DIR, ARCHIVE)
+    archive = read_json(archive_path)
+    dead = []
+    for filename in os.listdir(METRICS_DIR):
+      stem, ext = os.path.splitext(filename)
+      if ext != '.json' or not stem.isdigit():
+        continue
+      pid = int(stem)
+      if pid == os.getpid():
+        total.add(own)
+      elif alive(pid):
+        total.add(read_json(os.path.join(METRICS_DIR, filename)))
+      else:
+        archive.add(read_json(os.path.join(METRICS_DIR, filename)), gauges=False)
+        dead.append(filename)
+    if dead:
+      write_json(archive_path, archive.to_json())
+      for filename in dead:
+        os.unlink(os.path.join(METRICS_DIR, filename))
+  total.add(archive, gauges=False)
+  return total
+
+def clear_dir():
+  """Called by gunicorn.conf.py when gunicorn starts: forget earlier runs."""
+  if not METRICS_DIR or not os.path.isdir(METRICS_DIR):
+    return
+  for filename in os.listdir(METRICS_DIR):
+    if filename.endswith('.json') or filename.endswith('.tmp'):
+      os.unlink(os.path.join(METRICS_DIR, filename))
+
+def flush_forever():
+  while True:
+    time.sleep(METRICS_FLUSH_INTERVAL)
+    try:
+      write_snapshot()
+    except OSError:
+      pass
+
+def start_flusher():
+  if not METRICS_DIR:
+    return
+  with registry.lock:
+    if registry.flusher is None:
+      registry.flusher = threading.Thread(target=flush_forever, name='metrics-flush', daemon=True)
+      registry.flusher.start()
+
+# ------------------------------------------------------------ exposition
+
+def escape(value):
+  return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def label_text(names, values, extra=None):
+  pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+  if extra is not None:
+    pairs.append(extra)
+  return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def number(value):
+  if isinstance(value, float):
+    return repr(value) if value == value and value not in (float('inf'), float('-inf')) else 'NaN'
+  return str(value)
+
+def render(snapshot):
+  samples = {}
+  for values in (snapshot.counters, snapshot.histograms, snapshot.gauges):
+    for (name, labels), value in values.items():
+      samples.setdefault(name, []).append((labels, value))
+
+  lines = []
+  for name in sorted(samples):
+    metric = registry.metrics.get(name)
+    if metric is None:
+      continue
+    lines.append(f"# HELP {name} {metric.help}")
+    lines.append(f"# TYPE {name} {metric.kind}")
+    for labels, value in sorted(samples[name]):
+      if metric.kind == 'histogram':
+        cumulative = 0
+        for bound, count in zip(metric.buckets + (float('inf'),), value):
+          cumulative += count
+          le = '+Inf' if bound == float('inf') else repr(bound)
+          bucket_labels = label_text(metric.labels, labels, 'le="' + le + '"')
+          lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+        lines.append(f"{name}_sum{label_text(metric.labels, labels)} {number(float(value[-1]))}")
+        lines.append(f"{name}_count{label_text(metric.labels, labels)} {cumulative}")
+      else:
+        lines.append(f"{name}{label_text(metric.labels, labels)} {number(value)}")
+  return '\n'.join(lines) + '\n'
+
+def authorized():
+  if METRICS_TOKEN is None:
+    return request.remote_addr in LOOPBACK
+  scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+  return scheme.lower() == 'bearer' and hmac.compare_digest(token.strip().encode('utf-8'), METRICS_TOKEN.encode('utf-8'))
+
+def response():
+  if not authorized():
+    if METRICS_TOKEN is None:
+      return make_response('', 404)
+    result = make_response('', 401)
+    result.headers['WWW-Authenticate'] = 'Bearer realm="metrics"'
+    return result
+  result = make_response(render(aggregate()), 200)
+  result.headers['Content-Type'] = CONTENT_TYPE
+  result.headers['Cache-Control'] = 'no-store'
+  return result
+
+# ------------------------------------------------------------ http
+
+HTTP_REQUESTS = counter('http_requests_total', 'Requests answered, by route and status', ('method', 'route', 'status'))
+HTTP_DURATION = histogram('http_request_duration_seconds', 'Time to build the response, by route', ('method', 'route'))
+
+def observe_request(method, route, status, seconds):
+  # unmatched paths (404s, scanners) share one label so they cannot grow the registry
+  route = route if route is not None else '<unmatched>'
+  HTTP_REQUESTS.inc(method, route, str(status))
+  HTTP_DURATION.observe(seconds, method, route)
+
+# the log pipeline has no dependencies of its own, so it is registered here
+register_stats('log', lib.log.stats,
+  counters=('enqueued', 'dropped', 'shipped', 'ship_errors'),
+  gauges=('queue_depth', 'queue_size'))
+
+def init_app(app):
+  on_worker_start(start_flusher)
+  if METRICS_ENABLED:
+    app.add_url_rule('/metrics', 'metrics', response)
@@ -0,0 +1,259 @@
+import atexit
+import collections
+import os
+import threading
+import time
+
+from lib.log import get_logger
+import lib.metrics
+
+LOGGER = get_logger(__name__)
+
+# Notification writes, batched off the request path.
+#
+#   lib.notifications.notify('reply', actor_uuid, activity_uuid=parent, reply_uuid=reply)
+#   lib.notifications.notify('like', actor_uuid, activity_uuid=liked)
+#   lib.notifications.notify('message', actor_uuid, user_uuid=receiver,
+#     message_group_uuid=group, message=text)
+#
+# Without user_uuid the notification goes to the author of activity_uuid.
+# Nobody is notified of their own reply or like.
+#
+# Requests only append to a per-worker queue; one thread per worker writes
+# it every NOTIFICATIONS_FLUSH_INTERVAL seconds in one transaction: the
+# activities and replies the batch refers to are locked FOR KEY SHARE (what
+# the foreign key check takes), and notifications of those deleted or
+# expired meanwhile are skipped; recipients are resolved with one query,
+# each recipient's unread counter in
+# notification_counts goes up by what they got (so the unread badge is a
+# primary key lookup, never a COUNT(*)), then the rows are inserted with one
+# INSERT .. SELECT FROM unnest(..). The counters are bumped before the rows
+# are inserted and rows take clock_timestamp(), so a concurrent "mark all
+# read" (which sets read_at and zeroes the counter on the same row) either
+# sees the whole batch as unread or none of it.
+#
+# A failed flush keeps the batch for the next one. If Postgres refuses rows
+# of it anyway (a user deleted meanwhile, a bad uuid), the batch is written
+# again one notification at a time and only those it refuses are dropped.
+# The queue is written when a worker exits (gunicorn worker_exit,
+# atexit) and holds at most NOTIFICATIONS_QUEUE_MAX entries; beyond that the
+# oldest are dropped and counted.
+#
+# Environment:
+#   NOTIFICATIONS_FLUSH_INTERVAL  seconds between flushes (default 1)
+#   NOTIFICATIONS_QUEUE_MAX       queued notifications per worker (default 10000)
+
+NOTIFICATIONS_FLUSH_INTERVAL = float(os.getenv('NOTIFICATIONS_FLUSH_INTERVAL', '1'))
+NOTIFICATIONS_QUEUE_MAX = int(os.getenv('NOTIFICATIONS_QUEUE_MAX', '10000'))
+MESSAGE_PREVIEW_CHARS = 280
+
+KINDS = ('reply', 'like', 'message')
+
+EXISTING_SQL = """
+  SELECT uuid FROM public.activities
+  WHERE uuid = ANY(%(uuids)s::uuid[])
+  FOR KEY SHARE
+"""
+
+RESOLVE_SQL = """
+  SELECT COALESCE(events.user_uuid, activities.user_uuid)
+  FROM unnest(%(user_uuids)s::uuid[], %(activity_uuids)s::uuid[]) WITH ORDINALITY
+    AS events (user_uuid, activity_uuid, n)
+  LEFT JOIN public.activities ON activities.uuid = events.activity_uuid
+  ORDER BY events.n
+"""
+
+COUNT_SQL = """
+  INSERT INTO public.notification_counts AS counts (user_uuid, unread)
+  SELECT * FROM unnest(%(user_uuids)s::uuid[], %(unread)s::int[])
+  ON CONFLICT (user_uuid) DO UPDATE SET unread = counts.unread + EXCLUDED.unread
+"""
+
+INSERT_SQL = """
+  INSERT INTO public.notifications
+    (user_uuid, kind, actor_uuid, activity_uuid, reply_uuid, message_group_uuid, message)
+  SELECT * FROM unnest(
+    %(user_uuids)s::uuid[], %(kinds)s::text[], %(actor_uuids)s::uuid[], %(activity_uuids)s::uuid[],
+    %(reply_uuids)s::uuid[], %(message_group_uuids)s::text[], %(messages)s::text[]
+  )
+"""
+
+class Notification:
+  __slots__ = ('kind', 'actor_uuid', 'user_uuid', 'activity_uuid', 'reply_uuid', 'message_group_uuid', 'message')
+
+  def __init__(self, kind, actor_uuid, user_uuid=None, activity_uuid=None, reply_uuid=None,
+               message_group_uuid=None, message=None):
+    self.kind = kind
+    self.actor_uuid = str(actor_uuid)
+    self.user_uuid = str(user_uuid) if user_uuid is not None else None
+    self.activity_uuid = str(activity_uuid) if activity_uuid is not None else None
+    self.reply_uuid = str(reply_uuid) if reply_uuid is not None else None
+    self.message_group_uuid = message_group_uuid
+    self.message = message[:MESSAGE_PREVIEW_CHARS] if message is not None else None
+
+class NotificationQueue:
+  def __init__(self, interval=NOTIFICATIONS_FLUSH_INTERVAL, max_size=NOTIFICATIONS_QUEUE_MAX):
+    self.interval = interval
+    self.max_size = max_size
+    self.reset()
+    os.register_at_fork(after_in_child=self.reset)
+
+  def reset(self):
+    # also run in a forked worker: it queues and writes its own
+    self.queue = collections.deque()
+    self.lock = threading.Lock()
+    self.flush_lock = threading.Lock()
+    self.thread = None
+    self.counts = {'queued': 0, 'written': 0, 'skipped': 0, 'dropped': 0, 'flushes': 0, 'flush_errors': 0}
+
+  def put(self, notification):
+    with self.lock:
+      self.queue.append(notification)
+      self.counts['queued'] += 1
+      while len(self.queue) > self.max_size:
+        self.queue.popleft()
+        self.counts['dropped'] += 1
+      if self.thread is None:
+        self.thread = threading.Thread(target=self.run_forever, name='notifications-flush', daemon=True)
+        self.thread.start()
+
+  def flush(self):
+    with self.flush_lock:
+      with self.lock:
+        batch = list(self.queue)
+        self.queue.clear()
+      if not batch:
+        return 0
+      try:
+        written = self.write(batch)
+        skipped = len(batch) - written
+      except Exception as e:
+        self.counts['flush_errors'] += 1
+        if not is_data_error(e):
+          LOGGER.warning("notification flush failed, keeping %d: %s", len(batch), e)
+          self.requeue(batch)
+          return 0
+        LOGGER.warning("notification batch refused, writing its %d one by one: %s", len(batch), e)
+        written, skipped = self.write_each(batch)
+      self.counts['flushes'] += 1
+      self.counts['written'] += written
+      self.counts['skipped'] += skipped
+      return written
+
+  def write_each(self, batch):
+    """
+    Writes batch one notification per transaction, dropping those refused.
+    Returns (written, skipped) like a flush of the whole batch.
+    """
+    written = skipped = 0
+    for i, notification in enumerate(batch):
+      try:
+        if self.write([notification]):
+          written += 1
+        else:
+          skipped += 1
+      except Exception as e:
+        if not is_data_error(e):
+          LOGGER.warning("notification flush failed, keeping %d: %s", len(batch) - i, e)
+          self.requeue(batch[i:])
+          break
+        LOGGER.warning("dropping a %s notification that cannot be stored: %s", notification.kind, e)
+        self.counts['dropped'] += 1
+    return written, skipped
+
+  def write(self, batch):
+    from lib.db import db
+    with db.pool.connection() as conn:
+      with conn.transaction():
+        # held until commit: none of these can be deleted under the INSERT
+        referenced = {n.activity_uuid for n in batch} | {n.reply_uuid for n in batch}
+        referenced.discard(None)
+        existing = {str(row[0]) for row in conn.execute(EXISTING_SQL, {
+          'uuids': sorted(referenced)
+        }).fetchall()}
+        recipients = [row[0] for row in conn.execute(RESOLVE_SQL, {
+          'user_uuids': [n.user_uuid for n in batch],
+          'activity_uuids': [n.activity_uuid for n in batch]
+        }).fetchall()]
+        rows = []
+        for notification, recipient in zip(batch, recipients):
+          # the activity or reply is gone, or the user acted on their own
+          if recipient is None or str(recipient) == notification.actor_uuid:
+            continue
+          if any(uuid is not None and uuid not in existing
+                 for uuid in (notification.activity_uuid, notification.reply_uuid)):
+            continue
+          rows.append((str(recipient), notification))
+        if not rows:
+          return 0
+        unread = collections.Counter(recipient for recipient, _ in rows)
+        user_uuids = sorted(unread)  # same lock order in every worker
+        conn.execute(COUNT_SQL, {
+          'user_uuids': user_uuids,
+          'unread': [unread[user_uuid] for user_uuid in user_uuids]
+        })
+        conn.execute(INSERT_SQL, {
+          'user_uuids': [recipient for recipient, _ in rows],
+          'kinds': [n.kind for _, n in rows],
+          'actor_uuids': [n.actor_uuid for _, n in rows],
+          'activity_uuids': [n.activity_uuid for _, n in rows],
+          'reply_uuids': [n.reply_uuid for _, n in rows],
+          'message_group_uuids': [n.message_group_uuid for _, n in rows],
+          'messages': [n.message for _, n in rows]
+        })
+    return len(rows)
+
+  def requeue(self, batch):
+    with self.lock:
+      self.queue.extendleft(reversed(batch))
+      while len(self.queue) > self.max_size:
+        self.queue.popleft()
+        self.counts['dropped'] += 1
+
+  def run_forever(self):
+    while True:
+      time.sleep(self.interval)
+      try:
+        self.flush()
+      except Exception as e:
+        LOGGER.warning("notification flush failed: %s", e)
+
+  def stats(self):
+    with self.lock:
+      stats = dict(self.counts)
+      stats['pending'] = len(self.queue)
+    return stats
+
+def is_data_error(e):
+  # rows Postgres refuses (a foreign key that no longer exists, a bad uuid)
+  # fail the same way on every retry
+  try:
+    import psycopg
+  except ImportError:
+    return False
+  return isinstance(e, (psycopg.errors.IntegrityError, psycopg.errors.DataError))
+
+queue = NotificationQueue()
+
+def notify(kind, actor_uuid, **fields):
+  if kind not in KINDS:
+    raise ValueError(f"unknown notification kind {kind!r}")
+  if actor_uuid is None:
+    return
+  queue.put(Notification(kind, actor_uuid, **fields))
+
+def flush():
+  try:
+    return queue.flush()
+  except Exception as e:
+    LOGGER.warning("notification flush failed: %s", e)
+    return 0
+
+def stats():
+  return queue.stats()
+
+atexit.register(flush)
+
+lib.metrics.register_stats('notifications', stats,
+  counters=('queued', 'written', 'skipped', 'dropped', 'flushes', 'flush_errors'),
+  gauges=('pending',))
@@ -0,0 +1,415 @@
+import collections
+import contextvars
+import os
+import queue
+import random
+import threading
+import time
+from functools import wraps
+from flask import request
+
+from lib.log import get_logger
+from lib.process import on_worker_start
+import lib.metrics
+
+LOGGER = get_logger(__name__)
+
+# Request tracing: one facade, one backend, sampled at the head and the tail.
+#
+#   lib.observability.init_app(app)
+#
+#   @app.route("/api/activities/home")
+#   @capture('activities_home')             # a span around the endpoint
+#   def data_home(): ...
+#
+#   with span('db.query_array_json') as s:
+#     s.set('db.rows', len(rows))           # no-op when the request is not traced
+#
+# Every traced request records its spans in memory on the request thread:
+# a few small objects and perf_counter_ns() calls, nothing else
+# (bin/bench/tracing checks that against TRACE_OVERHEAD_BUDGET_US). When the
+# request ends the trace is kept or dropped:
+#
+#   head sampling  each route is sampled at its TRACE_SAMPLE_RATES rate
+#                  (TRACE_SAMPLE_RATE otherwise) or when the upstream trace
+#                  header says it is sampled
+#   tail sampling  a trace the head did not pick is still kept when the
+#                  request failed (5xx or an exception) or took longer than
+#                  TRACE_SLOW_MS
+#
+# Kept traces go into a bounded buffer; a background exporter thread turns
+# them into spans of the one configured backend (TRACING_BACKEND) and sends
+# them. The SDKs are imported on that thread, so they cost nothing at import
+# time, and with gunicorn --preload it is started per worker
+# (lib/process.py). A full buffer drops traces instead of blocking requests.
+#
+# Environment:
+#   OBSERVABILITY_ENABLED      0 turns tracing off entirely (default 1)
+#   TRACING_BACKEND            otel (OTLP over HTTP, OTEL_EXPORTER_OTLP_*) |
+#                              xray (X-Ray daemon, AWS_XRAY_DAEMON_ADDRESS) |
+#                              none (default otel)
+#   TRACE_SAMPLE_RATE          head sampling rate of other routes (default 0.05)
+#   TRACE_SAMPLE_RATES         per route rates, e.g.
+#                              "/api/activities/home=0.1,/api/health-check=0";
+#                              a rate of 0 does not trace the route at all
+#                              (default: health checks, /api/stream, /metrics)
+#   TRACE_TAIL_SAMPLING        0 records only head-sampled requests (default 1)
+#   TRACE_SLOW_MS              duration kept by tail sampling (default 500)
+#   TRACE_BUFFER_SIZE          kept traces waiting for export (default 1000)
+
+OBSERVABILITY_ENABLED = os.getenv('OBSERVABILITY_ENABLED', '1') == '1'
+TRACING_BACKEND = os.getenv('TRACING_BACKEND', 'otel')
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0.05'))
+TRACE_TAIL_SAMPLING = os.getenv('TRACE_TAIL_SAMPLING', '1') == '1'
+TRACE_SLOW_MS = float(os.getenv('TRACE_SLOW_MS', '500'))
+TRACE_BUFFER_SIZE = int(os.getenv('TRACE_BUFFER_SIZE', '1000'))
+TRACE_MAX_SPANS = 128  # per trace, so a loop of queries cannot grow one without bound
+EXPORT_BATCH = 100
+
+def parse_rates(value):
+  rates = {}
+  for part in value.split(','):
+    if '=' in part:
+      route, rate = part.rsplit('=', 1)
+      rates[route.strip()] = float(rate)
+  return rates
+
+TRACE_SAMPLE_RATES = parse_rates(os.getenv('TRACE_SAMPLE_RATES', '/api/health-check=0,/api/health-check/ready=0,/api/stream=0,/metrics=0'))
+
+ready = threading.Event()
+_current = contextvars.ContextVar('trace', default=None)
+
+class Span:
+  __slots__ = ('name', 'start_ns', 'end_ns', 'attributes', 'children', 'error')
+
+  def __init__(self, name, start_ns):
+    self.name = name
+    self.start_ns = start_ns
+    self.end_ns = None
+    self.attributes = None
+    self.children = []
+    self.error = None
+
+  def set(self, key, value):
+    if self.attributes is None:
+      self.attributes = {}
+    self.attributes[key] = value
+
+class NoopSpan:
+  __slots__ = ()
+
+  def set(self, key, value):
+    pass
+
+NOOP_SPAN = NoopSpan()
+
+class Trace:
+  __slots__ = ('root', 'stack', 'span_count', 'epoch_ns', 'perf_ns', 'sampled',
+               'upstream', 'status', 'error', 'kept_because')
+
+  def __init__(self, name, sampled, upstream=None):
+    # one wall clock reading per trace; spans use the monotonic clock
+    self.epoch_ns = time.time_ns()
+    self.perf_ns = time.perf_counter_ns()
+    self.root = Span(name, self.perf_ns)
+    self.stack = [self.root]
+    self.span_count = 1
+    self.sampled = sampled
+    self.upstream = upstream or {}
+    self.status = None
+    self.error = None
+    self.kept_because = None
+
+  def wall_ns(self, perf_ns):
+    return self.epoch_ns + (perf_ns - self.perf_ns)
+
+class SpanScope:
+  __slots__ = ('name', 'trace', 'span')
+
+  def __init__(self, name):
+    self.name = name
+
+  def __enter__(self):
+    trace = self.trace = _current.get()
+    if trace is None or trace.span_count >= TRACE_MAX_SPANS:
+      self.span = None
+      return NOOP_SPAN
+    span = self.span = Span(self.name, time.perf_counter_ns())
+    trace.stack[-1].children.append(span)
+    trace.stack.append(span)
+    trace.span_count += 1
+    return span
+
+  def __exit__(self, exc_type, exc, tb):
+    span = self.span
+    if span is not None:
+      span.end_ns = time.perf_counter_ns()
+      if exc is not None:
+        span.error = f"{exc_type.__name__}: {exc}"
+      self.trace.stack.pop()
+    return False
+
+def span(name):
+  return SpanScope(name)
+
+def capture(name):
+  def decorator(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+      with SpanScope(name):
+        return fn(*args, **kwargs)
+    return wrapper
+  return decorator
+
+def current_trace():
+  return _current.get()
+
+# ------------------------------------------------------------ sampling
+
+def route_rate(route):
+  return TRACE_SAMPLE_RATES.get(route, TRACE_SAMPLE_RATE)
+
+def upstream_context(headers):
+  upstream = {}
+  amzn = headers.get('X-Amzn-Trace-Id')
+  if amzn:
+    for part in amzn.split(';'):
+      key, _, value = part.partition('=')
+      upstream[key.strip()] = value.strip()
+  traceparent = headers.get('traceparent')
+  if traceparent:
+    upstream['traceparent'] = traceparent
+  return upstream
+
+def upstream_sampled(upstream):
+  traceparent = upstream.get('traceparent')
+  return upstream.get('Sampled') == '1' or (traceparent is not None and traceparent.endswith('-01'))
+
+def start_trace(name, rate, upstream=None):
+  """Starts recording on this thread; None if the request is not traced at all."""
+  if rate <= 0:
+    return None
+  sampled = random.random() < rate or (upstream is not None and upstream_sampled(upstream))
+  if not sampled and not TRACE_TAIL_SAMPLING:
+    _stats.count('not_recorded')
+    return None
+  trace = Trace(name, sampled, upstream)
+  _current.set(trace)
+  return trace
+
+def finish_trace(trace, status=None, error=None):
+  _current.set(None)
+  root = trace.root
+  root.end_ns = time.perf_counter_ns()
+  trace.status = status
+  trace.error = error
+  if trace.sampled:
+    trace.kept_because = 'head'
+  elif error is not None or (status is not None and status >= 500):
+    trace.kept_because = 'error'
+  elif (root.end_ns - root.start_ns) >= TRACE_SLOW_MS * 1_000_000:
+    trace.kept_because = 'slow'
+  if trace.kept_because is None:
+    _stats.count('dropped')
+    return False
+  _stats.count(f"kept_{trace.kept_because}")
+  exporter.submit(trace)
+  return True
+
+# ------------------------------------------------------------ export
+
+class Stats:
+  def __init__(self):
+    self.reset()
+    os.register_at_fork(after_in_child=self.reset)
+
+  def reset(self):
+    self.counts = collections.Counter()
+    self.lock = threading.Lock()
+
+  def count(self, name, n=1):
+    with self.lock:
+      self.counts[name] += n
+
+  def snapshot(self):
+    with self.lock:
+      return dict(self.counts)
+
+_stats = Stats()
+
+def load_otel():
+  from opentelemetry import trace as otel_trace
+  from opentelemetry.sdk.trace import TracerProvider
+  from opentelemetry.sdk.trace.export import BatchSpanProcessor
+  from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+  from opentelemetry.trace import Status, StatusCode
+  from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapPropagator
+
+  # send traces to the OTEL Collector / Honeycomb (OTEL_EXPORTER_OTLP_*)
+  provider = TracerProvider()
+  provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+  tracer = provider.get_tracer('backend-flask')
+  propagator = TraceContextTextMapPropagator()
+
+  def emit(trace, span, context):
+    otel_span = tracer.start_span(span.name, context=context,
+      start_time=trace.wall_ns(span.start_ns), attributes=span.attributes)
+    if span.error is not None:
+      otel_span.set_status(Status(StatusCode.ERROR, span.error))
+    child_context = otel_trace.set_span_in_context(otel_span)
+    for child in span.children:
+      emit(trace, child, child_context)
+    otel_span.end(end_time=trace.wall_ns(span.end_ns or trace.root.end_ns))
+
+  def export(trace):
+    context = None
+    if 'traceparent' in trace.upstream:
+      context = propagator.extract({'traceparent': trace.upstream['traceparent']})
+    emit(trace, trace.root, context)
+
+  return export
+
+def load_xray():
+  from aws_xray_sdk.core.emitters.udp_emitter import UDPEmitter
+  from aws_xray_sdk.core.models.segment import Segment
+  from aws_xray_sdk.core.models.subsegment import Subsegment
+
+  emitter = UDPEmitter()  # AWS_XRAY_DAEMON_ADDRESS
+
+  def add_children(trace, segment, entity, span):
+    for child in span.children:
+      subsegment = Subsegment(child.name, 'local', segment)
+      entity.add_subsegment(subsegment)
+      subsegment.start_time = trace.wall_ns(child.start_ns) / 1e9
+      for key, value in (child.attributes or {}).items():
+        subsegment.put_metadata(key, value)
+      if child.error is not None:
+        subsegment.add_fault_flag()
+        subsegment.put_metadata('error', child.error)
+      add_children(trace, segment, subsegment, child)
+      subsegment.close(trace.wall_ns(child.end_ns or trace.root.end_ns) / 1e9)
+
+  def export(trace):
+    root = trace.root
+    segment = Segment('backend-flask', traceid=trace.upstream.get('Root'),
+      parent_id=trace.upstream.get('Parent'))
+    segment.start_time = trace.wall_ns(root.start_ns) / 1e9
+    attributes = root.attributes or {}
+    segment.put_http_meta('method', attributes.get('http.method'))
+    segment.put_http_meta('url', attributes.get('http.url'))
+    if trace.status is not None:
+      segment.put_http_meta('status', trace.status)
+      segment.apply_status_code(trace.status)
+    if trace.error is not None:
+      segment.add_fault_flag()
+    segment.put_annotation('route', attributes.get('http.route', ''))
+    segment.put_annotation('kept_because', trace.kept_because)
+    add_children(trace, segment, segment, root)
+    segment.close(trace.wall_ns(root.end_ns) / 1e9)
+    emitter.send_entity(segment)
+
+  return export
+
+BACKENDS = {
+  'otel': load_otel,
+  'xray': load_xray,
+  'none': lambda: (lambda trace: None)
+}
+
+class Exporter:
+  def __init__(self):
+    self.reset()
+    os.register_at_fork(after_in_child=self.reset)
+
+  def reset(self):
+    # also run in a forked worker: the buffer and thread are per process
+    self.buffer = queue.Queue(maxsize=TRACE_BUFFER_SIZE)
+    self.thread = None
+    self.lock = threading.Lock()
+
+  def start(self):
+    with self.lock:
+      if self.thread is None:
+        self.thread = threading.Thread(target=self.run, name='trace-exporter', daemon=True)
+        self.thread.start()
+
+  def submit(self, trace):
+    try:
+      self.buffer.put_nowait(trace)
+    except queue.Full:
+      _stats.count('dropped_buffer_full')
+
+  def run(self):
+    try:
+      export = BACKENDS[TRACING_BACKEND]()
+    except Exception as e:
+      LOGGER.warning("%s tracing initialization failed, continuing without it: %s", TRACING_BACKEND, e)
+      export = BACKENDS['none']()
+    ready.set()
+    while True:
+      batch = [self.buffer.get()]
+      while len(batch) < EXPORT_BATCH:
+        try:
+          batch.append(self.buffer.get_nowait())
+        except queue.Empty:
+          break
+      for trace in batch:
+        try:
+          export(trace)
+          _stats.count('exported')
+        except Exception as e:
+          _stats.count('export_errors')
+          LOGGER.warning("trace export failed: %s", e)
+
+exporter = Exporter()
+
+# ------------------------------------------------------------ flask
+
+def before_request():
+  route = request.url_rule.rule if request.url_rule is not None else request.path
+  trace = start_trace(f"{request.method} {route}", route_rate(route), upstream_context(request.headers))
+  if trace is not None:
+    root = trace.root
+    root.set('http.method', request.method)
+    root.set('http.route', route)
+    root.set('http.url', request.base_url)
+
+def after_request(response):
+  trace = _current.get()
+  if trace is not None:
+    trace.status = response.status_code
+    trace.root.set('http.status_code', response.status_code)
+  return response
+
+def teardown_request(exception):
+  trace = _current.get()
+  if trace is not None:
+    error = f"{type(exception).__name__}: {exception}" if exception is not None else None
+    finish_trace(trace, trace.status, error)
+
+def init_app(app):
+  if not OBSERVABILITY_ENABLED:
+    ready.set()
+    return
+  app.before_request(before_request)
+  app.after_request(after_request)
+  app.teardown_request(teardown_request)
+  on_worker_start(exporter.start)
+
+def wait(timeout=None):
+  """Blocks until the tracing backend is loaded (scripts and benchmarks)."""
+  return ready.wait(timeout)
+
+def stats():
+  stats = _stats.snapshot()
+  stats['buffered'] = exporter.buffer.qsize()
+  return stats
+
+TRACES = lib.metrics.counter('traces_total', 'Traces by outcome (kept_head, kept_error, kept_slow, dropped, exported, ...)', ('outcome',))
+BUFFERED = lib.metrics.gauge('traces_buffered', 'Kept traces waiting for export')
+
+@lib.metrics.collector
+def collect():
+  samples = [(TRACES, (outcome,), count) for outcome, count in _stats.snapshot().items()]
+  samples.append((BUFFERED, (), exporter.buffer.qsize()))
+  return samples
@@ -0,0 +1,32 @@
+import os
+
+# Per-worker startup for gunicorn --preload.
+#
+# With GUNICORN_PRELOAD=1 (see bin/docker/entrypoint-prod, gunicorn.conf.py)
+# app.py is imported once in the gunicorn master and the workers are forked
+# from it, so the imported code is shared copy-on-write instead of being
+# loaded and kept by every worker. Nothing that owns a socket or a thread may
+# be created in the master: the Db pool, boto3 clients, the OTel
+# BatchSpanProcessor and the log shipper are created lazily per process (and
+# reset by os.register_at_fork in a forked child), and the background
+# warm-ups app.py starts at import are deferred to every worker:
+#
+#   lib.process.on_worker_start(db.start_background_open)
+#
+# Without preload (flask run, plain gunicorn) on_worker_start just runs the
+# callback, since the importing process is the worker.
+
+PRELOAD = os.getenv('GUNICORN_PRELOAD', '0') == '1'
+
+_worker_hooks = []
+
+def on_worker_start(fn):
+  if PRELOAD:
+    _worker_hooks.append(fn)
+  else:
+    fn()
+
+def worker_started():
+  """Called from gunicorn.conf.py post_fork, in the new worker."""
+  for fn in _worker_hooks:
+    fn()
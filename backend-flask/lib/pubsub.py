@@ -0,0 +1,169 @@
+import collections
+import json
+import os
+import threading
+import time
+
+from lib.log import get_logger
+
+LOGGER = get_logger(__name__)
+
+# Publish/subscribe used to push new messages to open /api/stream
+# connections instead of having clients poll.
+#
+#   broker().publish('user:<uuid>', {'type': 'message', ...})
+#   sub = broker().subscribe(['user:<uuid>'])
+#   event = sub.get(timeout=15)      # None on timeout, raises Overflow
+#   broker().unsubscribe(sub)
+#
+# Backends (PUBSUB_BACKEND):
+#   memory   - in-process only (default). Fine for a single task/worker.
+#   postgres - fans events out through Postgres LISTEN/NOTIFY so every
+#              gunicorn worker in every ECS task sees every event.
+
+PUBSUB_BACKEND = os.getenv('PUBSUB_BACKEND', 'memory')
+PUBSUB_QUEUE_SIZE = int(os.getenv('PUBSUB_QUEUE_SIZE', '100'))
+PUBSUB_CHANNEL = 'cruddur_events'
+
+class Overflow(Exception):
+  """The subscriber fell more than PUBSUB_QUEUE_SIZE events behind."""
+  pass
+
+class Subscription:
+  def __init__(self, topics, maxsize):
+    self.topics = set(topics)
+    self.maxsize = maxsize
+    self.events = collections.deque()
+    self.overflowed = False
+    self.condition = threading.Condition()
+
+  def put(self, event):
+    with self.condition:
+      if self.overflowed:
+        return
+      if len(self.events) >= self.maxsize:
+        # backpressure: a slow consumer is cut loose rather than buffering
+        # without bound; the stream tells the client to resync via REST
+        self.overflowed = True
+        self.events.clear()
+      else:
+        self.events.append(event)
+      self.condition.notify()
+
+  def get(self, timeout=None):
+    with self.condition:
+      if not self.events and not self.overflowed:
+        self.condition.wait(timeout)
+      if self.overflowed:
+        raise Overflow()
+      if self.events:
+        return self.events.popleft()
+      return None
+
+class InProcessBroker:
+  def __init__(self, queue_size=PUBSUB_QUEUE_SIZE):
+    self.queue_size = queue_size
+    self.topics = {}
+    self.lock = threading.Lock()
+
+  def subscribe(self, topics):
+    subscription = Subscription(topics, self.queue_size)
+    with self.lock:
+      for topic in subscription.topics:
+        self.topics.setdefault(topic, set()).add(subscription)
+    return subscription
+
+  def unsubscribe(self, subscription):
+    with self.lock:
+      for topic in subscription.topics:
+        subscribers = self.topics.get(topic)
+        if subscribers is not None:
+          subscribers.discard(subscription)
+          if not subscribers:
+            del self.topics[topic]
+
+  def subscriber_count(self):
+    with self.lock:
+      return sum(len(s) for s in self.topics.values())
+
+  def publish(self, topic, event):
+    self.deliver(topic, event)
+
+  def deliver(self, topic, event):
+    with self.lock:
+      subscribers = list(self.topics.get(topic, ()))
+    for subscription in subscribers:
+      subscription.put(event)
+
+class PostgresBroker(InProcessBroker):
+  """
+  publish() does a pg_notify on the shared pool; a listener thread holding a
+  dedicated LISTEN connection delivers every notification to local
+  subscribers, including the ones in the publishing process.
+  """
+  RECONNECT_DELAY = 2
+
+  def __init__(self, connection_url=None, queue_size=PUBSUB_QUEUE_SIZE):
+    super().__init__(queue_size)
+    self.connection_url = connection_url or os.getenv('CONNECTION_URL')
+    self.listener = None
+    self.listener_lock = threading.Lock()
+
+  def subscribe(self, topics):
+    self.ensure_listener()
+    return super().subscribe(topics)
+
+  def publish(self, topic, event):
+    from lib.db import db
+    payload = json.dumps({'topic': topic, 'event': event}, default=str)
+    with db.pool.connection() as conn:
+      conn.execute('SELECT pg_notify(%s, %s)', (PUBSUB_CHANNEL, payload))
+
+  def ensure_listener(self):
+    with self.listener_lock:
+      if self.listener is None or not self.listener.is_alive():
+        self.listener = threading.Thread(target=self.listen, name='pubsub-listener', daemon=True)
+        self.listener.start()
+
+  def listen(self):
+    import psycopg
+    while True:
+      try:
+        with psycopg.connect(self.connection_url, autocommit=True) as conn:
+          conn.execute(f"LISTEN {PUBSUB_CHANNEL}")
+          for notify in conn.notifies():
+            message = json.loads(notify.payload)
+            self.deliver(message['topic'], message['event'])
+      except Exception as e:
+        LOGGER.warning("pubsub listener error, reconnecting: %s", e)
+        time.sleep(self.RECONNECT_DELAY)
+
+BACKENDS = {
+  'memory': InProcessBroker,
+  'postgres': PostgresBroker
+}
+
+_broker = None
+_broker_lock = threading.Lock()
+
+def _after_fork():
+  # subscriptions and the LISTEN thread belong to the parent process
+  global _broker, _broker_lock
+  _broker = None
+  _broker_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+def broker():
+  global _broker
+  with _broker_lock:
+    if _broker is None:
+      _broker = BACKENDS[PUBSUB_BACKEND]()
+    return _broker
+
+def publish(topic, event):
+  """Best effort: a pub/sub failure must never fail the write that triggered it."""
+  try:
+    broker().publish(topic, event)
+  except Exception as e:
+    LOGGER.warning("pubsub publish to %s failed: %s", topic, e)
@@ -0,0 +1,223 @@
+import collections
+import math
+import os
+import threading
+import time
+from functools import wraps
+from flask import make_response, request
+
+from lib.auth import verify_request
+from lib.log import get_logger
+import lib.metrics
+
+LOGGER = get_logger(__name__)
+
+# Token-bucket rate limits for the write endpoints.
+#
+#   @app.route("/api/messages", methods=['POST','OPTIONS'])
+#   @cross_origin()
+#   @authenticate(AUTH_REQUIRED)
+#   @rate_limit('create_message')
+#   def data_create_message(): ...
+#
+# Each rule is a bucket of `burst` tokens refilled evenly over `period`
+# seconds; a request takes one token or gets 429 with Retry-After. Buckets are
+# keyed per rule by the verified user (claims sub) or, for anonymous
+# requests, by client IP. Every limited response carries the IETF
+# RateLimit-Limit / RateLimit-Remaining / RateLimit-Reset / RateLimit-Policy
+# headers.
+#
+# Backends (RATE_LIMIT_BACKEND):
+#   memory   - buckets in the process (default). Every gunicorn worker and
+#              ECS task keeps its own, so a client may get the limit once
+#              per worker.
+#   postgres - one bucket row per key in the unlogged rate_limit_buckets
+#              table (db/migrations), taken with a single atomic upsert, so
+#              the limit holds across workers and tasks. If Postgres cannot
+#              be reached the request is let through (fail open).
+#
+# Environment:
+#   RATE_LIMIT_ENABLED         0 disables limiting (default 1)
+#   RATE_LIMIT_BACKEND         memory | postgres (default memory)
+#   RATE_LIMIT_<RULE>          burst/period, e.g. RATE_LIMIT_CREATE_ACTIVITY=30/60
+#   RATE_LIMIT_MAX_KEYS        buckets kept by the memory backend (default 10000)
+#   RATE_LIMIT_TRUSTED_PROXIES proxies in front of the app that append to
+#                              X-Forwarded-For, e.g. 1 behind the ALB (default 0:
+#                              use the peer address)
+
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', '1') == '1'
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_MAX_KEYS = int(os.getenv('RATE_LIMIT_MAX_KEYS', '10000'))
+RATE_LIMIT_TRUSTED_PROXIES = int(os.getenv('RATE_LIMIT_TRUSTED_PROXIES', '0'))
+
+# rule: (burst, period in seconds)
+DEFAULT_RULES = {
+  'create_activity': (30, 60),
+  'create_reply': (30, 60),
+  'react_activity': (120, 60),
+  'create_message': (60, 60),
+  'stream_ticket': (30, 60),
+  'update_profile': (10, 60)
+}
+
+class Rule:
+  def __init__(self, name, burst, period):
+    self.name = name
+    self.burst = burst
+    self.period = period
+    self.rate = burst / period  # tokens per second
+
+  def policy(self):
+    return f"{self.burst};w={self.period}"
+
+def parse_rule(name, default):
+  value = os.getenv(f"RATE_LIMIT_{name.upper()}")
+  if not value:
+    return Rule(name, *default)
+  try:
+    burst, period = value.split('/')
+    return Rule(name, int(burst), int(period))
+  except ValueError:
+    LOGGER.warning("ignoring RATE_LIMIT_%s=%r, expected burst/period", name.upper(), value)
+    return Rule(name, *default)
+
+RULES = {name: parse_rule(name, default) for name, default in DEFAULT_RULES.items()}
+
+DECISIONS = lib.metrics.counter('rate_limit_decisions_total', 'Rate limit checks, by rule and result', ('rule', 'result'))
+
+class Decision:
+  def __init__(self, rule, allowed, tokens):
+    self.rule = rule
+    self.allowed = allowed
+    self.remaining = max(0, math.floor(tokens))
+    # seconds until the next token and until the bucket is full again
+    self.retry_after = 0 if allowed else math.ceil((1 - tokens) / rule.rate)
+    self.reset = math.ceil((rule.burst - tokens) / rule.rate)
+
+  def headers(self):
+    headers = {
+      'RateLimit-Limit': str(self.rule.burst),
+      'RateLimit-Remaining': str(self.remaining),
+      'RateLimit-Reset': str(self.reset),
+      'RateLimit-Policy': self.rule.policy()
+    }
+    if not self.allowed:
+      headers['Retry-After'] = str(self.retry_after)
+    return headers
+
+class MemoryStore:
+  def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS):
+    self.max_keys = max_keys
+    self.buckets = collections.OrderedDict()  # key -> (tokens, updated_at)
+    self.lock = threading.Lock()
+
+  def take(self, key, rule, now=None):
+    now = time.monotonic() if now is None else now
+    with self.lock:
+      tokens, updated_at = self.buckets.pop(key, (rule.burst, now))
+      tokens = min(rule.burst, tokens + (now - updated_at) * rule.rate)
+      allowed = tokens >= 1
+      if allowed:
+        tokens -= 1
+      self.buckets[key] = (tokens, now)
+      if len(self.buckets) > self.max_keys:
+        # least recently used; a dropped bucket just starts full again
+        self.buckets.popitem(last=False)
+    return Decision(rule, allowed, tokens)
+
+class PostgresStore:
+  # refill and take in one statement: concurrent requests for the same key
+  # serialize on the row lock instead of racing a read-modify-write
+  REFILLED = "LEAST(%(burst)s, bucket.tokens + EXTRACT(EPOCH FROM now() - bucket.updated_at) * %(rate)s)"
+  SQL = f"""
+    INSERT INTO public.rate_limit_buckets AS bucket (key, tokens, allowed, updated_at)
+    VALUES (%(key)s, %(burst)s - 1, true, now())
+    ON CONFLICT (key) DO UPDATE SET
+      tokens = CASE WHEN {REFILLED} >= 1 THEN {REFILLED} - 1 ELSE {REFILLED} END,
+      allowed = {REFILLED} >= 1,
+      updated_at = now()
+    RETURNING bucket.tokens, bucket.allowed
+  """
+  PRUNE_EVERY = 1000
+
+  def __init__(self):
+    self.calls = 0
+
+  def take(self, key, rule):
+    from lib.db import db
+    self.calls += 1
+    with db.pool.connection() as conn:
+      tokens, allowed = conn.execute(self.SQL, {
+        'key': key,
+        'burst': rule.burst,
+        'rate': rule.rate
+      }).fetchone()
+      if self.calls % self.PRUNE_EVERY == 0:
+        # an idle bucket is full again; rows untouched for a day carry no state
+        conn.execute("DELETE FROM public.rate_limit_buckets WHERE updated_at < now() - interval '1 day'")
+    return Decision(rule, allowed, tokens)
+
+BACKENDS = {
+  'memory': MemoryStore,
+  'postgres': PostgresStore
+}
+
+_store = None
+_store_lock = threading.Lock()
+
+def _after_fork():
+  # a forked worker starts with its own (empty) buckets and an unheld lock
+  global _store, _store_lock
+  _store = None
+  _store_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+def store():
+  global _store
+  with _store_lock:
+    if _store is None:
+      _store = BACKENDS[RATE_LIMIT_BACKEND]()
+    return _store
+
+def client_ip():
+  if RATE_LIMIT_TRUSTED_PROXIES > 0:
+    # the last N X-Forwarded-For entries were appended by our own proxies;
+    # anything left of them is whatever the client chose to send
+    route = request.access_route
+    if len(route) >= RATE_LIMIT_TRUSTED_PROXIES:
+      return route[-RATE_LIMIT_TRUSTED_PROXIES]
+  return request.remote_addr
+
+def bucket_key(rule):
+  claims = verify_request()
+  if claims is not None:
+    return f"{rule.name}:user:{claims['sub']}"
+  return f"{rule.name}:ip:{client_ip()}"
+
+def check(rule):
+  try:
+    return store().take(bucket_key(rule), rule)
+  except Exception as e:
+    LOGGER.warning("rate limit store failed, allowing request: %s", e)
+    return None
+
+def rate_limit(name):
+  rule = RULES[name]
+  def decorator(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+      if not RATE_LIMIT_ENABLED or request.method == 'OPTIONS':
+        return fn(*args, **kwargs)
+      decision = check(rule)
+      if decision is None:
+        DECISIONS.inc(rule.name, 'store_failed')
+        return fn(*args, **kwargs)
+      DECISIONS.inc(rule.name, 'allowed' if decision.allowed else 'limited')
+      if not decision.allowed:
+        return {'errors': ['rate_limited']}, 429, decision.headers()
+      response = make_response(fn(*args, **kwargs))
+      response.headers.update(decision.headers())
+      return response
+    return wrapper
+  return decorator
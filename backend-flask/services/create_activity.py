@@ -2,6 +2,14 @@
 from datetime import datetime, timedelta, timezone 
 # Import the database utility object for executing SQL queries
 from lib.db import db 
+# Structured logger (lib/log.py); debug records cost nothing when disabled
+from lib.log import get_logger
+# Cached public responses that show the new activity (lib/cache.py)
+import lib.cache
+from services.home_activities import HomeActivities
+from services.user_activities import UserActivities
+
+LOGGER = get_logger(__name__)
 
 class CreateActivity:
   # @staticmethod decorator allows this method to be called without creating a class instance
@@ -9,14 +17,9 @@ class CreateActivity:
   @staticmethod
   def run(message, user_handle, ttl):
     # ============================================================
-    # DEBUG LOGGING: Print incoming parameters for troubleshooting
+    # DEBUG LOGGING: incoming parameters (free unless LOG_LEVEL=DEBUG)
     # ============================================================
-    print('='*60)
-    print('🔍 CreateActivity.run() called!')
-    print(f'   message: {message}')
-    print(f'   user_handle: {user_handle}')
-    print(f'   ttl: {ttl}')
-    print('='*60)
+    LOGGER.debug('CreateActivity.run() message=%r user_handle=%s ttl=%s', message, user_handle, ttl)
     
     # ============================================================
     # INITIALIZE RESPONSE MODEL
@@ -86,7 +89,7 @@ class CreateActivity:
     if model['errors']:
       # If there are validation errors, log them and return the invalid data
       # The frontend can use this to show error messages to the user
-      print(f'❌ Validation errors: {model["errors"]}')
+      LOGGER.debug('Validation errors: %s', model['errors'])
       model['data'] = {
         'handle':  user_handle,
         'message': message
@@ -95,15 +98,13 @@ class CreateActivity:
       # ============================================================
       # CREATE ACTIVITY IN DATABASE (Success Path)
       # ============================================================
-      print('✅ Validation passed, creating activity...')
-      
       # Calculate when the activity should expire
       # by adding the TTL offset to the current time
       expires_at = (now + ttl_offset)
       
       # Insert the activity into the database and get back its UUID
       uuid = CreateActivity.create_activity(user_handle, message, expires_at)
-      print(f'✅ Activity created with UUID: {uuid}')
+      LOGGER.debug('Activity created with UUID: %s', uuid)
       
       # Retrieve the complete activity object from the database
       # This includes all fields (user info, timestamps, etc.)
@@ -111,7 +112,10 @@ class CreateActivity:
       
       # Set the retrieved activity as the response data
       model['data'] = object_json
-      print(f'✅ Activity data retrieved: {object_json}')
+
+      # The public feed and the author's profile now show it
+      HomeActivities().changed()
+      lib.cache.invalidate(HomeActivities.CACHE_KEY, UserActivities.cache_key(user_handle))
     
     # ============================================================
     # RETURN RESPONSE MODEL
@@ -137,8 +141,6 @@ class CreateActivity:
     Returns:
         uuid: Unique identifier of the newly created activity
     """
-    print(f'🔍 Inserting into database...')
-    
     # Load the SQL template file for creating activities
     # This keeps SQL separate from Python code for better organization
     sql = db.template('activities','create')
@@ -171,8 +173,6 @@ class CreateActivity:
         JSON object containing the complete activity data including
         user information, message, timestamps, counts, etc.
     """
-    print(f'🔍 Querying activity with UUID: {uuid}')
-    
     # Load the SQL template for querying a single activity object
     sql = db.template('activities','object')
     
@@ -2,6 +2,11 @@ from datetime import datetime, timedelta, timezone
 
 from lib.db import db
 from lib.ddb import Ddb
+from lib.pubsub import publish
+from lib.log import get_logger
+import lib.notifications
+
+LOGGER = get_logger(__name__)
 
 class CreateMessage:
   # mode indicates if we want to create a new message_group or using an existing one
@@ -42,16 +47,11 @@ class CreateMessage:
         'cognito_user_id': cognito_user_id,
         'user_receiver_handle': rev_handle
       })
-      print("USERS =-=-=-=-==")
-      print(users)
 
       my_user    = next((item for item in users if item["kind"] == 'sender'), None)
       other_user = next((item for item in users if item["kind"] == 'recv')  , None)
 
-      print("USERS=[my-user]==")
-      print(my_user)
-      print("USERS=[other-user]==")
-      print(other_user)
+      LOGGER.debug("create_message users my_user=%s other_user=%s", my_user, other_user)
 
       ddb = Ddb.client()
 
@@ -76,4 +76,32 @@ class CreateMessage:
           other_user_handle=other_user['handle']
         )
       model['data'] = data
-    return model
\ No newline at end of file
+      CreateMessage.notify(ddb, mode, data, message, my_user, other_user)
+    return model
+
+  def notify(ddb, mode, data, message, my_user, other_user):
+    # push the new message to every participant's open /api/stream
+    if data is None:
+      return
+    if mode == "create":
+      user_uuids = [my_user['uuid'], other_user['uuid']]
+      created_at = datetime.now(timezone.utc).isoformat()
+    else:
+      user_uuids = Ddb.message_group_user_uuids(ddb, data['message_group_uuid'])
+      created_at = data['created_at']
+    event = {
+      'type': 'message',
+      'mode': mode,
+      'message_group_uuid': data['message_group_uuid'],
+      'uuid': my_user['uuid'],
+      'display_name': my_user['display_name'],
+      'handle': my_user['handle'],
+      'message': message,
+      'created_at': created_at
+    }
+    for user_uuid in user_uuids:
+      publish(f"user:{user_uuid}", event)
+      # and to their notifications inbox (lib/notifications.py)
+      if user_uuid != my_user['uuid']:
+        lib.notifications.notify('message', my_user['uuid'], user_uuid=user_uuid,
+          message_group_uuid=data['message_group_uuid'], message=message)
\ No newline at end of file
@@ -1,39 +1,69 @@
-import uuid
-from datetime import datetime, timedelta, timezone
+from lib.db import db
+from lib.log import get_logger
+import lib.cache
+import lib.counters
+import lib.notifications
+from services.home_activities import HomeActivities
+from services.show_activity import valid_uuid
+
+LOGGER = get_logger(__name__)
+
 class CreateReply:
-  def run(message, user_handle, activity_uuid):
+  def run(message, user_uuid, activity_uuid):
     model = {
       'errors': None,
       'data': None
     }
 
-    if user_handle == None or len(user_handle) < 1:
-      model['errors'] = ['user_handle_blank']
+    if user_uuid == None:
+      model['errors'] = ['user_not_found']
 
     if activity_uuid == None or len(activity_uuid) < 1:
       model['errors'] = ['activity_uuid_blank']
+    elif valid_uuid(activity_uuid) is None:
+      model['errors'] = ['activity_not_found']
 
     if message == None or len(message) < 1:
-      model['errors'] = ['message_blank'] 
+      model['errors'] = ['message_blank']
     elif len(message) > 1024:
-      model['errors'] = ['message_exceed_max_chars'] 
+      model['errors'] = ['message_exceed_max_chars']
 
     if model['errors']:
       # return what we provided
       model['data'] = {
-        'display_name': 'Chris Fenton',
-        'handle':  user_sender_handle,
+        'user_uuid': user_uuid,
         'message': message,
         'reply_to_activity_uuid': activity_uuid
       }
     else:
-      now = datetime.now(timezone.utc).astimezone()
-      model['data'] = {
-        'uuid': uuid.uuid4(),
-        'display_name': 'Chris Fenton',
-        'handle':  user_handle,
-        'message': message,
-        'created_at': now.isoformat(),
-        'reply_to_activity_uuid': activity_uuid
-      }
-    return model
\ No newline at end of file
+      uuid = CreateReply.create_reply(user_uuid, message, valid_uuid(activity_uuid))
+      if uuid is None:
+        # no such activity (or it expired and was removed)
+        model['errors'] = ['activity_not_found']
+        return model
+      LOGGER.debug('Reply %s created for activity %s', uuid, activity_uuid)
+      # the parent's replies_count is buffered, not updated here (lib/counters.py)
+      lib.counters.add(valid_uuid(activity_uuid), 'replies_count', 1)
+      model['data'] = CreateReply.query_object_reply(uuid)
+      # the parent's author hears about it (lib/notifications.py)
+      lib.notifications.notify('reply', model['data']['user_uuid'],
+        activity_uuid=valid_uuid(activity_uuid), reply_uuid=uuid)
+
+      # replies are not listed on the feed or on profiles, only the parent's
+      # replies_count is, so the feed's ETag stays (HomeActivities.validators)
+      lib.cache.invalidate(HomeActivities.CACHE_KEY)
+    return model
+
+  def create_reply(user_uuid, message, reply_to_activity_uuid):
+    # nothing is stored when the parent does not exist; replies expire with
+    # the activity they answer
+    sql = db.template('activities', 'reply')
+    return db.query_commit(sql, {
+      'user_uuid': user_uuid,
+      'message': message,
+      'reply_to_activity_uuid': reply_to_activity_uuid
+    })
+
+  def query_object_reply(uuid):
+    sql = db.template('activities', 'object')
+    return db.query_object_json(sql, {'uuid': uuid})
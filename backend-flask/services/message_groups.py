@@ -2,24 +2,36 @@ from datetime import datetime, timedelta, timezone
 
 from lib.ddb import Ddb
 from lib.db import db
+from lib.conditional import make_etag, parse_timestamp
+from lib.auth import lookup_user_uuid
+from lib.log import get_logger
+
+LOGGER = get_logger(__name__)
 
 class MessageGroups:
-  def run(cognito_user_id):
+  def run(cognito_user_id, my_user_uuid=None):
     model = {
       'errors': None,
       'data': None
     }
 
-    sql = db.template('activities/users','uuid_from_cognito_user_id')
-    my_user_uuid = db.query_value(sql,{
-      'cognito_user_id': cognito_user_id
-    })
-
-    print(f"UUID: {my_user_uuid}")
+    if my_user_uuid is None:
+      my_user_uuid = MessageGroups.my_user_uuid(cognito_user_id)
 
     ddb = Ddb.client()
     data = Ddb.list_message_groups(ddb, my_user_uuid)
-    print("list_message_groups:",data)
+    LOGGER.debug("list_message_groups user=%s groups=%d", my_user_uuid, len(data))
 
     model['data'] = data
-    return model
\ No newline at end of file
+    return model
+
+  def my_user_uuid(cognito_user_id):
+    # memoized per process; see lib/auth.py
+    return lookup_user_uuid(cognito_user_id)
+
+  def validators(my_user_uuid):
+    # the inbox is ordered by sk, so its newest sk changes whenever it does
+    ddb = Ddb.client()
+    last_message_at = Ddb.latest_message_group_at(ddb, my_user_uuid)
+    etag = make_etag('message_groups', my_user_uuid, last_message_at)
+    return etag, parse_timestamp(last_message_at)
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import secrets
+import threading
+import time
+
+from lib.concurrency import CONCURRENCY_MAX_INFLIGHT
+from lib.db import db
+from lib.pubsub import broker, Overflow
+
+# Server-Sent Events stream of a user's new messages (see /api/stream).
+# Every event published to user:<uuid> by CreateMessage is forwarded to the
+# connection; the frontend updates both the open conversation and the inbox
+# from it instead of polling /api/messages and /api/message_groups.
+#
+# Each open stream holds one gunicorn thread, so streams per process are
+# capped and recycled after SSE_MAX_LIFETIME seconds; EventSource reconnects
+# on its own after `retry` ms. The cap is the thread budget left after the
+# request limiter (CONCURRENCY_MAX_INFLIGHT) and SSE_SPARE_THREADS for shed
+# responses and health checks: GUNICORN_THREADS - 6 - 2 = 32 with the
+# entrypoint's defaults (8 request threads + SSE_STREAM_THREADS=32), so
+# streams never starve ordinary requests of threads. Without the entrypoint
+# (flask run starts a thread per request) the same 40 threads are assumed.
+#
+# EventSource cannot send an Authorization header, and a JWT in the URL ends
+# up in proxy and load balancer logs, so the stream is opened with a ticket:
+#
+#   POST /api/stream/ticket          (Authorization: Bearer ...) -> {ticket}
+#   GET  /api/stream?ticket=<ticket>
+#
+# A ticket is random, works once and only for STREAM_TICKET_TTL seconds.
+# Only its hash is stored (stream_tickets), so every worker of every task
+# can redeem it.
+SSE_HEARTBEAT = int(os.getenv('SSE_HEARTBEAT', '15'))
+SSE_MAX_LIFETIME = int(os.getenv('SSE_MAX_LIFETIME', '300'))
+GUNICORN_THREADS = int(os.getenv('GUNICORN_THREADS', '40'))
+SSE_SPARE_THREADS = int(os.getenv('SSE_SPARE_THREADS', '2'))
+SSE_MAX_STREAMS = int(os.getenv('SSE_MAX_STREAMS',
+  max(GUNICORN_THREADS - CONCURRENCY_MAX_INFLIGHT - SSE_SPARE_THREADS, 0)))
+SSE_RETRY_MS = 3000
+STREAM_TICKET_TTL = int(os.getenv('STREAM_TICKET_TTL', '30'))
+
+_open_streams = 0
+_open_streams_lock = threading.Lock()
+
+class MessageStream:
+  def acquire():
+    global _open_streams
+    with _open_streams_lock:
+      if _open_streams >= SSE_MAX_STREAMS:
+        return False
+      _open_streams += 1
+      return True
+
+  def release():
+    global _open_streams
+    with _open_streams_lock:
+      _open_streams -= 1
+
+  def ticket_hash(ticket):
+    return hashlib.sha256(ticket.encode('utf-8')).hexdigest()
+
+  def issue_ticket(my_user_uuid):
+    ticket = secrets.token_urlsafe(32)
+    sql = db.template('stream', 'issue_ticket')
+    stored = db.query_commit(sql, {
+      'ticket_hash': MessageStream.ticket_hash(ticket),
+      'user_uuid': my_user_uuid,
+      'ttl': STREAM_TICKET_TTL
+    })
+    if stored is None:
+      return None
+    return {'ticket': ticket, 'expires_in': STREAM_TICKET_TTL}
+
+  def redeem_ticket(ticket):
+    """The user the ticket was issued to, or None; the ticket is used up."""
+    if not ticket or len(ticket) > 128:
+      return None
+    sql = db.template('stream', 'consume_ticket')
+    return db.query_commit(sql, {'ticket_hash': MessageStream.ticket_hash(ticket)})
+
+  def frame(event_type, data):
+    return f"event: {event_type}\ndata: {json.dumps(data, default=str)}\n\n"
+
+  def run(my_user_uuid):
+    """
+    Generator of SSE frames. The caller must have acquire()d a slot and
+    release() it when the response is closed (even if it never started).
+    """
+    subscription = broker().subscribe([f"user:{my_user_uuid}"])
+    deadline = time.monotonic() + SSE_MAX_LIFETIME
+    try:
+      yield f"retry: {SSE_RETRY_MS}\n\n"
+      while time.monotonic() < deadline:
+        try:
+          event = subscription.get(timeout=SSE_HEARTBEAT)
+        except Overflow:
+          # we dropped events for this client; have it refetch over REST
+          yield MessageStream.frame('resync', {})
+          return
+        if event is None:
+          # comment line keeps proxies/ALB from closing an idle connection
+          yield ": ping\n\n"
+        else:
+          yield MessageStream.frame(event.get('type', 'message'), event)
+    finally:
+      broker().unsubscribe(subscription)
@@ -1,25 +1,34 @@
 from datetime import datetime, timedelta, timezone
 from lib.ddb import Ddb
 from lib.db import db
+from lib.conditional import make_etag, parse_timestamp
+from lib.log import get_logger
+
+LOGGER = get_logger(__name__)
 
 class Messages:
-  def run(message_group_uuid,cognito_user_id):
+  def run(message_group_uuid,cognito_user_id,my_user_uuid=None):
     model = {
       'errors': None,
       'data': None
     }
 
-    sql = db.template('activities/users','uuid_from_cognito_user_id')
-    my_user_uuid = db.query_value(sql,{
-      'cognito_user_id': cognito_user_id
-    })
-
-    print(f"UUID: {my_user_uuid}")
+    if my_user_uuid is None:
+      sql = db.template('activities/users','uuid_from_cognito_user_id')
+      my_user_uuid = db.query_value(sql,{
+        'cognito_user_id': cognito_user_id
+      })
 
     ddb = Ddb.client()
     data = Ddb.list_messages(ddb, message_group_uuid)
-    print("list_messages")
-    print(data)
+    LOGGER.debug("list_messages group=%s user=%s messages=%d", message_group_uuid, my_user_uuid, len(data))
 
     model['data'] = data
-    return model
\ No newline at end of file
+    return model
+
+  def validators(message_group_uuid):
+    # newest sk across the group's shards; one Limit=1 query per shard
+    ddb = Ddb.client()
+    last_message_at = Ddb.latest_message_at(ddb, message_group_uuid)
+    etag = make_etag('messages', message_group_uuid, last_message_at)
+    return etag, parse_timestamp(last_message_at)
@@ -1,39 +1,63 @@
-from datetime import datetime, timedelta, timezone
-from aws_xray_sdk.core import xray_recorder # Keep this import
+import os
+
+from lib.db import db
+from services.show_activity import valid_uuid
+
+# The signed-in user's notifications (replies to their activities, likes,
+# new messages), newest first, written by lib/notifications.py.
+#
+#   GET /api/activities/notifications                   first page
+#   GET /api/activities/notifications?before=<uuid>     the page after that one
+#
+# Pages are keyset pages on (created_at, uuid) over the
+# (user_uuid, created_at, uuid) index, so a deep page costs the same as the
+# first. 'unread' is the maintained counter in notification_counts.
+#
+# Environment:
+#   NOTIFICATIONS_PAGE  notifications per page (default 20, also the most
+#                       ?limit= may ask for)
+
+NOTIFICATIONS_PAGE = int(os.getenv('NOTIFICATIONS_PAGE', '20'))
 
 class NotificationsActivities:
-  def run():
-    # Changed to in_subsegment to indicate it's a child of the main request segment
-    with xray_recorder.in_subsegment('notifications_activities') as subsegment: # <-- CHANGED THIS LINE
-        try:
-            print("Subsegment started: notifications_activities") # <-- UPDATED PRINT MESSAGE
-            print("Endpoint logic finished.")
-             #You can add custom annotations or metadata to this subsegment here
-            subsegment.put_annotation('custom_key', 'custom_value')
-        finally:
-            print("Subsegment context manager exiting.") # <-- UPDATED PRINT MESSAGE
-
-    now = datetime.now(timezone.utc).astimezone()
-
-    results = [{
-      'uuid': '68f126b0-1ceb-4a33-88be-d90fa7109eee',
-      'handle':  'Antwuan Jacobs',
-      'message': 'AI Automation is the Future!',
-      'created_at': (now - timedelta(days=2)).isoformat(),
-      'expires_at': (now + timedelta(days=5)).isoformat(),
-      'likes_count': 100,
-      'replies_count': 1,
-      'reposts_count': 0,
-      'replies': [{
-        'uuid': '26e12864-1c26-5c3a-9658-97a10f8fea67',
-        'reply_to_activity_uuid': '68f126b0-1ceb-4a33-88be-d90fa7109eee',
-        'handle':  'Worf',
-        'message': 'This post has no honor! Follow my posts instead',
-        'likes_count': 0,
-        'replies_count': 0,
-        'reposts_count': 0,
-        'created_at': (now - timedelta(days=2)).isoformat()
-      }],
-    }]
-
-    return results
+  def run(user_uuid, before=None, limit=None):
+    model = {
+      'errors': None,
+      'data': None
+    }
+
+    if user_uuid == None:
+      model['errors'] = ['user_not_found']
+      return model
+    if before is not None:
+      before = valid_uuid(before)
+      if before is None:
+        model['errors'] = ['before_invalid']
+        return model
+    if limit is None:
+      limit = NOTIFICATIONS_PAGE
+    limit = max(1, min(limit, NOTIFICATIONS_PAGE))
+
+    sql = db.template('notifications', 'list')
+    data = db.query_object_json(sql, {
+      'user_uuid': user_uuid,
+      'before': before,
+      'limit': limit
+    })
+    notifications = data['notifications']
+    model['data'] = {
+      'notifications': notifications,
+      'unread': data['unread'],
+      # a full page: there may be older ones
+      'next': notifications[-1]['uuid'] if len(notifications) == limit else None
+    }
+    return model
+
+  def unread(user_uuid):
+    sql = db.template('notifications', 'unread')
+    return db.query_value(sql, {'user_uuid': user_uuid})
+
+  def mark_read(user_uuid):
+    """Everything received so far is read; the counter starts again at 0."""
+    sql = db.template('notifications', 'read')
+    db.query_commit(sql, {'user_uuid': user_uuid})
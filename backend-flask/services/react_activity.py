@@ -0,0 +1,58 @@
+from lib.db import db
+from lib.log import get_logger
+import lib.counters
+import lib.notifications
+from services.show_activity import valid_uuid
+
+LOGGER = get_logger(__name__)
+
+class ReactActivity:
+  # kind -> (count column, response field)
+  KINDS = {
+    'like': ('likes_count', 'liked'),
+    'repost': ('reposts_count', 'reposted')
+  }
+
+  def run(kind, activity_uuid, user_uuid, active):
+    """
+    Likes / reposts (active=True) or takes that back (active=False).
+    Repeating either is a no-op, so a double click never counts twice.
+    """
+    model = {
+      'errors': None,
+      'data': None
+    }
+
+    if user_uuid == None:
+      model['errors'] = ['user_not_found']
+      return model
+    activity_uuid = valid_uuid(activity_uuid)
+    if activity_uuid is None:
+      model['errors'] = ['activity_not_found']
+      return model
+
+    column, field = ReactActivity.KINDS[kind]
+    sql = db.template('activities', 'react' if active else 'unreact')
+    outcome = db.query_commit(sql, {
+      'activity_uuid': activity_uuid,
+      'kind': kind,
+      'user_uuid': user_uuid
+    })
+    if outcome == 'not_found':
+      model['errors'] = ['activity_not_found']
+      return model
+    if outcome is None:
+      model['errors'] = [f"{kind}_failed"]
+      return model
+
+    if outcome == 'changed':
+      # the event row is the record; the count column follows on the next flush
+      lib.counters.add(activity_uuid, column, 1 if active else -1)
+      if active and kind == 'like':
+        lib.notifications.notify('like', user_uuid, activity_uuid=activity_uuid)
+    LOGGER.debug('%s %s by %s: %s', kind, activity_uuid, user_uuid, outcome)
+    model['data'] = {
+      'uuid': activity_uuid,
+      field: active
+    }
+    return model
@@ -1,24 +1,92 @@
-from datetime import datetime, timedelta, timezone
+import os
+import uuid
+
+from lib.db import db
+from lib.log import get_logger
+
+LOGGER = get_logger(__name__)
+
+# An activity and a bounded reply tree, loaded with one query
+# (db/sql/activities/show.sql):
+#
+#   GET /api/activities/<uuid>                   first page of direct replies
+#   GET /api/activities/<uuid>?after=<reply>     the page after that reply
+#
+# Every direct reply on the page comes with its first replies, and theirs,
+# down to ACTIVITY_REPLY_DEPTH levels. A reply whose replies_count is larger
+# than what came with it has more: open it (GET /api/activities/<reply>)
+# to page through them.
+#
+# Environment:
+#   ACTIVITY_REPLIES_PAGE      direct replies per page (default 20, also the
+#                              most ?limit= may ask for)
+#   ACTIVITY_REPLY_DEPTH       levels of replies in the tree (default 3)
+#   ACTIVITY_REPLY_CHILDREN    replies loaded under each nested reply (default 5)
+
+ACTIVITY_REPLIES_PAGE = int(os.getenv('ACTIVITY_REPLIES_PAGE', '20'))
+ACTIVITY_REPLY_DEPTH = int(os.getenv('ACTIVITY_REPLY_DEPTH', '3'))
+ACTIVITY_REPLY_CHILDREN = int(os.getenv('ACTIVITY_REPLY_CHILDREN', '5'))
+
+def valid_uuid(value):
+    try:
+        return str(uuid.UUID(value))
+    except (TypeError, ValueError, AttributeError):
+        return None
 
 class ShowActivity:
     @staticmethod
-    def run(activity_uuid):
-        print(f'🔍 DEBUG: ShowActivity called with UUID: {activity_uuid}')
-        
-        now = datetime.now(timezone.utc).astimezone()
-        results = [{
-            'uuid': '68f126b0-1ceb-4a33-88be-d90fa7109eee',
-            'handle': 'Chris Fenton',
-            'message': 'Cloud is the future!',
-            'created_at': (now - timedelta(days=2)).isoformat(),
-            'expires_at': (now + timedelta(days=5)).isoformat(),
-            'replies': {
-                'uuid': '26e12864-1c26-5c3a-9658-97a10f8fea67',
-                'handle': 'Worf',
-                'message': 'This post has no honor, always go with proprietary tech in the cloud! Down with open source',
-                'created_at': (now - timedelta(days=2)).isoformat()
-            }
-        }]
-        
-        print(f'🔍 DEBUG: Returning {len(results)} activities')
-        return results
\ No newline at end of file
+    def run(activity_uuid, after=None, limit=None):
+        LOGGER.debug('ShowActivity called with UUID: %s after: %s', activity_uuid, after)
+        model = {
+            'errors': None,
+            'data': None
+        }
+
+        activity_uuid = valid_uuid(activity_uuid)
+        if activity_uuid is None:
+            model['errors'] = ['activity_not_found']
+            return model
+        if after is not None:
+            after = valid_uuid(after)
+            if after is None:
+                model['errors'] = ['after_invalid']
+                return model
+        if limit is None:
+            limit = ACTIVITY_REPLIES_PAGE
+        limit = max(1, min(limit, ACTIVITY_REPLIES_PAGE))
+
+        sql = db.template('activities', 'show')
+        result = db.query_object_json(sql, {
+            'uuid': activity_uuid,
+            'after': after,
+            'limit': limit,
+            'depth': ACTIVITY_REPLY_DEPTH,
+            'children_limit': ACTIVITY_REPLY_CHILDREN
+        })
+        if not result or result.get('activity') is None:
+            model['errors'] = ['activity_not_found']
+            return model
+
+        activity = result['activity']
+        activity['replies'] = ShowActivity.nest(activity['uuid'], result['replies'])
+        # the page is full and more direct replies follow the last one
+        activity['replies_next'] = activity['replies'][-1]['uuid'] if result['more'] else None
+        model['data'] = activity
+        return model
+
+    @staticmethod
+    def nest(root_uuid, rows):
+        """
+        Turns the flat rows of the tree (ordered by depth, then created_at)
+        into nested 'replies' lists, each in created_at order.
+        """
+        replies = {root_uuid: []}
+        for row in rows:
+            depth = row.pop('depth')
+            row['replies'] = replies[row['uuid']] = []
+            parent = replies.get(row['reply_to_activity_uuid'])
+            if parent is not None:
+                parent.append(row)
+            else:
+                LOGGER.debug('reply %s at depth %s without its parent', row['uuid'], depth)
+        return replies[root_uuid]
@@ -1,4 +1,8 @@
 from lib.db import db
+import lib.cache
+from services.home_activities import HomeActivities
+from services.user_activities import UserActivities
+from services.users_short import UsersShort
 
 class UpdateProfile:
   def run(cognito_user_id, bio, display_name):
@@ -12,6 +16,17 @@ class UpdateProfile:
     else:
       handle = UpdateProfile.update(cognito_user_id, bio, display_name)
       data = UpdateProfile.query_users_short(handle)
+      if handle is not None:
+        # display_name shows on every cached response carrying the user
+        keys = [
+          HomeActivities.CACHE_KEY,
+          UserActivities.cache_key(handle),
+          UsersShort.cache_key(handle)
+        ]
+        if isinstance(data, dict) and 'uuid' in data:
+          keys.append(UsersShort.uuid_cache_key(data['uuid']))
+        HomeActivities().changed()
+        lib.cache.invalidate(*keys)
       model['data'] = data
     return model
 
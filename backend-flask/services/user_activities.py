@@ -1,7 +1,8 @@
 from lib.db import db
+from lib.conditional import make_etag
 
 class UserActivities:
-  def run(handle):
+  def run(handle, raw=False):
     model = {
       'errors': None,
       'data': None
@@ -11,6 +12,15 @@ class UserActivities:
       model['errors'] = ['blank_user_handle']
     else:
       sql = db.template('users', 'show')
-      results = db.query_object_json(sql, {'handle': handle})
+      # raw=True: data is the profile JSON text, ready to send as the body
+      results = db.query_object_json(sql, {'handle': handle}, raw=raw)
       model['data'] = results
-    return model
\ No newline at end of file
+    return model
+
+  def cache_key(handle):
+    return f"activities:@{handle}"
+
+  def cached_body(handle):
+    # (body, etag, last_modified) for lib.cache.cached_response
+    body = UserActivities.run(handle, raw=True)['data']
+    return body, make_etag('profile', handle, body), None
\ No newline at end of file
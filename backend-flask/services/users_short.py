@@ -1,4 +1,14 @@
+import json
+import os
+import uuid
+
 from lib.db import db
+from lib.conditional import make_etag
+from lib.json_provider import loads
+import lib.cache
+
+# most users a single /api/users/short request may ask for
+USERS_SHORT_BATCH_MAX = int(os.getenv('USERS_SHORT_BATCH_MAX', '100'))
 
 class UsersShort:
   def run(handle):
@@ -6,4 +16,93 @@ class UsersShort:
     results = db.query_object_json(sql,{
       'handle': handle
     })
-    return results
\ No newline at end of file
+    return results
+
+  def run_many(handles=(), uuids=()):
+    """
+    Short cards for many users (a feed's or a conversation list's authors).
+
+    Each card is cached under the same key /api/users/@<handle>/short uses
+    (uuids under their own), so the two endpoints share entries and
+    UpdateProfile's invalidation; the cards that are not cached are loaded
+    with one query. Users asked for twice (by handle and by uuid) are
+    returned once; the ones that do not exist are listed in 'missing'.
+    """
+    model = {
+      'errors': None,
+      'data': None
+    }
+
+    lookups = {}  # cache key -> ('handle' | 'uuid', value)
+    missing = []
+    for handle in handles:
+      handle = handle.strip().lstrip('@')
+      if handle:
+        lookups.setdefault(UsersShort.cache_key(handle), ('handle', handle))
+    for value in uuids:
+      try:
+        value = str(uuid.UUID(value.strip()))
+      except ValueError:
+        missing.append(value)
+        continue
+      lookups.setdefault(UsersShort.uuid_cache_key(value), ('uuid', value))
+
+    if not lookups and not missing:
+      model['errors'] = ['users_blank']
+      return model
+    if len(lookups) > USERS_SHORT_BATCH_MAX:
+      model['errors'] = ['users_exceed_max']
+      return model
+
+    entries = lib.cache.cached_entries(list(lookups),
+      build_many=lambda keys: UsersShort.cached_bodies(keys, lookups))
+
+    users = []
+    seen = set()
+    for key, (kind, value) in lookups.items():
+      card = loads(entries[key].body)
+      if not card:
+        missing.append(value)
+      elif card['uuid'] not in seen:
+        seen.add(card['uuid'])
+        users.append(card)
+    model['data'] = {'users': users, 'missing': missing}
+    return model
+
+  def query_many(handles, uuids):
+    sql = db.template('activities/users','short_many')
+    return db.query_array_json(sql,{
+      'handles': handles,
+      'uuids': uuids
+    })
+
+  def cache_key(handle):
+    return f"users:@{handle}:short"
+
+  def uuid_cache_key(user_uuid):
+    return f"users:{user_uuid}:short"
+
+  def cached_body(handle):
+    # (body, etag, last_modified) for lib.cache.cached_response
+    data = UsersShort.run(handle)
+    return (data,) + UsersShort.validators(data)
+
+  def cached_bodies(keys, lookups):
+    # {key: (body, etag, last_modified)} for lib.cache.cached_entries; a user
+    # that does not exist is cached as {} like the single lookup caches it
+    handles = [lookups[key][1] for key in keys if lookups[key][0] == 'handle']
+    uuids = [lookups[key][1] for key in keys if lookups[key][0] == 'uuid']
+    rows = UsersShort.query_many(handles, uuids)
+    by_value = {}
+    for row in rows:
+      by_value[('handle', row['handle'])] = row
+      by_value[('uuid', row['uuid'])] = row
+    bodies = {}
+    for key in keys:
+      data = by_value.get(lookups[key], {})
+      bodies[key] = (data,) + UsersShort.validators(data)
+    return bodies
+
+  def validators(data):
+    # no updated_at on users; the short card is tiny so hash the row itself
+    return make_etag('users_short', json.dumps(data, sort_keys=True, default=str)), None
@@ -0,0 +1,86 @@
+# The adaptive limit of lib/concurrency.py on its own, driven by a fake
+# clock (no Flask app, no threads):
+#
+#   python -m pytest -q tests/test_concurrency.py
+
+import os
+import sys
+
+parent_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, parent_path)
+
+from lib.concurrency import AdaptiveLimit  # noqa: E402
+
+class Clock:
+  def __init__(self):
+    self.now = 0.0
+
+  def __call__(self):
+    return self.now
+
+def limit_measuring(clock, **kwargs):
+  """An AdaptiveLimit whose next try_acquire() starts a min RTT measurement."""
+  limit = AdaptiveLimit('test', initial=6, min_limit=3, max_limit=32, tolerance=1.25,
+                        min_rtt_interval=60, clock=clock, **kwargs)
+  clock.now += 60 * 1.1
+  return limit
+
+def test_measures_min_rtt_at_the_minimum_limit():
+  clock = Clock()
+  limit = limit_measuring(clock)
+  for _ in range(AdaptiveLimit.MIN_RTT_SAMPLES):
+    ticket = limit.try_acquire()
+    assert limit.measuring and ticket
+    limit.release(ticket, 0.002)
+  assert not limit.measuring
+  assert limit.min_rtt == 0.002
+
+def test_only_high_priority_passes_the_minimum_limit_while_measuring():
+  clock = Clock()
+  limit = limit_measuring(clock)
+  held = [limit.try_acquire() for _ in range(3)]
+  assert all(ticket is not None for ticket in held)
+  assert limit.try_acquire() is None
+  assert limit.try_acquire(high=True) is False  # admitted, but no sample
+  assert limit.measuring
+
+def test_measurement_ends_under_steady_high_priority_load():
+  clock = Clock()
+  limit = limit_measuring(clock)
+  held = [limit.try_acquire(high=True) for _ in range(5)]
+  assert limit.measuring
+  for _ in range(2000):
+    # one request finishes, the next is admitted: 5 always in flight
+    limit.release(held.pop(0), 0.01)
+    ticket = limit.try_acquire(high=True)
+    assert ticket is not None
+    held.append(ticket)
+  assert not limit.measuring
+  # the limit adapts again, and low priority is no longer held to min_limit
+  assert limit.limit != 6.0
+  assert limit.current() == limit.limit
+
+def test_measurement_ends_after_the_timeout():
+  clock = Clock()
+  limit = limit_measuring(clock)
+  limit.release(limit.try_acquire(), 0.004)
+  assert limit.measuring
+  clock.now += AdaptiveLimit.MIN_RTT_TIMEOUT
+  limit.release(limit.try_acquire(), 0.004)
+  assert not limit.measuring
+  # finished with the one sample it had
+  assert limit.min_rtt == 0.004
+
+def test_timed_out_measurement_without_samples_keeps_min_rtt():
+  clock = Clock()
+  limit = AdaptiveLimit('test', initial=6, min_limit=3, min_rtt_interval=60, clock=clock)
+  limit.min_rtt = 0.003
+  clock.now += 60 * 1.1
+  # in flight the whole time, so not one sample comes back
+  for _ in range(5):
+    limit.try_acquire(high=True)
+  assert limit.measuring
+  clock.now += AdaptiveLimit.MIN_RTT_TIMEOUT
+  limit.try_acquire(high=True)
+  assert not limit.measuring
+  assert limit.min_rtt == 0.003
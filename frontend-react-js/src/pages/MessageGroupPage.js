@@ -80,6 +80,49 @@ export default function MessageGroupPage() {
     }
   };
 
+  // Push channel: the backend streams new messages for this user over SSE
+  // (/api/stream) so the page does not have to poll for them. EventSource
+  // cannot send the Authorization header, so the stream is opened with a
+  // one-time ticket; a ticket only works once, so every reconnect (the server
+  // recycles streams) asks for a new one.
+  const streamRef = React.useRef({ source: null, timer: null, stopped: false });
+
+  const openMessageStream = async () => {
+    const stream = streamRef.current;
+    const accessToken = await getAccessToken();
+    if (!accessToken || stream.stopped) return;
+
+    const res = await fetch(`${process.env.REACT_APP_BACKEND_URL}/api/stream/ticket`, {
+      method: "POST",
+      headers: { 'Authorization': `Bearer ${accessToken}` }
+    });
+    if (res.status !== 200 || stream.stopped) return;
+    const { ticket } = await res.json();
+
+    const stream_url = `${process.env.REACT_APP_BACKEND_URL}/api/stream?ticket=${encodeURIComponent(ticket)}`
+    const source = new EventSource(stream_url);
+    stream.source = source;
+    source.addEventListener('message', (e) => {
+      const event = JSON.parse(e.data);
+      if (event.message_group_uuid === params.message_group_uuid) {
+        setMessages(current => [...current, event]);
+      }
+      loadMessageGroupsData();
+    });
+    // the server dropped events for us; refetch everything
+    source.addEventListener('resync', () => {
+      loadMessageGroupsData();
+      loadMessageGroupData();
+    });
+    // the used ticket cannot reconnect: close it and start over with a new one
+    source.addEventListener('error', () => {
+      source.close();
+      if (!stream.stopped) {
+        stream.timer = setTimeout(openMessageStream, 3000);
+      }
+    });
+  };
+
   React.useEffect(()=>{
     //prevents double call
     if (dataFetchedRef.current) return;
@@ -90,6 +133,17 @@ export default function MessageGroupPage() {
     loadMessageGroupData();
   }, [])
 
+  React.useEffect(()=>{
+    const stream = streamRef.current;
+    stream.stopped = false;
+    openMessageStream();
+    return () => {
+      stream.stopped = true;
+      clearTimeout(stream.timer);
+      if (stream.source) stream.source.close();
+    };
+  }, [])
+
   return (
     <article>
       <DesktopNavigation user={user} active={'home'} setPopped={setPopped} handleSignOut={handleSignOut} />
@@ -34,7 +34,7 @@ export default function NotificationsFeedPage() {
       });
       let resJson = await res.json();
       if (res.status === 200) {
-        setActivities(resJson)
+        setActivities(resJson.notifications)
       } else {
         console.log(res)
       }